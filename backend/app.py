@@ -1,28 +1,37 @@
 import os
-from functools import wraps
 from flask import Flask, redirect, url_for, session, jsonify, request, Blueprint
 from authlib.integrations.flask_client import OAuth
 from dotenv import load_dotenv
 
 # Assuming auth.py is in a 'backend' package or same directory
-from backend.auth import get_or_create_user 
+from backend.auth import get_or_create_user, login_required
+from backend.db_utils import teardown_unit_of_work, pin_reads_to_primary
+from backend.compression import compress_response
+from backend import metrics
+from backend.log import get_logger
 # Import Blueprint modules
 from backend.projects_api import projects_bp
 from backend.diagrams_api import diagrams_bp
 from backend.sharing_api import sharing_bp
+from backend.revisions_api import revisions_bp
+from backend.search_api import search_bp
+from backend.transfer_api import transfer_bp
+from backend.debug_api import debug_bp
+from backend import query_profile # Registers the slow-query hook
 from backend.sockets import sockets # Import the Sockets object
 
 # Load environment variables from .env file
 load_dotenv()
 
+log = get_logger(__name__)
 app = Flask(__name__)
 # Ensure FLASK_SECRET_KEY is set, otherwise raise an error
 if not os.getenv("FLASK_SECRET_KEY"):
     raise RuntimeError("FLASK_SECRET_KEY is not set in the environment.")
 if not os.getenv("GOOGLE_CLIENT_ID") or not os.getenv("GOOGLE_CLIENT_SECRET"):
-    app.logger.warning("Google OAuth credentials are not set. Authentication will not work.")
+    log.warning("Google OAuth credentials are not set. Authentication will not work.")
 if not os.getenv("DATABASE_URL"):
-    app.logger.warning("DATABASE_URL is not set. Database operations will fail.")
+    log.warning("DATABASE_URL is not set. Database operations will fail.")
 
 app.secret_key = os.getenv("FLASK_SECRET_KEY") 
 app.config.update(
@@ -30,15 +39,13 @@ app.config.update(
     SESSION_COOKIE_SECURE=True if os.getenv('FLASK_ENV') == 'production' else False, # Use secure cookies in production
 )
 
-# --- Authentication Decorator ---
-def login_required(f):
-    @wraps(f)
-    def decorated_function(*args, **kwargs):
-        if 'user' not in session:
-            return jsonify(error="Authentication required. Please login."), 401
-        # You could add more checks here, e.g., user active status from DB
-        return f(*args, **kwargs)
-    return decorated_function
+# Compress JSON/NDJSON bodies (gzip or brotli). Registered first so it runs last of the
+# after_request hooks and sees the final body
+app.after_request(compress_response)
+# Release any request-scoped database unit of work left open by a handler
+app.teardown_appcontext(teardown_unit_of_work)
+# Send a user's reads to the primary for a few seconds after they write (read-your-writes)
+app.after_request(pin_reads_to_primary)
 
 # --- Error Handlers ---
 @app.errorhandler(400)
@@ -59,13 +66,12 @@ def not_found(e):
 
 @app.errorhandler(500)
 def internal_server_error(e):
-    # Log the error e for debugging
-    app.logger.error(f"Internal Server Error: {e}")
+    log.error("Internal server error", error=str(e))
     return jsonify(error="Internal server error"), 500
 
 @app.errorhandler(PermissionError) # Custom permission error from db_utils
 def handle_permission_error(e):
-    app.logger.warning(f"Permission denied: {e}")
+    log.warning("Permission denied", error=str(e))
     return jsonify(error=str(e)), 403
 
 
@@ -110,7 +116,7 @@ def auth_google_callback():
     try:
         token = google.authorize_access_token()
     except Exception as e:
-        app.logger.error(f"Error authorizing access token: {e}")
+        log.error("Error authorizing access token", error=str(e))
         return jsonify(error="Failed to authorize access token", details=str(e)), 400
 
     if not token:
@@ -121,14 +127,14 @@ def auth_google_callback():
     # Alternatively, parse the ID token if available and configured
     user_info_response = google.get('userinfo')
     if not user_info_response.ok:
-        app.logger.error(f"Failed to fetch user info: {user_info_response.text}")
+        log.error("Failed to fetch user info", status=user_info_response.status_code, body=user_info_response.text)
         return jsonify(error="Failed to fetch user information from Google."), 500
         
     user_info = user_info_response.json()
 
     # Check if DATABASE_URL is set (required by auth.py)
     if not os.getenv("DATABASE_URL"):
-        app.logger.error("DATABASE_URL is not set. Cannot connect to database.")
+        log.error("DATABASE_URL is not set. Cannot connect to database.")
         # In a real app, you might redirect to an error page or return a more user-friendly error
         return jsonify(error="Server configuration error: Database URL not set."), 500
 
@@ -147,7 +153,7 @@ def auth_google_callback():
         else:
             return jsonify(error="Could not retrieve or create user."), 500
     except Exception as e:
-        app.logger.error(f"Error in get_or_create_user: {e}")
+        log.exception("Error in get_or_create_user")
         return jsonify(error="An error occurred during user processing.", details=str(e)), 500
 
 
@@ -171,6 +177,16 @@ def logout():
 app.register_blueprint(projects_bp, url_prefix='/api')
 app.register_blueprint(diagrams_bp, url_prefix='/api') # Diagrams are routed like /api/projects/<id>/diagrams and /api/diagrams/<id>
 app.register_blueprint(sharing_bp, url_prefix='/api')  # Sharing routes are /api/projects/<id>/sharing
+app.register_blueprint(revisions_bp, url_prefix='/api')  # History routes are /api/diagrams/<id>/revisions
+app.register_blueprint(search_bp, url_prefix='/api')  # Search is /api/search?q=
+app.register_blueprint(transfer_bp, url_prefix='/api')  # /api/projects/<id>/export and /api/projects/import
+
+# Dev-only introspection (top queries by time); never registered in production by default
+if os.getenv('DEBUG_ENDPOINTS', '1' if os.getenv('FLASK_ENV') == 'development' else '0') == '1':
+    app.register_blueprint(debug_bp, url_prefix='/api')  # /api/debug/queries
+
+# Request timing and the Prometheus scrape endpoint at /metrics
+metrics.init_app(app)
 
 
 # Initialize Flask-Sockets with the app
@@ -183,16 +199,16 @@ if __name__ == '__main__':
     if not is_debug_mode:
         # Production or staging with gevent
         from gevent import pywsgi
-        from geventwebsocket.handler import WebSocketHandler
-        print("Starting gevent WSGI server with WebSocket support...")
-        server = pywsgi.WSGIServer(('', int(os.getenv("PORT", 5000))), app, handler_class=WebSocketHandler)
+        from backend.ws_deflate import DeflateWebSocketHandler
+        log.info("Starting gevent WSGI server with WebSocket support")
+        server = pywsgi.WSGIServer(('', int(os.getenv("PORT", 5000))), app, handler_class=DeflateWebSocketHandler)
         server.serve_forever()
     else:
         # Development server (Flask's default server can work with Flask-Sockets for basic testing,
         # but gevent is more robust for WebSockets)
         # For simplicity in this environment, we'll rely on Flask-Sockets's compatibility
         # with the dev server. If issues arise, a full gevent setup would be needed even for dev.
-        print("Starting Flask development server with WebSocket support...")
+        log.info("Starting Flask development server with WebSocket support")
         # The Flask dev server itself doesn't natively support WebSockets in a way Flask-Sockets
         # always seamlessly integrates without gevent. However, Flask-Sockets tries to make it work.
         # For true robustness, gevent is preferred.
@@ -217,11 +233,10 @@ if __name__ == '__main__':
         # The most reliable way is to use gevent for serving.
         try:
             from gevent import pywsgi
-            from geventwebsocket.handler import WebSocketHandler
-            print(f"Starting gevent WSGI server on port {os.getenv('PORT', 5000)} in debug mode (less optimal but functional)...")
-            server = pywsgi.WSGIServer(('0.0.0.0', int(os.getenv("PORT", 5000))), app, handler_class=WebSocketHandler)
+            from backend.ws_deflate import DeflateWebSocketHandler
+            log.info("Starting gevent WSGI server in debug mode (less optimal but functional)", port=int(os.getenv('PORT', 5000)))
+            server = pywsgi.WSGIServer(('0.0.0.0', int(os.getenv("PORT", 5000))), app, handler_class=DeflateWebSocketHandler)
             server.serve_forever()
         except ImportError:
-            print("gevent not found. Falling back to Flask's default development server.")
-            print("WebSockets may not work correctly with the default Flask dev server without gevent.")
+            log.warning("gevent not found. Falling back to Flask's default development server; WebSockets may not work correctly.")
             app.run(debug=is_debug_mode, host='0.0.0.0', port=int(os.getenv("PORT", 5000)))
@@ -0,0 +1,199 @@
+"""
+ASGI entry point: the same REST API and /ws/diagram/<id> protocol, served by asyncio.
+
+    uvicorn backend.asgi:application --host 0.0.0.0 --port 5000 --workers 4
+    gunicorn -w 4 -k uvicorn.workers.UvicornWorker backend.asgi:application
+
+Nothing is monkey-patched in this mode. HTTP requests go to the Flask app through a WSGI
+bridge that runs on a pool of ASGI_WSGI_THREADS threads. WebSockets are native: a socket
+is a coroutine reading frames plus a task draining its send queue. An idle editor
+therefore costs a few KB of memory and no thread or greenlet, so one worker can hold
+tens of thousands of them.
+
+The room logic is the one sockets.py uses: OT sequencing, the backplane between workers,
+and the write-behind flush. Its database calls (room loads, claiming revisions, flushes)
+are blocking psycopg2 calls on the shared pool. They run on a separate executor of
+ASGI_DB_THREADS threads, sized like the pool, so a slow query holds up that socket's next
+frame but never the event loop.
+"""
+import os
+import re
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+from asgiref.sync import SyncToAsync
+from asgiref.wsgi import WsgiToAsgi, WsgiToAsgiInstance
+from flask import session
+from werkzeug.test import EnvironBuilder
+
+from backend import metrics, sockets
+from backend.app import app as flask_app
+from backend.db_pool import DB_POOL_MAX_SIZE
+from backend.log import get_logger, LOG_SAMPLE_RATE
+
+ASGI_WSGI_THREADS = int(os.getenv("ASGI_WSGI_THREADS", "32"))  # Concurrent REST requests per worker
+ASGI_DB_THREADS = int(os.getenv("ASGI_DB_THREADS", str(DB_POOL_MAX_SIZE)))  # Concurrent room database calls per worker
+
+SOCKET_ROUTE = re.compile(r"^/ws/diagram/(\d+)/?$")
+
+log = get_logger(__name__)
+
+_wsgi_executor = ThreadPoolExecutor(max_workers=ASGI_WSGI_THREADS, thread_name_prefix="asgi-wsgi")
+_db_executor = ThreadPoolExecutor(max_workers=ASGI_DB_THREADS, thread_name_prefix="asgi-db")
+
+
+# --- REST: the Flask app on a thread pool ---
+
+def _closing(wsgi_app):
+    """Closes the response iterable however iteration ends; Flask finishes streamed responses there."""
+    def app(environ, start_response):
+        iterable = wsgi_app(environ, start_response)
+        try:
+            yield from iterable
+        finally:
+            if hasattr(iterable, 'close'):
+                iterable.close()
+    return app
+
+
+class _ThreadedWsgiInstance(WsgiToAsgiInstance):
+    # asgiref runs every request on one shared thread by default; use a real pool instead
+    run_wsgi_app = SyncToAsync(WsgiToAsgiInstance.__dict__['run_wsgi_app'].func, thread_sensitive=False, executor=_wsgi_executor)
+
+
+class ThreadedWsgiToAsgi(WsgiToAsgi):
+    async def __call__(self, scope, receive, send):
+        await _ThreadedWsgiInstance(self.wsgi_application, self.duplicate_header_limit)(scope, receive, send)
+
+
+_rest = ThreadedWsgiToAsgi(_closing(flask_app.wsgi_app))
+
+
+# --- WebSockets ---
+
+class AsyncClientConnection(sockets.ClientConnection):
+    """
+    sockets.ClientConnection whose writer is an asyncio task instead of a thread. It keeps
+    the same queue, coalescing and slow-consumer rules. enqueue() may still be called from
+    any thread: the room runs on the database executor, and remote edits arrive on the
+    backplane's listener thread.
+    """
+    def __init__(self, send, diagram_id, loop):
+        self._send = send
+        self._loop = loop
+        self._wakeup = asyncio.Event()
+        self.disconnected = False
+        super().__init__(None, diagram_id)
+
+    @property
+    def closed(self):
+        return self._closed or self.disconnected
+
+    def _start_writer(self):
+        self._writer = self._loop.create_task(self._drain())
+
+    def _wake_writer(self):
+        self._loop.call_soon_threadsafe(self._wakeup.set)
+
+    async def _drain(self):
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            while True:
+                with self._cond:
+                    if self._closed:
+                        return
+                    if not self._queue:
+                        break
+                    enqueued_at, _, message = self._queue.popleft()
+                    self._in_flight_since = enqueued_at
+                try:
+                    await self._send({'type': 'websocket.send', 'text': message})
+                    sockets.count_sent(message)
+                except Exception as e:
+                    log.warning("Send failed, closing client", diagram_id=self.diagram_id, error=str(e))
+                    self.close()
+                    return
+                finally:
+                    self._in_flight_since = None
+
+    def _close_slow_socket(self):
+        self._loop.call_soon_threadsafe(self._loop.create_task, self._close_socket())
+
+    async def _close_socket(self):
+        try:
+            await self._send({'type': 'websocket.close', 'code': sockets.CLOSE_CODE_SLOW_CONSUMER})
+        except Exception:
+            pass
+
+
+async def _in_db_thread(function, *args):
+    return await asyncio.get_running_loop().run_in_executor(_db_executor, functools.partial(function, *args))
+
+
+def _socket_access(scope, diagram_id):
+    """sockets.socket_access() for the user of the handshake's session cookie, read by the Flask app."""
+    headers = [(name.decode('latin-1'), value.decode('latin-1')) for name, value in scope['headers']]
+    with flask_app.request_context(EnvironBuilder(path=scope['path'], headers=headers).get_environ()):
+        return sockets.socket_access(diagram_id, session.get('user'))
+
+
+async def diagram_socket(scope, receive, send, diagram_id):
+    """The /ws/diagram/<id> protocol of sockets.diagram_socket, on asyncio."""
+    if (await receive())['type'] != 'websocket.connect':
+        return
+    await send({'type': 'websocket.accept'})
+    metrics.ensure_writer()
+    access = await _in_db_thread(_socket_access, scope, diagram_id)
+    if access is None:
+        await send({'type': 'websocket.close', 'code': sockets.CLOSE_CODE_POLICY_VIOLATION,
+                    'reason': "Not allowed to open this diagram."})
+        return
+    client = AsyncClientConnection(send, diagram_id, asyncio.get_running_loop())
+    client.can_edit = access == 'edit'
+    log.debug("Client connected", diagram_id=diagram_id)
+    room = None
+    try:
+        room = await _in_db_thread(sockets.join_room, diagram_id, client)
+        while True:
+            event = await receive()
+            if event['type'] == 'websocket.disconnect':
+                break
+            message = event.get('text')
+            if message is None:
+                message = (event.get('bytes') or b'').decode('utf-8', 'replace')
+            log.debug("Frame received", sample=LOG_SAMPLE_RATE, diagram_id=diagram_id, size=len(message), payload=message)
+            await _in_db_thread(sockets.handle_message, room, client, message)
+    except Exception:
+        log.exception("Error in WebSocket handler", diagram_id=diagram_id)
+    finally:
+        client.disconnected = True
+        await _in_db_thread(sockets.leave_room, diagram_id, client, room)
+
+
+# --- Entry point ---
+
+async def _lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            # Open rooms are flushed by rooms' atexit hook once the server exits
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def application(scope, receive, send):
+    if scope['type'] == 'http':
+        await _rest(scope, receive, send)
+    elif scope['type'] == 'websocket':
+        match = SOCKET_ROUTE.match(scope['path'])
+        if match is None:
+            await receive()  # websocket.connect
+            await send({'type': 'websocket.close', 'code': sockets.CLOSE_CODE_POLICY_VIOLATION})
+            return
+        await diagram_socket(scope, receive, send, int(match.group(1)))
+    elif scope['type'] == 'lifespan':
+        await _lifespan(receive, send)
@@ -1,59 +1,63 @@
 import os
 import psycopg2
-from psycopg2.extras import RealDictCursor
+from functools import wraps
+from flask import session, jsonify
+from backend.cache_utils import TTLCache
+from backend.db_utils import execute_query
+from backend import metrics
+from backend.log import get_logger
 
-# Placeholder for database connection - in a real app, manage this connection carefully
-DATABASE_URL = os.getenv("DATABASE_URL")
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", "60"))
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "10000"))
 
-def get_db_connection():
-    conn = psycopg2.connect(DATABASE_URL)
-    return conn
+log = get_logger(__name__)
 
-def get_user_by_google_id(google_id: str):
-    """Fetches a user by their Google ID."""
-    conn = get_db_connection()
-    cursor = conn.cursor(cursor_factory=RealDictCursor)
-    cursor.execute("SELECT * FROM users WHERE google_id = %s", (google_id,))
-    user = cursor.fetchone()
-    cursor.close()
-    conn.close()
-    return user
+# google_id -> users row, so a burst of logins doesn't turn into a burst of writes
+_user_cache = TTLCache(maxsize=USER_CACHE_SIZE, ttl=USER_CACHE_TTL)
 
-def get_user_by_email(email: str):
-    """Fetches a user by their email."""
-    conn = get_db_connection()
-    cursor = conn.cursor(cursor_factory=RealDictCursor)
-    cursor.execute("SELECT * FROM users WHERE email = %s", (email,))
-    user = cursor.fetchone()
-    cursor.close()
-    conn.close()
-    return user
+# --- Authentication Decorator ---
+# Lives here rather than in app.py so the blueprints app.py imports can use it
+def login_required(f):
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if 'user' not in session:
+            return jsonify(error="Authentication required. Please login."), 401
+        # You could add more checks here, e.g., user active status from DB
+        return f(*args, **kwargs)
+    return decorated_function
 
-def create_user(google_id: str, name: str, email: str, profile_pic_url: str = None):
-    """Creates a new user in the database."""
-    conn = get_db_connection()
-    cursor = conn.cursor(cursor_factory=RealDictCursor)
-    # Assuming your users table has 'google_id', 'username' (can be name), 'email', 'profile_pic_url'
-    # And that password_hash is not required if using Google OAuth primarily
-    cursor.execute(
-        """
+# One round trip for every login. The UPDATE refreshes a user already linked to this
+# Google account. Otherwise the INSERT creates the user, or, if the email is already
+# registered without a Google account, links it. An email linked to a different Google
+# account is left alone and nothing is returned.
+UPSERT_GOOGLE_USER = """
+    WITH linked AS (
+        UPDATE users SET username = %(name)s, profile_pic_url = %(picture)s, updated_at = CURRENT_TIMESTAMP
+        WHERE google_id = %(google_id)s
+        RETURNING *
+    ), upserted AS (
         INSERT INTO users (google_id, username, email, profile_pic_url)
-        VALUES (%s, %s, %s, %s)
-        RETURNING *;
-        """,
-        (google_id, name, email, profile_pic_url)
+        SELECT %(google_id)s, %(name)s, %(email)s, %(picture)s
+        WHERE NOT EXISTS (SELECT 1 FROM linked)
+        ON CONFLICT (email) DO UPDATE
+            SET google_id = EXCLUDED.google_id, username = EXCLUDED.username,
+                profile_pic_url = EXCLUDED.profile_pic_url, updated_at = CURRENT_TIMESTAMP
+            WHERE users.google_id IS NULL OR users.google_id = EXCLUDED.google_id
+        RETURNING *
     )
-    new_user = cursor.fetchone()
-    conn.commit()
-    cursor.close()
-    conn.close()
-    return new_user
+    SELECT * FROM linked
+    UNION ALL
+    SELECT * FROM upserted;
+"""
 
 def get_or_create_user(user_info: dict):
     """
     Gets an existing user or creates a new one based on Google profile information.
     The `user_info` dict is expected to come from Authlib's `userinfo()` endpoint.
     It typically contains 'sub' (subject, Google's ID for the user), 'name', 'email', 'picture'.
+
+    Repeat logins within USER_CACHE_TTL with an unchanged name and picture are answered
+    from this worker's cache without touching the database.
     """
     google_id = user_info.get('sub')
     email = user_info.get('email')
@@ -63,46 +67,28 @@ def get_or_create_user(user_info: dict):
     if not google_id or not email:
         raise ValueError("Google ID or email missing from user info.")
 
-    # Try to find user by Google ID first
-    user = get_user_by_google_id(google_id)
-    if user:
-        # Optionally, update user's name or profile picture if they've changed
-        # For example:
-        # if user['username'] != name or user.get('profile_pic_url') != profile_pic:
-        #     update_user_details(user['user_id'], name, profile_pic)
-        return user
-
-    # If not found by Google ID, try by email (in case they registered differently before)
-    # Be cautious with this if emails are not strictly verified or unique across OAuth providers
-    user = get_user_by_email(email)
-    if user:
-        # If found by email, it's good practice to link their Google ID now
-        # For example:
-        # link_google_id_to_user(user['user_id'], google_id)
-        # For simplicity, we'll assume if email matches, it's the same user and update their google_id
-        # Or, if your policy is stricter, this could be an error or merge-account scenario.
-        # For now, let's assume we create a new one if google_id doesn't match,
-        # or handle it as an update if the table structure supports it (e.g. google_id can be NULL).
-        # The current create_user function expects google_id, so direct creation is simpler here.
-        pass # Fall through to create if no user with that google_id
-
-    # Create new user
-    # Note: The 'users' table needs a 'google_id' column.
-    # The schema in init.sql had username, email, password_hash.
-    # It needs to be adjusted for OAuth. Let's assume 'username' can store 'name',
-    # and 'password_hash' can be nullable. A 'google_id' column is crucial.
-    # I will proceed assuming the `users` table will be updated to include `google_id VARCHAR(255) UNIQUE`
-    # and `profile_pic_url VARCHAR(255)`.
-    # I will also assume `password_hash` can be NULL for OAuth users.
+    cached = _user_cache.get(google_id)
+    if cached is not None and cached['username'] == name and cached.get('profile_pic_url') == profile_pic:
+        return dict(cached)
 
     try:
-        new_user = create_user(google_id=google_id, name=name, email=email, profile_pic_url=profile_pic)
-        return new_user
+        user = execute_query(UPSERT_GOOGLE_USER,
+                             {'google_id': google_id, 'name': name, 'email': email, 'picture': profile_pic},
+                             fetchone=True, commit=True)
     except psycopg2.Error as e:
-        # Handle potential database errors (e.g., unique constraint violation if somehow missed)
-        print(f"Database error: {e}")
-        # In a real app, log this and potentially raise a custom exception
+        # Handle potential database errors (e.g., a concurrent login changing the same rows)
+        log.error("Could not create user", error=str(e))
         return None
+    if user is None:
+        log.warning("Email is already linked to another Google account", email=email)
+        return None
+    _user_cache.set(google_id, dict(user))
+    return user
+
+
+metrics.register_gauge('user_cache_lookups_total', "Login cache lookups by result.",
+                       lambda: [({'result': 'hit'}, _user_cache.hits), ({'result': 'miss'}, _user_cache.misses)],
+                       metric_type='counter')
 
 # Example of how you might update the users table structure:
 # ALTER TABLE users ADD COLUMN google_id VARCHAR(255) UNIQUE;
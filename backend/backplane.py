@@ -0,0 +1,132 @@
+import os
+import json
+import uuid
+import socket
+import threading
+
+from backend.db_utils import execute_query
+from backend import pubsub
+from backend.log import get_logger
+
+log = get_logger(__name__)
+
+# Postgres rejects NOTIFY payloads of 8000 bytes or more. Messages whose envelope would
+# exceed this are stored in socket_messages and only their id is sent.
+MAX_INLINE_PAYLOAD = int(os.getenv("BACKPLANE_MAX_INLINE_PAYLOAD", "7900"))
+# How long stored messages are kept for slow listeners before being purged.
+STORED_MESSAGE_TTL_SECONDS = int(os.getenv("BACKPLANE_STORED_MESSAGE_TTL", "60"))
+PURGE_EVERY_N_STORED = 100
+
+_worker_id = None
+_worker_pid = None
+_stored_count = 0
+_local_handlers = {}  # diagram_id -> handler(message), one per diagram per worker
+_lock = threading.Lock()
+
+
+def worker_id():
+    """Identifies this worker process across the whole deployment (host, pid, random suffix)."""
+    global _worker_id, _worker_pid
+    if _worker_pid != os.getpid():
+        _worker_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        _worker_pid = os.getpid()
+    return _worker_id
+
+
+def channel_for(diagram_id):
+    return f"diagram_{diagram_id}"
+
+
+def _make_listener(diagram_id, handler):
+    def deliver(item):
+        ref, message = item
+        if ref is not None:
+            row = execute_query("SELECT payload FROM socket_messages WHERE message_id = %s", (ref,), fetchone=True)
+            if not row:
+                log.warning("Backplane message expired before delivery", diagram_id=diagram_id, ref=ref)
+                return
+            message = row['payload']
+        handler(message)
+
+    # Stored messages are fetched here, off the listener thread; whatever arrives behind one
+    # queues after it so messages stay in publish order
+    mailbox = pubsub.Mailbox(deliver, f"backplane-{diagram_id}")
+
+    def on_notify(payload):
+        if payload is None:  # Channel (re)subscribed: earlier messages were not seen
+            item = (None, None)
+        else:
+            try:
+                envelope = json.loads(payload)
+            except ValueError:
+                log.warning("Ignoring malformed backplane payload", diagram_id=diagram_id, payload=payload)
+                return
+            if envelope.get('o') == worker_id():
+                return  # Our own broadcast, already delivered locally
+            item = (envelope.get('ref'), envelope.get('m'))
+        if item[0] is None and mailbox.idle():
+            handler(item[1])
+        else:
+            mailbox.put(item)
+    return on_notify
+
+
+def join(diagram_id, handler):
+    """
+    Starts relaying messages published by other workers for `diagram_id` to `handler`.
+    Called when the first local client joins a diagram. `handler(message)` is called in
+    publish order, on the pubsub listener thread or, behind a stored message, on the
+    diagram's mailbox thread; it must not block either way. `handler(None)` signals that
+    the channel just became live (or was re-established) and earlier messages were not
+    received.
+    """
+    listener = _make_listener(diagram_id, handler)
+    with _lock:
+        _local_handlers[diagram_id] = listener
+    pubsub.subscribe(channel_for(diagram_id), listener)
+
+
+def leave(diagram_id):
+    """Stops relaying for `diagram_id`, once the last local client has left."""
+    with _lock:
+        listener = _local_handlers.pop(diagram_id, None)
+    if listener is not None:
+        pubsub.unsubscribe(channel_for(diagram_id), listener)
+
+
+def envelope(message, origin=None):
+    """
+    The NOTIFY payload carrying `message` from this worker, or None if it is too large to inline.
+    Listeners skip messages from their own worker; an `origin` of its own gets it delivered there too.
+    """
+    payload = json.dumps({'o': origin or worker_id(), 'm': message})
+    return payload if len(payload.encode('utf-8')) <= MAX_INLINE_PAYLOAD else None
+
+
+def publish(diagram_id, message):
+    """Sends `message` (a str) to the clients of `diagram_id` connected to every other worker."""
+    global _stored_count
+    payload = envelope(message)
+    if payload is not None:
+        pubsub.publish(channel_for(diagram_id), payload)
+        return
+
+    # Pass by reference: store the body and NOTIFY its id, in a single round-trip
+    execute_query(
+        """
+        WITH stored AS (
+            INSERT INTO socket_messages (diagram_id, payload) VALUES (%s, %s)
+            RETURNING message_id
+        )
+        SELECT pg_notify(%s, json_build_object('o', %s, 'ref', stored.message_id)::text)
+        FROM stored;
+        """,
+        (diagram_id, message, channel_for(diagram_id), worker_id()),
+        fetchone=True, commit=True
+    )
+    _stored_count += 1
+    if _stored_count % PURGE_EVERY_N_STORED == 0:
+        execute_query(
+            "DELETE FROM socket_messages WHERE created_at < CURRENT_TIMESTAMP - make_interval(secs => %s)",
+            (STORED_MESSAGE_TTL_SECONDS,), commit=True
+        )
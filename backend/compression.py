@@ -0,0 +1,148 @@
+"""
+Negotiated gzip/brotli compression of HTTP responses.
+
+    app.after_request(compress_response)
+
+JSON, NDJSON and text responses are compressed when the client accepts it and the body is
+at least COMPRESS_MIN_BYTES. Brotli wins ties in Accept-Encoding when the `brotli` package
+is installed; otherwise only gzip is offered. Streamed responses (the NDJSON export) are
+compressed chunk by chunk as they are sent, so a large export is never held in memory.
+A body that doesn't get smaller is sent as is.
+
+Every compression is counted in the http_compression_* metrics: bytes in, bytes out and
+the CPU seconds spent per encoding.
+"""
+import os
+import time
+import zlib
+
+from flask import request
+
+from backend import metrics
+
+try:
+    import brotli
+except ImportError:  # br is optional; gzip always works
+    brotli = None
+
+COMPRESS_MIN_BYTES = int(os.getenv("COMPRESS_MIN_BYTES", "1024"))  # Smaller bodies aren't worth the CPU
+COMPRESS_GZIP_LEVEL = int(os.getenv("COMPRESS_GZIP_LEVEL", "6"))  # 1-9
+COMPRESS_BROTLI_QUALITY = int(os.getenv("COMPRESS_BROTLI_QUALITY", "4"))  # 0-11; above ~5 costs far more CPU than it saves
+
+COMPRESSIBLE_MIMETYPES = {'application/json', 'application/x-ndjson', 'text/plain', 'text/html'}
+
+
+class _Gzip:
+    encoding = 'gzip'
+
+    def __init__(self):
+        self._z = zlib.compressobj(COMPRESS_GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def compress(self, data):
+        return self._z.compress(data)
+
+    def finish(self):
+        return self._z.flush()
+
+
+class _Brotli:
+    encoding = 'br'
+
+    def __init__(self):
+        self._b = brotli.Compressor(quality=COMPRESS_BROTLI_QUALITY)
+
+    def compress(self, data):
+        return self._b.process(data)
+
+    def finish(self):
+        return self._b.finish()
+
+
+_COMPRESSORS = {'br': _Brotli, 'gzip': _Gzip}
+
+
+class _Tally:
+    """Bytes and CPU time of one response's compression, reported once when it's done."""
+    def __init__(self, encoding):
+        self.encoding = encoding
+        self.bytes_in = self.bytes_out = 0
+        self.cpu = 0.0
+
+    def run(self, step, data=None):
+        started = time.thread_time()
+        output = step() if data is None else step(data)  # An empty chunk still goes to compress()
+        self.cpu += time.thread_time() - started
+        self.bytes_in += len(data or b'')
+        self.bytes_out += len(output)
+        return output
+
+    def report(self):
+        metrics.inc('http_compressed_responses_total', encoding=self.encoding)
+        metrics.inc('http_compression_input_bytes_total', self.bytes_in, encoding=self.encoding)
+        metrics.inc('http_compression_output_bytes_total', self.bytes_out, encoding=self.encoding)
+        metrics.inc('http_compression_cpu_seconds_total', self.cpu, encoding=self.encoding)
+
+
+def choose_encoding():
+    """The encoding to use for this request: the client's highest q-value, br before gzip on ties."""
+    best, best_quality = None, 0
+    for encoding in _COMPRESSORS:
+        if encoding == 'br' and brotli is None:
+            continue
+        quality = request.accept_encodings.quality(encoding)
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+    return best
+
+
+def _compress_stream(iterable, compressor, tally):
+    try:
+        for chunk in iterable:
+            if isinstance(chunk, str):
+                chunk = chunk.encode('utf-8')
+            output = tally.run(compressor.compress, chunk)
+            if output:
+                yield output
+        yield tally.run(compressor.finish)
+        tally.report()
+    finally:
+        if hasattr(iterable, 'close'):
+            iterable.close()
+
+
+def compress_response(response):
+    """after_request hook: compresses the response body when that is negotiated and worthwhile."""
+    if (request.method == 'HEAD' or response.direct_passthrough
+            or response.status_code < 200 or response.status_code in (204, 304)
+            or 'Content-Encoding' in response.headers or response.mimetype not in COMPRESSIBLE_MIMETYPES):
+        return response
+    response.vary.add('Accept-Encoding')
+    encoding = choose_encoding()
+    if encoding is None:
+        return response
+
+    compressor, tally = _COMPRESSORS[encoding](), _Tally(encoding)
+    if response.is_streamed:
+        response.response = _compress_stream(response.response, compressor, tally)
+        response.headers.pop('Content-Length', None)
+    else:
+        data = response.get_data()
+        if len(data) < COMPRESS_MIN_BYTES:
+            return response
+        body = tally.run(compressor.compress, data) + tally.run(compressor.finish)
+        if len(body) >= len(data):
+            return response
+        tally.report()
+        response.set_data(body)
+    response.headers['Content-Encoding'] = encoding
+    # The encoded bytes differ from the identity ones, so a strong validator no longer holds
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+    return response
+
+
+metrics.describe('http_compressed_responses_total', 'counter', "Responses sent compressed, by encoding.")
+metrics.describe('http_compression_input_bytes_total', 'counter', "Bytes of response bodies before compression.")
+metrics.describe('http_compression_output_bytes_total', 'counter', "Bytes of response bodies after compression.")
+metrics.describe('http_compression_cpu_seconds_total', 'counter', "CPU time spent compressing response bodies.")
@@ -0,0 +1,330 @@
+import os
+import time
+import threading
+from collections import deque
+from contextlib import contextmanager
+
+import psycopg2
+import psycopg2.extensions
+import psycopg2.extras
+
+# Pool settings, overridable per deployment. Sizes are per gunicorn worker, so the
+# total number of Postgres connections is roughly workers * DB_POOL_MAX_SIZE.
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "10"))  # Seconds to wait for a free connection
+DB_POOL_MAX_LIFETIME = float(os.getenv("DB_POOL_MAX_LIFETIME", "1800"))  # Recycle connections older than this
+DB_POOL_HEALTHCHECK_AFTER = float(os.getenv("DB_POOL_HEALTHCHECK_AFTER", "30"))  # Ping connections idle longer than this
+# Read replicas (comma-separated DSNs); each gets its own pool of DB_POOL_MAX_SIZE
+DB_REPLICA_RETRY_AFTER = float(os.getenv("DB_REPLICA_RETRY_AFTER", "30"))  # Seconds a failed replica is skipped
+DB_REPLICA_CONNECT_TIMEOUT = int(os.getenv("DB_REPLICA_CONNECT_TIMEOUT", "3"))
+
+
+class PoolError(psycopg2.Error):
+    """Raised when the pool is closed or otherwise unusable."""
+
+
+class PoolTimeout(PoolError):
+    """Raised when no connection became available within the wait timeout."""
+
+
+class PooledConnection(psycopg2.extensions.connection):
+    """psycopg2 connection that carries the bookkeeping the pool needs."""
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.created_at = time.monotonic()
+        self.last_used_at = self.created_at
+        # Names of the server-side prepared statements of this session (see db_utils.PreparedQuery);
+        # None when unknown after an error, so they are all deallocated before the next PREPARE
+        self.prepared = set()
+
+
+def _enable_gevent_support():
+    """
+    Make psycopg2 cooperative when running under gevent.
+    Without a wait callback psycopg2 blocks in libpq and stalls every greenlet in the
+    worker while a query is in flight. wait_select relies on `select` being monkey-patched,
+    which the gunicorn gevent worker does before the app is imported.
+    """
+    try:
+        from gevent import monkey
+    except ImportError:
+        return False
+    if not monkey.is_module_patched('select'):
+        return False
+    if psycopg2.extensions.get_wait_callback() is None:
+        psycopg2.extensions.set_wait_callback(psycopg2.extras.wait_select)
+    return True
+
+
+class ConnectionPool:
+    """
+    Bounded, per-process PostgreSQL connection pool.
+
+    Idle connections are reused LIFO so the hottest connections stay warm. Waiting is done
+    on a threading.Condition, which gevent's monkey-patching turns into a greenlet-aware
+    primitive, so the same pool works under gevent workers and plain threads.
+    """
+    def __init__(self, dsn, max_size=DB_POOL_MAX_SIZE, timeout=DB_POOL_TIMEOUT,
+                 max_lifetime=DB_POOL_MAX_LIFETIME, healthcheck_after=DB_POOL_HEALTHCHECK_AFTER, connect_timeout=None):
+        if not dsn:
+            raise ValueError("DATABASE_URL environment variable is not set.")
+        if max_size < 1:
+            raise ValueError("Pool max_size must be at least 1.")
+        self.dsn = dsn
+        self.max_size = max_size
+        self.timeout = timeout
+        self.max_lifetime = max_lifetime
+        self.healthcheck_after = healthcheck_after
+        self.connect_timeout = connect_timeout
+        self.pid = os.getpid()
+
+        self._idle = deque()
+        self._size = 0  # Open connections, idle + checked out
+        self._waiting = 0
+        self._closed = False
+        self._cond = threading.Condition()
+
+        # Counters for wait-time metrics and pool health
+        self._checkouts = 0
+        self._connects = 0
+        self._discards = 0
+        self._timeouts = 0
+        self._failed_healthchecks = 0
+        self._wait_time_total = 0.0
+        self._wait_time_max = 0.0
+
+    def _connect(self):
+        if self.connect_timeout:
+            conn = psycopg2.connect(self.dsn, connection_factory=PooledConnection, connect_timeout=self.connect_timeout)
+        else:
+            conn = psycopg2.connect(self.dsn, connection_factory=PooledConnection)
+        self._connects += 1
+        return conn
+
+    def _is_expired(self, conn, now):
+        return self.max_lifetime and now - conn.created_at > self.max_lifetime
+
+    def _is_healthy(self, conn):
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            self._failed_healthchecks += 1
+            return False
+
+    def _close_quietly(self, conn):
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+
+    def getconn(self, timeout=None):
+        """Checks out a connection, waiting up to `timeout` seconds for one to free up."""
+        timeout = self.timeout if timeout is None else timeout
+        started = time.monotonic()
+        deadline = started + timeout
+        conn = None
+        with self._cond:
+            while True:
+                if self._closed:
+                    raise PoolError("Connection pool is closed.")
+                if self._idle:
+                    conn = self._idle.pop()
+                    break
+                if self._size < self.max_size:
+                    self._size += 1  # Reserve the slot before connecting outside the lock
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._timeouts += 1
+                    raise PoolTimeout(f"Timed out after {timeout:.1f}s waiting for a database connection "
+                                      f"(pool size {self.max_size}).")
+                self._waiting += 1
+                try:
+                    self._cond.wait(remaining)
+                finally:
+                    self._waiting -= 1
+
+            waited = time.monotonic() - started
+            self._checkouts += 1
+            self._wait_time_total += waited
+            self._wait_time_max = max(self._wait_time_max, waited)
+
+        try:
+            now = time.monotonic()
+            if conn is not None and (conn.closed or self._is_expired(conn, now) or
+                                     (now - conn.last_used_at > self.healthcheck_after and not self._is_healthy(conn))):
+                self._discards += 1
+                self._close_quietly(conn)
+                conn = None
+            if conn is None:
+                conn = self._connect()
+        except Exception:
+            self._release_slot()
+            raise
+        return conn
+
+    def _release_slot(self):
+        with self._cond:
+            self._size -= 1
+            self._cond.notify()
+
+    def putconn(self, conn, discard=False):
+        """Returns a connection to the pool, rolling back any open transaction."""
+        if not discard and not conn.closed:
+            try:
+                if conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+            except psycopg2.Error:
+                discard = True
+        if discard or conn.closed or self._closed or self._is_expired(conn, time.monotonic()):
+            self._discards += 1
+            self._close_quietly(conn)
+            self._release_slot()
+            return
+        conn.last_used_at = time.monotonic()
+        with self._cond:
+            self._idle.append(conn)
+            self._cond.notify()
+
+    @contextmanager
+    def connection(self, timeout=None):
+        """
+        Context manager that checks a connection out and always returns it.
+        Connections that raised an OperationalError/InterfaceError are discarded, since
+        they most likely lost their server.
+        """
+        conn = self.getconn(timeout)
+        discard = False
+        try:
+            yield conn
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            discard = True
+            raise
+        finally:
+            self.putconn(conn, discard=discard)
+
+    def closeall(self):
+        with self._cond:
+            self._closed = True
+            while self._idle:
+                self._close_quietly(self._idle.pop())
+                self._size -= 1
+            self._cond.notify_all()
+
+    def stats(self):
+        """Snapshot of pool state and wait-time metrics."""
+        with self._cond:
+            return {
+                'max_size': self.max_size,
+                'size': self._size,
+                'idle': len(self._idle),
+                'in_use': self._size - len(self._idle),
+                'waiting': self._waiting,
+                'checkouts': self._checkouts,
+                'connects': self._connects,
+                'discards': self._discards,
+                'timeouts': self._timeouts,
+                'failed_healthchecks': self._failed_healthchecks,
+                'wait_time_total': self._wait_time_total,
+                'wait_time_max': self._wait_time_max,
+            }
+
+
+class ReplicaSet:
+    """
+    One pool per read replica, handed out round-robin. A replica whose connection fails is
+    skipped for `retry_after` seconds, after which the next read tries it again.
+    """
+    def __init__(self, dsns, retry_after=DB_REPLICA_RETRY_AFTER):
+        self.pools = [ConnectionPool(dsn, connect_timeout=DB_REPLICA_CONNECT_TIMEOUT) for dsn in dsns]
+        self.retry_after = retry_after
+        self.pid = os.getpid()
+        self._down_until = [0.0] * len(self.pools)
+        self._next = 0
+        self._lock = threading.Lock()
+        self._failovers = 0
+
+    def choose(self):
+        """The next replica pool that isn't marked down, or None if they all are."""
+        now = time.monotonic()
+        with self._lock:
+            for _ in range(len(self.pools)):
+                index = self._next
+                self._next = (index + 1) % len(self.pools)
+                if self._down_until[index] <= now:
+                    return self.pools[index]
+        return None
+
+    def mark_down(self, pool):
+        with self._lock:
+            self._down_until[self.pools.index(pool)] = time.monotonic() + self.retry_after
+            self._failovers += 1
+
+    def healthy(self):
+        now = time.monotonic()
+        with self._lock:
+            return sum(1 for until in self._down_until if until <= now)
+
+    def closeall(self):
+        for pool in self.pools:
+            pool.closeall()
+
+    def stats(self):
+        now = time.monotonic()
+        with self._lock:
+            down = [until > now for until in self._down_until]
+            failovers = self._failovers
+        return {'failovers': failovers,
+                'replicas': [{'down': is_down, **pool.stats()} for pool, is_down in zip(self.pools, down)]}
+
+
+_pool = None
+_replicas = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """
+    Returns this process's pool, creating it on first use.
+    The pool is keyed on the pid so a forked gunicorn worker never shares sockets with
+    its parent; the inherited pool object is simply dropped.
+    """
+    global _pool
+    pool = _pool
+    if pool is not None and pool.pid == os.getpid():
+        return pool
+    with _pool_lock:
+        if _pool is None or _pool.pid != os.getpid():
+            _enable_gevent_support()
+            _pool = ConnectionPool(os.getenv("DATABASE_URL"))
+        return _pool
+
+
+def get_replicas():
+    """This process's ReplicaSet for DATABASE_REPLICA_URLS, or None if no replicas are configured."""
+    global _replicas
+    replicas = _replicas
+    if replicas is not None and replicas.pid == os.getpid():
+        return replicas
+    dsns = [dsn.strip() for dsn in os.getenv("DATABASE_REPLICA_URLS", "").split(",") if dsn.strip()]
+    if not dsns:
+        return None
+    with _pool_lock:
+        if _replicas is None or _replicas.pid != os.getpid():
+            _enable_gevent_support()
+            _replicas = ReplicaSet(dsns)
+        return _replicas
+
+
+def close_pool():
+    """Closes the current process's pools, e.g. on worker shutdown."""
+    global _pool, _replicas
+    with _pool_lock:
+        if _pool is not None and _pool.pid == os.getpid():
+            _pool.closeall()
+        if _replicas is not None and _replicas.pid == os.getpid():
+            _replicas.closeall()
+        _pool = _replicas = None
@@ -1,34 +1,278 @@
 import os
+import re
+import time
+from contextlib import contextmanager
 import psycopg2
-from psycopg2.extras import RealDictCursor
+import psycopg2.errors
+from psycopg2.extras import RealDictCursor, execute_values
+from flask import g, has_app_context, has_request_context, request, session
+from backend.db_pool import get_pool, get_replicas, PoolTimeout
+from backend import metrics
+from backend.log import get_logger
 
 DATABASE_URL = os.getenv("DATABASE_URL")
+DB_READ_YOUR_WRITES_SECONDS = float(os.getenv("DB_READ_YOUR_WRITES_SECONDS", "5"))  # Reads stay on the primary this long after a write
+DB_PREPARED_STATEMENTS = os.getenv("DB_PREPARED_STATEMENTS", "1") == "1"  # 0 behind a transaction-mode pooler
+
+log = get_logger(__name__)
 
 def get_db_connection():
-    """Establishes a connection to the database."""
-    if not DATABASE_URL:
-        raise ValueError("DATABASE_URL environment variable is not set.")
-    conn = psycopg2.connect(DATABASE_URL)
-    return conn
+    """
+    Checks a pooled connection out of this worker's pool.
+    Callers must hand it back with release_db_connection() instead of closing it.
+    """
+    return get_pool().getconn()
+
+def release_db_connection(conn, discard=False):
+    """Returns a connection obtained from get_db_connection() to the pool."""
+    get_pool().putconn(conn, discard=discard)
+
+def _current_unit_of_work():
+    """Returns the connection of the unit of work open in this app context, if any."""
+    if has_app_context():
+        return g.get('_db_unit_of_work')
+    return None
+
+QUERY_OPERATIONS = ('SELECT', 'INSERT', 'UPDATE', 'DELETE', 'WITH')
+
+class QueryEvent:
+    """
+    What a query hook is told about one statement. `cursor` is the cursor it ran on (its
+    connection is still checked out); `error` is the psycopg2 error it raised, if any.
+    """
+    __slots__ = ('query', 'params', 'operation', 'duration', 'error', 'cursor', 'batch_size')
+
+    def __init__(self, query, params, operation, duration, error, cursor, batch_size=None):
+        self.query = query
+        self.params = params
+        self.operation = operation
+        self.duration = duration
+        self.error = error
+        self.cursor = cursor
+        self.batch_size = batch_size  # Rows expanded into VALUES, for execute_values_query()
+
+_query_hooks = []
+
+def add_query_hook(hook):
+    """Calls hook(QueryEvent) after every statement run through this module."""
+    if hook not in _query_hooks:
+        _query_hooks.append(hook)
+
+def _instrumented(run, cursor, query, params, batch_size=None):
+    """Calls run(), times it, and hands the outcome to every query hook."""
+    started_at = time.perf_counter()
+    error = None
+    try:
+        return run()
+    except psycopg2.Error as e:
+        error = e
+        raise
+    finally:
+        keyword = query.lstrip()[:6].upper()
+        operation = next((op for op in QUERY_OPERATIONS if keyword.startswith(op)), 'OTHER')
+        event = QueryEvent(query, params, operation, time.perf_counter() - started_at, error, cursor, batch_size)
+        for hook in _query_hooks:
+            try:
+                hook(event)
+            except Exception:
+                log.exception("Error in query hook", hook=getattr(hook, '__name__', repr(hook)))
+
+def _record_query_metrics(event):
+    if event.error is not None:
+        metrics.inc('db_query_errors_total', operation=event.operation)
+    metrics.observe('db_query_duration_seconds', event.duration, operation=event.operation)
+
+add_query_hook(_record_query_metrics)
+
+# --- Prepared statements ---
+
+_PLACEHOLDER = re.compile(r"%(?:\((\w+)\))?([s%])")
+_prepared_names = {}
+
+class PreparedQuery(str):
+    """
+    A fixed, frequently run SQL text that execute_query() runs as a named server-side
+    prepared statement, so Postgres parses it once per connection and can reuse its plan:
+
+        DIAGRAM_OWNER = PreparedQuery('diagram_owner', "SELECT ... WHERE diagram_id = %s;")
+        execute_query(DIAGRAM_OWNER, (diagram_id,), fetchone=True)
+
+    It is still a str, so anything that runs it directly on a cursor gets the plain query.
+    Placeholders are either all positional (%s) or all named (%(name)s).
+    """
+    def __new__(cls, name, query):
+        if _prepared_names.setdefault(name, query) != query:
+            raise ValueError(f"Prepared statement name {name!r} is already used for another query.")
+        self = super().__new__(cls, query)
+        self.name = name
+        keys = []
+
+        def number(match):
+            key, kind = match.groups()
+            if kind == '%':
+                return '%'
+            if key is None:
+                keys.append(None)
+                return f"${len(keys)}"
+            if key not in keys:
+                keys.append(key)
+            return f"${keys.index(key) + 1}"
+
+        body = _PLACEHOLDER.sub(number, query).strip().rstrip(';')
+        if None in keys and len(keys) > keys.count(None):
+            raise ValueError(f"Prepared statement {name!r} mixes positional and named placeholders.")
+        self.prepare_sql = f"PREPARE {name} AS {body}"
+        arguments = ", ".join("%s" if key is None else f"%({key})s" for key in keys)
+        self.execute_sql = f"EXECUTE {name} ({arguments})" if keys else f"EXECUTE {name}"
+        return self
+
+def _is_stale_prepared(error):
+    """The session lost (or never had) a statement we think is prepared, or its plan went stale after DDL."""
+    if isinstance(error, (psycopg2.errors.InvalidSqlStatementName, psycopg2.errors.DuplicatePreparedStatement)):
+        return True
+    return isinstance(error, psycopg2.errors.FeatureNotSupported) and 'cached plan' in str(error)
+
+def _execute_prepared(conn, cursor, query, params):
+    if conn.prepared is None:
+        cursor.execute("DEALLOCATE ALL")
+        conn.prepared = set()
+    try:
+        if query.name not in conn.prepared:
+            cursor.execute(query.prepare_sql)
+            conn.prepared.add(query.name)
+            metrics.inc('db_statements_prepared_total')
+        cursor.execute(query.execute_sql, params)
+    except psycopg2.Error as e:
+        if _is_stale_prepared(e):
+            conn.prepared = None
+        raise
+
+def _run_on_connection(conn, query, params=None, fetchone=False, fetchall=False):
+    cursor = conn.cursor(cursor_factory=RealDictCursor)
+    if DB_PREPARED_STATEMENTS and isinstance(query, PreparedQuery) and hasattr(conn, 'prepared'):
+        _instrumented(lambda: _execute_prepared(conn, cursor, query, params), cursor, query, params)
+    else:
+        _instrumented(lambda: cursor.execute(query, params), cursor, query, params)
+    if fetchone:
+        return cursor.fetchone()
+    if fetchall:
+        return cursor.fetchall()
+    return None
+
+def _run_statement(conn, query, params=None, fetchone=False, fetchall=False):
+    """
+    _run_on_connection() for a statement that has its transaction to itself. If the
+    session lost a prepared statement (a pooler reset it, or DDL invalidated the plan),
+    the transaction is rolled back and the statement prepared again and retried once.
+    """
+    try:
+        return _run_on_connection(conn, query, params, fetchone, fetchall)
+    except psycopg2.Error as e:
+        if not (isinstance(query, PreparedQuery) and _is_stale_prepared(e)):
+            raise
+        log.warning("Prepared statement lost, preparing it again", statement=query.name, error=str(e))
+        conn.rollback()
+        metrics.inc('db_statements_reprepared_total')
+        return _run_on_connection(conn, query, params, fetchone, fetchall)
+
+# --- Read replicas ---
+
+READ_METHODS = ('GET', 'HEAD')
+PRIMARY_UNTIL_SESSION_KEY = '_db_primary_until'
+_LOCKING_CLAUSE = re.compile(r"\bFOR\s+(NO\s+KEY\s+)?(UPDATE|SHARE|KEY\s+SHARE)\b", re.IGNORECASE)
+
+def _replica_eligible(query, commit, primary):
+    """
+    Only plain SELECTs issued by GET/HEAD requests go to a replica, and not for a user who
+    wrote something in the last DB_READ_YOUR_WRITES_SECONDS (they'd miss their own change).
+    WITH statements may modify data, so they stay on the primary.
+
+    WebSocket handlers run inside the GET of their handshake, but their room loads and
+    catch-ups must see every revision already committed, so they never use a replica.
+    """
+    if primary or commit or not has_request_context() or request.method not in READ_METHODS:
+        return False
+    if 'wsgi.websocket' in request.environ or request.headers.get('Upgrade', '').lower() == 'websocket':
+        return False
+    if session.get(PRIMARY_UNTIL_SESSION_KEY, 0) > time.time():
+        return False
+    return query.lstrip()[:6].upper() == 'SELECT' and not _LOCKING_CLAUSE.search(query)
+
+def _read_from_replica(replicas, query, params, fetchone, fetchall):
+    """
+    Runs a read on the next healthy replica. Returns (True, result), or (False, None) when
+    no replica could serve it and the caller should use the primary. A replica whose
+    connection fails is marked down and the next one is tried.
+    """
+    while True:
+        pool = replicas.choose()
+        if pool is None:
+            return False, None
+        conn = None
+        discard = False
+        try:
+            conn = pool.getconn()
+            return True, _run_statement(conn, query, params, fetchone, fetchall)
+        except PoolTimeout:
+            return False, None  # Busy rather than broken; don't take it out of rotation
+        except (psycopg2.OperationalError, psycopg2.InterfaceError) as e:
+            discard = True
+            if conn is not None and not conn.closed:
+                # The replica is up but couldn't run it (e.g. cancelled by a recovery conflict)
+                log.warning("Replica query failed, retrying on the primary", error=str(e))
+                return False, None
+            replicas.mark_down(pool)
+            metrics.inc('db_replica_failovers_total')
+            log.warning("Replica unavailable, marking it down", error=str(e), retry_after=replicas.retry_after)
+        except psycopg2.Error as e:
+            log.error("Database query error", error=str(e), query=query)
+            raise
+        finally:
+            if conn is not None:
+                pool.putconn(conn, discard=discard)
+
+def pin_reads_to_primary(response):
+    """
+    after_request hook: once a user's write succeeds, their reads go to the primary for
+    DB_READ_YOUR_WRITES_SECONDS, long enough for the replicas to catch up.
+    """
+    if (request.method not in READ_METHODS + ('OPTIONS',) and response.status_code < 400
+            and 'user' in session and get_replicas() is not None):
+        session[PRIMARY_UNTIL_SESSION_KEY] = time.time() + DB_READ_YOUR_WRITES_SECONDS
+    return response
 
 # Example of a helper function to execute queries
-def execute_query(query, params=None, fetchone=False, fetchall=False, commit=False):
+def execute_query(query, params=None, fetchone=False, fetchall=False, commit=False, primary=False):
     """
     Executes a SQL query and returns results.
-    Manages connection and cursor.
+    Borrows a connection from the pool for the duration of the statement, unless a
+    unit of work is open for the current request; then the statement runs on that
+    unit's connection and `commit` is deferred until the unit of work ends.
+    Reads from GET requests may be served by a read replica (see _replica_eligible);
+    pass `primary=True` for reads that must see the latest committed data.
     """
+    uow_conn = _current_unit_of_work()
+    if uow_conn is not None:
+        try:
+            return _run_on_connection(uow_conn, query, params, fetchone, fetchall)
+        except psycopg2.Error as e:
+            log.error("Database query error", error=str(e), query=query)
+            raise
+
+    if _replica_eligible(query, commit, primary):
+        replicas = get_replicas()
+        if replicas is not None:
+            served, result = _read_from_replica(replicas, query, params, fetchone, fetchall)
+            metrics.inc('db_replica_reads_total', target='replica' if served else 'primary')
+            if served:
+                return result
+
     conn = None
+    discard = False
     try:
         conn = get_db_connection()
-        cursor = conn.cursor(cursor_factory=RealDictCursor)
-        cursor.execute(query, params)
-        
-        result = None
-        if fetchone:
-            result = cursor.fetchone()
-        elif fetchall:
-            result = cursor.fetchall()
-        
+        result = _run_statement(conn, query, params, fetchone, fetchall)
+
         if commit:
             conn.commit()
             # For INSERT, UPDATE, DELETE returning ID or affected row,
@@ -45,22 +289,117 @@ def execute_query(query, params=None, fetchone=False, fetchall=False, commit=Fal
 
         return result
     except psycopg2.Error as e:
-        if conn and not commit: # Only rollback if not a commit error itself
-            conn.rollback()
+        # Connections that lost their server are dropped; anything else is rolled back
+        # when the pool takes the connection back.
+        discard = isinstance(e, (psycopg2.OperationalError, psycopg2.InterfaceError))
         # Log error e
-        print(f"Database query error: {e}") # Replace with proper logging
+        log.error("Database query error", error=str(e), query=query)
         raise # Re-raise the exception to be handled by the caller
     finally:
         if conn:
-            conn.close()
+            release_db_connection(conn, discard=discard)
+
+def execute_values_query(query, argslist, template=None, page_size=100, fetch=False, commit=False):
+    """
+    Runs `query`, whose single VALUES %s placeholder is expanded from the tuples in
+    `argslist` (see psycopg2.extras.execute_values), on one connection and, with
+    `commit`, in one transaction. Returns the rows of every page when `fetch` is set.
+    Joins the current unit of work like execute_query().
+    """
+    uow_conn = _current_unit_of_work()
+    conn = uow_conn
+    discard = False
+    try:
+        if conn is None:
+            conn = get_db_connection()
+        cursor = conn.cursor(cursor_factory=RealDictCursor)
+        result = _instrumented(
+            lambda: execute_values(cursor, query, argslist, template=template, page_size=page_size, fetch=fetch),
+            cursor, query, argslist[:1], batch_size=len(argslist)
+        )
+        if commit and uow_conn is None:
+            conn.commit()
+        return result
+    except psycopg2.Error as e:
+        discard = isinstance(e, (psycopg2.OperationalError, psycopg2.InterfaceError))
+        log.error("Database query error", error=str(e), query=query)
+        raise
+    finally:
+        if conn is not None and uow_conn is None:
+            release_db_connection(conn, discard=discard)
+
+def _pool_stats():
+    stats = get_pool().stats()
+    return [({'state': state}, stats[state]) for state in ('in_use', 'idle', 'waiting')]
+
+metrics.register_gauge('db_pool_connections', "Pooled connections by state.", _pool_stats)
+metrics.register_gauge('db_pool_wait_seconds_total', "Time spent waiting for a pooled connection.",
+                       lambda: get_pool().stats()['wait_time_total'], metric_type='counter')
+metrics.register_gauge('db_pool_checkouts_total', "Connections checked out of the pool.",
+                       lambda: get_pool().stats()['checkouts'], metric_type='counter')
+metrics.register_gauge('db_pool_timeouts_total', "Checkouts that timed out waiting for a connection.",
+                       lambda: get_pool().stats()['timeouts'], metric_type='counter')
+metrics.describe('db_statements_prepared_total', 'counter', "PREPAREs issued for PreparedQuery statements.")
+metrics.describe('db_statements_reprepared_total', 'counter', "Statements retried after their session lost a prepared statement.")
+metrics.describe('db_replica_reads_total', 'counter', "Replica-eligible reads, by where they ran.")
+metrics.describe('db_replica_failovers_total', 'counter', "Times a read replica was taken out of rotation.")
+metrics.register_gauge('db_replicas_healthy', "Read replicas currently in rotation.",
+                       lambda: get_replicas().healthy() if get_replicas() is not None else 0)
+
+@contextmanager
+def unit_of_work():
+    """
+    Runs every execute_query() issued inside the block, within the current request,
+    on one pooled connection and one transaction that is committed once on exit.
+    Any exception rolls the whole unit back. Nested blocks join the outer unit.
+    """
+    if _current_unit_of_work() is not None:
+        yield g._db_unit_of_work
+        return
+
+    conn = get_db_connection()
+    g._db_unit_of_work = conn
+    discard = False
+    try:
+        yield conn
+        conn.commit()
+    except BaseException as e:
+        discard = isinstance(e, (psycopg2.OperationalError, psycopg2.InterfaceError))
+        if not discard:
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                discard = True
+        raise
+    finally:
+        g.pop('_db_unit_of_work', None)
+        release_db_connection(conn, discard=discard)
+
+def teardown_unit_of_work(exc=None):
+    """
+    App-context teardown hook: rolls back and releases a unit of work that was left
+    open (e.g. by a generator that was never exhausted) so its connection is not leaked.
+    """
+    conn = g.pop('_db_unit_of_work', None)
+    if conn is not None:
+        release_db_connection(conn, discard=conn.closed)
 
 class BaseDBOperations:
     """
     Base class for database operations to inherit common utilities like execute_query.
     """
-    def _execute(self, query, params=None, fetchone=False, fetchall=False, commit=False):
+    def _execute(self, query, params=None, fetchone=False, fetchall=False, commit=False, primary=False):
         # This method provides a shorthand for subclasses
-        return execute_query(query, params, fetchone, fetchall, commit)
+        return execute_query(query, params, fetchone, fetchall, commit, primary)
+
+    def unit_of_work(self):
+        """
+        Groups the statements of a request into one connection and one transaction:
+
+            with db_ops.unit_of_work():
+                ...  # every self._execute() here shares the connection; commit happens on exit
+        """
+        return unit_of_work()
 
     def _get_user_id_from_session(self, session):
         """Helper to get user_id from session, raises error if not found."""
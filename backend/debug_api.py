@@ -0,0 +1,30 @@
+from flask import Blueprint, request, jsonify
+from backend.auth import login_required # Import the shared decorator
+from backend import query_profile
+
+# Development-only routes; app.py registers this blueprint only when DEBUG_ENDPOINTS is on
+debug_bp = Blueprint('debug_api', __name__)
+
+QUERY_SORT_KEYS = ('total_ms', 'mean_ms', 'max_ms', 'calls', 'slow')
+
+@debug_bp.route('/debug/queries', methods=['GET'])
+@login_required
+def get_top_queries():
+    """
+    This worker's statements by total time (or ?sort=mean_ms|max_ms|calls|slow), ?limit= (default 20).
+    Each carries its normalized SQL, call count, timings, calling endpoints and last captured plan.
+    """
+    sort = request.args.get('sort', 'total_ms')
+    if sort not in QUERY_SORT_KEYS:
+        return jsonify(error=f"sort must be one of {list(QUERY_SORT_KEYS)}."), 400
+    try:
+        limit = int(request.args.get('limit', 20))
+    except ValueError:
+        return jsonify(error="limit must be an integer."), 400
+    return jsonify(query_profile.top_queries(max(1, limit), sort)), 200
+
+@debug_bp.route('/debug/queries', methods=['DELETE'])
+@login_required
+def reset_query_stats():
+    query_profile.reset()
+    return jsonify(message="Query statistics reset."), 200
@@ -1,25 +1,29 @@
+import json
+import base64
+from datetime import datetime
 from flask import Blueprint, request, jsonify, session
-from backend.db_utils import BaseDBOperations
-from backend.app import login_required # Import the shared decorator
+from backend.db_utils import BaseDBOperations, PreparedQuery, execute_values_query
+from backend.auth import login_required # Import the shared decorator
+from backend.log import get_logger
+from backend import permission_cache, project_listing, http_cache, revisions, rooms
 
 diagrams_bp = Blueprint('diagrams_api', __name__)
 db_ops = BaseDBOperations()
+log = get_logger(__name__)
 
 # Helper function to check project access (view or edit)
+# Resolved through the shared permission cache, so autosaves don't re-run the JOIN every time
 def check_project_access(project_id, user_id, require_edit=False):
-    permission_query = """
-        SELECT p.user_id AS owner_id, sp.permission_level
-        FROM projects p
-        LEFT JOIN sharing_permissions sp ON p.project_id = sp.project_id AND sp.user_id = %s
-        WHERE p.project_id = %s;
-    """
-    result = db_ops._execute(permission_query, (user_id, project_id), fetchone=True)
+    result = permission_cache.get_project_access(project_id, user_id)
 
     if not result:
         raise PermissionError("Project not found.") # 404
 
-    is_owner = result['owner_id'] == user_id
-    permission_level = result['permission_level']
+    return evaluate_access(result['owner_id'], result['permission_level'], user_id, require_edit)
+
+def evaluate_access(owner_id, permission_level, user_id, require_edit=False):
+    """Applies the project access rules to an already-fetched owner/permission pair."""
+    is_owner = owner_id == user_id
 
     if is_owner:
         return True # Owner has all permissions
@@ -33,6 +37,81 @@ def check_project_access(project_id, user_id, require_edit=False):
     # If require_edit is False, any permission_level (e.g., 'view') or ownership is enough
     return True
 
+# The access-checked queries below return the caller's access alongside the data in one
+# round-trip, under these two column names. split_access() separates them again.
+ACCESS_COLUMNS = """p.user_id AS access_owner_id, sp.permission_level AS access_permission_level"""
+
+# The columns a diagram is returned with. The trigger-maintained search columns (often larger
+# than the diagram itself) and live_revision are internal, so no query selects diagrams.*.
+DIAGRAM_FIELDS = ['diagram_id', 'diagram_name', 'project_id', 'diagram_data', 'created_at', 'updated_at']
+
+def diagram_columns(alias):
+    """DIAGRAM_FIELDS qualified with a table alias, for a SELECT or RETURNING list."""
+    return ", ".join(f"{alias}.{field}" for field in DIAGRAM_FIELDS)
+
+# SQL predicate equivalent to evaluate_access(require_edit=False) / (require_edit=True).
+CAN_VIEW_SQL = "(p.user_id = %(user_id)s OR sp.permission_level IS NOT NULL)"
+CAN_EDIT_SQL = "(p.user_id = %(user_id)s OR sp.permission_level IN ('edit', 'admin'))"
+
+def split_access(row):
+    """Splits a row from an access-checked query into (owner_id, permission_level, record)."""
+    record = dict(row)
+    owner_id = record.pop('access_owner_id')
+    permission_level = record.pop('access_permission_level')
+    return owner_id, permission_level, record
+
+
+# --- Diagram listing (metadata + keyset pagination) ---
+# Columns a listing may project via ?fields=. diagram_data is opt-in; data_size reports the
+# stored (possibly compressed) size of diagram_data without reading it.
+LISTING_FIELDS = {
+    'diagram_id': "d.diagram_id",
+    'diagram_name': "d.diagram_name",
+    'project_id': "d.project_id",
+    'created_at': "d.created_at",
+    'updated_at': "d.updated_at",
+    'data_size': "pg_column_size(d.diagram_data) AS data_size",
+    'diagram_data': "d.diagram_data",
+}
+DEFAULT_LISTING_FIELDS = ['diagram_id', 'diagram_name', 'project_id', 'created_at', 'updated_at', 'data_size']
+DEFAULT_LISTING_LIMIT = 50
+MAX_LISTING_LIMIT = 200
+
+def encode_listing_cursor(diagram):
+    """Opaque keyset cursor pointing just past `diagram` in (updated_at, diagram_id) DESC order."""
+    raw = json.dumps([diagram['updated_at'].isoformat(), diagram['diagram_id']])
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+def decode_listing_cursor(cursor):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        updated_at, diagram_id = json.loads(raw)
+        return datetime.fromisoformat(updated_at), int(diagram_id)
+    except (ValueError, TypeError):
+        raise ValueError("Invalid cursor.")
+
+def parse_listing_args(args):
+    """Validates limit/cursor/fields query arguments; raises ValueError on bad input."""
+    try:
+        limit = int(args.get('limit', DEFAULT_LISTING_LIMIT))
+    except ValueError:
+        raise ValueError("limit must be an integer.")
+    if not 1 <= limit <= MAX_LISTING_LIMIT:
+        raise ValueError(f"limit must be between 1 and {MAX_LISTING_LIMIT}.")
+
+    cursor = args.get('cursor')
+    after = decode_listing_cursor(cursor) if cursor else None
+
+    fields = DEFAULT_LISTING_FIELDS
+    if args.get('fields'):
+        fields = [f.strip() for f in args['fields'].split(',') if f.strip()]
+        unknown = [f for f in fields if f not in LISTING_FIELDS]
+        if unknown:
+            raise ValueError(f"Unknown fields: {', '.join(unknown)}. Must be among {sorted(LISTING_FIELDS)}.")
+        # The cursor is built from these, so they are always returned
+        fields = ['diagram_id', 'updated_at'] + [f for f in fields if f not in ('diagram_id', 'updated_at')]
+    return limit, after, fields
+
 
 @diagrams_bp.route('/projects/<int:project_id>/diagrams', methods=['POST'])
 @login_required
@@ -57,6 +136,8 @@ def create_diagram(project_id):
         # or a dict if it handles dict-to-JSONB conversion (psycopg2 does for jsonb)
         import json
         diagram = db_ops._execute(query, (diagram_name, project_id, json.dumps(diagram_data)), fetchone=True, commit=True)
+        project_listing.bump_projects([project_id]) # Diagram count changed
+        revisions.record_quietly(diagram['diagram_id'], diagram_data, user_id)
         return jsonify(diagram), 201
     except PermissionError as e:
         # Distinguish between auth error and project access error
@@ -67,6 +148,7 @@ def create_diagram(project_id):
         else: # Other permission errors (access denied to project)
             return jsonify(error=str(e)), 403
     except Exception as e:
+        log.exception("Failed to create diagram")
         return jsonify(error=f"Failed to create diagram: {str(e)}"), 500
 
 @diagrams_bp.route('/projects/<int:project_id>/diagrams', methods=['GET'])
@@ -74,11 +156,52 @@ def create_diagram(project_id):
 def get_diagrams_for_project(project_id):
     try:
         user_id = db_ops._get_user_id_from_session(session)
-        check_project_access(project_id, user_id) # Must have at least view rights
 
-        query = "SELECT * FROM diagrams WHERE project_id = %s;"
-        diagrams = db_ops._execute(query, (project_id,), fetchall=True)
-        return jsonify(diagrams), 200
+        # ?limit=, ?cursor= or ?fields= switch to the paginated metadata listing
+        if any(arg in request.args for arg in ('limit', 'cursor', 'fields')):
+            return list_diagrams_page(project_id, user_id)
+
+        params = {'user_id': user_id, 'project_id': project_id}
+        # The listing's ETag covers which diagrams it holds and their versions. It carries no
+        # Last-Modified: a deletion changes the listing without making anything newer.
+        if http_cache.has_validators():
+            # Conditional request: versions only, diagram_data is not read
+            query = f"""
+                SELECT {ACCESS_COLUMNS}, d.diagram_id, d.updated_at
+                FROM projects p
+                LEFT JOIN sharing_permissions sp ON sp.project_id = p.project_id AND sp.user_id = %(user_id)s
+                LEFT JOIN diagrams d ON d.project_id = p.project_id AND {CAN_VIEW_SQL}
+                WHERE p.project_id = %(project_id)s
+                ORDER BY d.diagram_id;
+            """
+            rows = db_ops._execute(query, params, fetchall=True)
+            if not rows:
+                raise PermissionError("Project not found.")
+            owner_id, permission_level, _ = split_access(rows[0])
+            evaluate_access(owner_id, permission_level, user_id)
+            etag = http_cache.version_etag(*(row for row in rows if row['diagram_id'] is not None))
+            if http_cache.is_fresh(etag):
+                return http_cache.not_modified(etag)
+
+        # Access check and listing in one statement. Diagrams are only joined in when the
+        # user may view them, so a forbidden request never ships diagram data.
+        query = f"""
+            SELECT {ACCESS_COLUMNS}, {diagram_columns('d')}
+            FROM projects p
+            LEFT JOIN sharing_permissions sp ON sp.project_id = p.project_id AND sp.user_id = %(user_id)s
+            LEFT JOIN diagrams d ON d.project_id = p.project_id AND {CAN_VIEW_SQL}
+            WHERE p.project_id = %(project_id)s
+            ORDER BY d.diagram_id;
+        """
+        rows = db_ops._execute(query, params, fetchall=True)
+        if not rows:
+            raise PermissionError("Project not found.")
+
+        owner_id, permission_level, _ = split_access(rows[0])
+        evaluate_access(owner_id, permission_level, user_id) # Must have at least view rights
+
+        diagrams = [split_access(row)[2] for row in rows if row['diagram_id'] is not None]
+        return http_cache.conditional_json(diagrams, http_cache.version_etag(*diagrams))
     except PermissionError as e:
         if "User not authenticated" in str(e) or "invalid session" in str(e):
              return jsonify(error=str(e)), 401
@@ -87,25 +210,101 @@ def get_diagrams_for_project(project_id):
         else:
             return jsonify(error=str(e)), 403
     except Exception as e:
+        log.exception("Failed to retrieve diagrams")
         return jsonify(error=f"Failed to retrieve diagrams: {str(e)}"), 500
 
+def list_diagrams_page(project_id, user_id):
+    """
+    One page of a project's diagrams, newest first, without diagram_data unless requested.
+    Responds with {"diagrams": [...], "next_cursor": <str or null>}.
+    """
+    try:
+        limit, after, fields = parse_listing_args(request.args)
+    except ValueError as e:
+        return jsonify(error=str(e)), 400
+
+    params = {'user_id': user_id, 'project_id': project_id, 'limit': limit + 1}
+    keyset_condition = ""
+    if after:
+        keyset_condition = "AND (d.updated_at, d.diagram_id) < (%(after_updated_at)s, %(after_diagram_id)s)"
+        params['after_updated_at'], params['after_diagram_id'] = after
+
+    # Access check and page in one statement. The LATERAL subquery walks
+    # idx_diagrams_project_updated and is only joined in when the user may view the project.
+    # One extra row is fetched to know whether another page follows.
+    query = f"""
+        SELECT {ACCESS_COLUMNS}, page.*
+        FROM projects p
+        LEFT JOIN sharing_permissions sp ON sp.project_id = p.project_id AND sp.user_id = %(user_id)s
+        LEFT JOIN LATERAL (
+            SELECT {', '.join(LISTING_FIELDS[f] for f in fields)}
+            FROM diagrams d
+            WHERE d.project_id = p.project_id {keyset_condition}
+            ORDER BY d.updated_at DESC, d.diagram_id DESC
+            LIMIT %(limit)s
+        ) page ON {CAN_VIEW_SQL}
+        WHERE p.project_id = %(project_id)s
+        ORDER BY page.updated_at DESC, page.diagram_id DESC;
+    """
+    rows = db_ops._execute(query, params, fetchall=True)
+    if not rows:
+        raise PermissionError("Project not found.")
+
+    owner_id, permission_level, _ = split_access(rows[0])
+    evaluate_access(owner_id, permission_level, user_id) # Must have at least view rights
+
+    diagrams = [split_access(row)[2] for row in rows if row['diagram_id'] is not None]
+    next_cursor = None
+    if len(diagrams) > limit:
+        diagrams = diagrams[:limit]
+        next_cursor = encode_listing_cursor(diagrams[-1])
+    return jsonify(diagrams=diagrams, next_cursor=next_cursor), 200
+
+# get_diagram()'s two statements run on every open and every conditional poll, so they are prepared.
+# Access and version only, without reading diagram_data, for conditional requests
+DIAGRAM_VERSION_QUERY = PreparedQuery('diagram_version', f"""
+    SELECT {ACCESS_COLUMNS}, d.diagram_id, d.updated_at
+    FROM diagrams d
+    JOIN projects p ON p.project_id = d.project_id
+    LEFT JOIN sharing_permissions sp ON sp.project_id = d.project_id AND sp.user_id = %(user_id)s
+    WHERE d.diagram_id = %(diagram_id)s;
+""")
+# Lookup, access check and fetch in a single statement. The diagram's columns are
+# joined in a second time only when the user may view it.
+DIAGRAM_QUERY = PreparedQuery('diagram', f"""
+    SELECT {ACCESS_COLUMNS}, {diagram_columns('visible')}
+    FROM diagrams d
+    JOIN projects p ON p.project_id = d.project_id
+    LEFT JOIN sharing_permissions sp ON sp.project_id = d.project_id AND sp.user_id = %(user_id)s
+    LEFT JOIN diagrams visible ON visible.diagram_id = d.diagram_id AND {CAN_VIEW_SQL}
+    WHERE d.diagram_id = %(diagram_id)s;
+""")
+
 @diagrams_bp.route('/diagrams/<int:diagram_id>', methods=['GET'])
 @login_required
 def get_diagram(diagram_id):
     try:
         user_id = db_ops._get_user_id_from_session(session)
-        
-        # Get project_id from diagram, then check project access
-        diagram_info = db_ops._execute("SELECT project_id FROM diagrams WHERE diagram_id = %s", (diagram_id,), fetchone=True)
-        if not diagram_info:
+        params = {'user_id': user_id, 'diagram_id': diagram_id}
+
+        if http_cache.has_validators():
+            # Conditional request: check access and version first, without reading diagram_data
+            row = db_ops._execute(DIAGRAM_VERSION_QUERY, params, fetchone=True)
+            if not row:
+                return jsonify(error="Diagram not found."), 404
+            owner_id, permission_level, version = split_access(row)
+            evaluate_access(owner_id, permission_level, user_id)
+            etag = http_cache.version_etag(version)
+            if http_cache.is_fresh(etag, version['updated_at']):
+                return http_cache.not_modified(etag, version['updated_at'])
+
+        row = db_ops._execute(DIAGRAM_QUERY, params, fetchone=True)
+        if not row:
             return jsonify(error="Diagram not found."), 404
-        
-        project_id = diagram_info['project_id']
-        check_project_access(project_id, user_id) # Check view access for the parent project
 
-        diagram = db_ops._execute("SELECT * FROM diagrams WHERE diagram_id = %s", (diagram_id,), fetchone=True)
-        # Already checked if diagram exists, so this should always return data
-        return jsonify(diagram), 200
+        owner_id, permission_level, diagram = split_access(row)
+        evaluate_access(owner_id, permission_level, user_id) # Check view access for the parent project
+        return http_cache.conditional_json(diagram, http_cache.version_etag(diagram), diagram['updated_at'])
     except PermissionError as e: # Catches session errors and access errors
         if "User not authenticated" in str(e) or "invalid session" in str(e):
              return jsonify(error=str(e)), 401
@@ -114,6 +313,7 @@ def get_diagram(diagram_id):
         else: # Other permission errors (access denied to project)
             return jsonify(error=str(e)), 403
     except Exception as e:
+        log.exception("Failed to retrieve diagram")
         return jsonify(error=f"Failed to retrieve diagram: {str(e)}"), 500
 
 @diagrams_bp.route('/diagrams/<int:diagram_id>', methods=['PUT'])
@@ -132,35 +332,62 @@ def update_diagram(diagram_id):
     try:
         user_id = db_ops._get_user_id_from_session(session)
 
-        # Get project_id from diagram, then check project access with edit rights
-        diagram_info = db_ops._execute("SELECT project_id FROM diagrams WHERE diagram_id = %s", (diagram_id,), fetchone=True)
-        if not diagram_info:
-            return jsonify(error="Diagram not found."), 404
-        
-        project_id = diagram_info['project_id']
-        check_project_access(project_id, user_id, require_edit=True)
-
         # Build query dynamically based on what's provided
         fields_to_update = []
-        params = []
+        params = {'user_id': user_id, 'diagram_id': diagram_id}
         if diagram_name:
-            fields_to_update.append("diagram_name = %s")
-            params.append(diagram_name)
+            fields_to_update.append("diagram_name = %(diagram_name)s")
+            params['diagram_name'] = diagram_name
         if diagram_data is not None:
-            fields_to_update.append("diagram_data = %s::jsonb")
+            # A REST save supersedes whatever the live room last flushed; rooms.sequence_saved()
+            # below hands it to the room if there is one, otherwise rooms pick it up on load
+            fields_to_update.append("diagram_data = %(diagram_data)s::jsonb, live_revision = NULL")
             import json
-            params.append(json.dumps(diagram_data))
+            params['diagram_data'] = json.dumps(diagram_data)
         
         if not fields_to_update: # Should be caught by earlier check, but as a safeguard
             return jsonify(error="No valid fields to update."), 400
 
-        params.append(diagram_id) # For WHERE clause
+        # Lookup, edit-permission check and UPDATE in one statement: the UPDATE only touches
+        # the row when the permission predicate holds, and the caller's access comes back
+        # with it so a refusal can be told apart from a missing diagram. The diagram row is
+        # locked by the lookup, so a concurrent move can't slip in between check and write
+        # (a move that commits first makes the row drop out of the join instead). NO KEY
+        # UPDATE is enough for that, and unlike FOR UPDATE it doesn't block the foreign-key
+        # checks of live edits inserting into diagram_ops: sequence_saved() below waits on
+        # those, so the two would deadlock.
         query = f"""
-            UPDATE diagrams SET {', '.join(fields_to_update)}, updated_at = CURRENT_TIMESTAMP
-            WHERE diagram_id = %s
-            RETURNING *;
+            WITH target AS (
+                SELECT d.diagram_id, {ACCESS_COLUMNS}, {CAN_EDIT_SQL} AS can_edit
+                FROM diagrams d
+                JOIN projects p ON p.project_id = d.project_id
+                LEFT JOIN sharing_permissions sp ON sp.project_id = d.project_id AND sp.user_id = %(user_id)s
+                WHERE d.diagram_id = %(diagram_id)s
+                FOR NO KEY UPDATE OF d
+            ), updated AS (
+                UPDATE diagrams SET {', '.join(fields_to_update)}, updated_at = CURRENT_TIMESTAMP
+                FROM target t
+                WHERE diagrams.diagram_id = t.diagram_id AND t.can_edit
+                RETURNING {diagram_columns('diagrams')}
+            )
+            SELECT t.access_owner_id, t.access_permission_level, u.*
+            FROM target t
+            LEFT JOIN updated u ON u.diagram_id = t.diagram_id;
         """
-        updated_diagram = db_ops._execute(query, tuple(params), fetchone=True, commit=True)
+        with db_ops.unit_of_work():
+            row = db_ops._execute(query, params, fetchone=True, commit=True)
+            if not row:
+                return jsonify(error="Diagram not found."), 404
+
+            owner_id, permission_level, updated_diagram = split_access(row)
+            evaluate_access(owner_id, permission_level, user_id, require_edit=True)
+            if updated_diagram['diagram_id'] is None: # Deleted concurrently
+                return jsonify(error="Diagram not found."), 404
+            if diagram_data is not None:
+                # Sequenced into the live room, if any, before the save commits
+                updated_diagram.update(rooms.sequence_saved([diagram_id]).get(diagram_id, {}))
+        if diagram_data is not None:
+            revisions.record_quietly(diagram_id, updated_diagram['diagram_data'], user_id)
         return jsonify(updated_diagram), 200
     except PermissionError as e:
         if "User not authenticated" in str(e) or "invalid session" in str(e):
@@ -169,7 +396,10 @@ def update_diagram(diagram_id):
             return jsonify(error="Diagram's parent project not found."), 404
         else:
             return jsonify(error=str(e)), 403
+    except rooms.ResyncRequired:
+        return jsonify(error="The diagram is being edited live; reload it and save again."), 409
     except Exception as e:
+        log.exception("Failed to update diagram")
         return jsonify(error=f"Failed to update diagram: {str(e)}"), 500
 
 @diagrams_bp.route('/diagrams/<int:diagram_id>', methods=['DELETE'])
@@ -178,14 +408,33 @@ def delete_diagram(diagram_id):
     try:
         user_id = db_ops._get_user_id_from_session(session)
 
-        diagram_info = db_ops._execute("SELECT project_id FROM diagrams WHERE diagram_id = %s", (diagram_id,), fetchone=True)
-        if not diagram_info:
+        # Same single-statement pattern (and row lock) as update_diagram
+        query = f"""
+            WITH target AS (
+                SELECT d.diagram_id, d.project_id, {ACCESS_COLUMNS}, {CAN_EDIT_SQL} AS can_edit
+                FROM diagrams d
+                JOIN projects p ON p.project_id = d.project_id
+                LEFT JOIN sharing_permissions sp ON sp.project_id = d.project_id AND sp.user_id = %(user_id)s
+                WHERE d.diagram_id = %(diagram_id)s
+                FOR UPDATE OF d
+            ), deleted AS (
+                DELETE FROM diagrams USING target t
+                WHERE diagrams.diagram_id = t.diagram_id AND t.can_edit
+                RETURNING diagrams.diagram_id
+            )
+            SELECT t.access_owner_id, t.access_permission_level, t.project_id, x.diagram_id AS deleted_id
+            FROM target t
+            LEFT JOIN deleted x ON x.diagram_id = t.diagram_id;
+        """
+        row = db_ops._execute(query, {'user_id': user_id, 'diagram_id': diagram_id}, fetchone=True, commit=True)
+        if not row:
             return jsonify(error="Diagram not found."), 404
-        
-        project_id = diagram_info['project_id']
-        check_project_access(project_id, user_id, require_edit=True) # Must have edit rights to delete
 
-        db_ops._execute("DELETE FROM diagrams WHERE diagram_id = %s", (diagram_id,), commit=True)
+        owner_id, permission_level, result = split_access(row)
+        evaluate_access(owner_id, permission_level, user_id, require_edit=True) # Must have edit rights to delete
+        if result['deleted_id'] is None: # Deleted concurrently
+            return jsonify(error="Diagram not found."), 404
+        project_listing.bump_projects([result['project_id']]) # Diagram count changed
         return jsonify(message="Diagram deleted successfully."), 200
     except PermissionError as e:
         if "User not authenticated" in str(e) or "invalid session" in str(e):
@@ -195,4 +444,229 @@ def delete_diagram(diagram_id):
         else:
             return jsonify(error=str(e)), 403
     except Exception as e:
+        log.exception("Failed to delete diagram")
         return jsonify(error=f"Failed to delete diagram: {str(e)}"), 500
+
+MAX_BATCH_OPERATIONS = 500
+BATCH_OPS = ('create', 'update', 'move', 'delete')
+
+def _int_field(operation, name):
+    value = operation.get(name)
+    if isinstance(value, bool) or not isinstance(value, int):
+        raise ValueError(f"{name} must be an integer.")
+    return value
+
+def parse_batch_operation(operation):
+    """Validates one batch item; returns it normalised or raises ValueError."""
+    if not isinstance(operation, dict) or operation.get('op') not in BATCH_OPS:
+        raise ValueError(f"op must be one of {', '.join(BATCH_OPS)}.")
+    op = operation['op']
+    if op == 'create':
+        if not operation.get('diagram_name'):
+            raise ValueError("Diagram name is required.")
+        return {'op': op, 'project_id': _int_field(operation, 'project_id'),
+                'diagram_name': operation['diagram_name'],
+                'diagram_data': operation.get('diagram_data', {})}
+    parsed = {'op': op, 'diagram_id': _int_field(operation, 'diagram_id')}
+    if op == 'update':
+        if not operation.get('diagram_name') and operation.get('diagram_data') is None:
+            raise ValueError("Diagram name or data is required for update.")
+        parsed['diagram_name'] = operation.get('diagram_name') or None
+        parsed['diagram_data'] = operation.get('diagram_data')
+    elif op == 'move':
+        parsed['project_id'] = _int_field(operation, 'project_id')
+    return parsed
+
+def _batch_error(status, message):
+    return {'status': status, 'error': message}
+
+@diagrams_bp.route('/diagrams/batch', methods=['POST'])
+@login_required
+def batch_diagrams():
+    """
+    Applies many diagram operations in one transaction. Body:
+        {"operations": [{"op": "create", "project_id", "diagram_name", "diagram_data"?},
+                        {"op": "update", "diagram_id", "diagram_name"?, "diagram_data"?},
+                        {"op": "move", "diagram_id", "project_id"},
+                        {"op": "delete", "diagram_id"}]}
+    Either every operation is applied or none is. Responds with {"results": [...]} in
+    request order, each item carrying its own status (and error, if the batch was rejected).
+    """
+    data = request.get_json(silent=True)
+    operations = data.get('operations') if isinstance(data, dict) else None
+    if not isinstance(operations, list) or not operations:
+        return jsonify(error="A non-empty list of operations is required."), 400
+    if len(operations) > MAX_BATCH_OPERATIONS:
+        return jsonify(error=f"At most {MAX_BATCH_OPERATIONS} operations per batch."), 400
+
+    parsed, results = [], [None] * len(operations)
+    seen_diagrams = set()
+    for index, operation in enumerate(operations):
+        try:
+            item = parse_batch_operation(operation)
+        except ValueError as e:
+            results[index] = _batch_error(400, str(e))
+            parsed.append(None)
+            continue
+        # Ops on the same diagram would depend on each other's order; keep them to separate batches
+        if 'diagram_id' in item:
+            if item['diagram_id'] in seen_diagrams:
+                results[index] = _batch_error(400, "Diagram appears more than once in the batch.")
+            seen_diagrams.add(item['diagram_id'])
+        parsed.append(item)
+
+    try:
+        user_id = db_ops._get_user_id_from_session(session)
+        with db_ops.unit_of_work():
+            # Lock the targets so their project can't change between the check and the writes.
+            # Only deletes need FOR UPDATE: it would block the foreign-key checks of live edits
+            # inserting into diagram_ops, which sequence_saved() waits on for updated diagrams.
+            current = {}
+            deleted_ids = {item['diagram_id'] for item in parsed if item and item['op'] == 'delete'}
+            for lock_mode, diagram_ids in (('FOR NO KEY UPDATE', seen_diagrams - deleted_ids), ('FOR UPDATE', deleted_ids)):
+                if diagram_ids:
+                    rows = db_ops._execute(
+                        f"SELECT diagram_id, project_id FROM diagrams WHERE diagram_id = ANY(%s) {lock_mode};",
+                        (list(diagram_ids),), fetchall=True
+                    )
+                    current.update((row['diagram_id'], row['project_id']) for row in rows)
+
+            # One access check per distinct project: sources and destinations alike
+            project_ids = set(current.values())
+            project_ids.update(item['project_id'] for item in parsed if item and 'project_id' in item)
+            access = {}
+            if project_ids:
+                rows = db_ops._execute(
+                    """
+                    SELECT p.project_id, p.user_id AS owner_id, sp.permission_level
+                    FROM projects p
+                    LEFT JOIN sharing_permissions sp ON sp.project_id = p.project_id AND sp.user_id = %s
+                    WHERE p.project_id = ANY(%s);
+                    """,
+                    (user_id, list(project_ids)), fetchall=True
+                )
+                for row in rows:
+                    try:
+                        access[row['project_id']] = evaluate_access(row['owner_id'], row['permission_level'], user_id, require_edit=True)
+                    except PermissionError as e:
+                        access[row['project_id']] = e
+
+            def project_error(project_id):
+                if project_id not in access:
+                    return _batch_error(404, "Project not found.")
+                if isinstance(access[project_id], PermissionError):
+                    return _batch_error(403, str(access[project_id]))
+                return None
+
+            for index, item in enumerate(parsed):
+                if results[index] is not None:
+                    continue
+                if 'diagram_id' in item and item['diagram_id'] not in current:
+                    results[index] = _batch_error(404, "Diagram not found.")
+                    continue
+                if 'diagram_id' in item:
+                    results[index] = project_error(current[item['diagram_id']])
+                if results[index] is None and 'project_id' in item:
+                    results[index] = project_error(item['project_id'])
+
+            failed = [result for result in results if result is not None]
+            if failed:
+                # Nothing has been written yet; report every item and leave the batch unapplied
+                for index, item in enumerate(parsed):
+                    if results[index] is None:
+                        results[index] = {'status': 424, 'error': "Not applied: another operation in the batch failed."}
+                for index, result in enumerate(results):
+                    result.update(index=index, op=parsed[index]['op'] if parsed[index] else None)
+                status = failed[0]['status'] if all(r['status'] == failed[0]['status'] for r in failed) else 400
+                return jsonify(error="Batch rejected; no changes were made.", results=results), status
+
+            creates = [(i, item) for i, item in enumerate(parsed) if item['op'] == 'create']
+            updates = [(i, item) for i, item in enumerate(parsed) if item['op'] == 'update']
+            moves = [(i, item) for i, item in enumerate(parsed) if item['op'] == 'move']
+            deletes = [(i, item) for i, item in enumerate(parsed) if item['op'] == 'delete']
+
+            if creates:
+                # Multi-row INSERT ... RETURNING yields rows in VALUES order
+                created = execute_values_query(
+                    """
+                    INSERT INTO diagrams (diagram_name, project_id, diagram_data)
+                    VALUES %s
+                    RETURNING diagram_id, diagram_name, project_id, created_at, updated_at;
+                    """,
+                    [(item['diagram_name'], item['project_id'], json.dumps(item['diagram_data'])) for _, item in creates],
+                    template="(%s, %s, %s::jsonb)", page_size=len(creates), fetch=True
+                )
+                for (index, _), diagram in zip(creates, created):
+                    results[index] = {'status': 201, 'diagram': diagram}
+
+            if updates:
+                updated = execute_values_query(
+                    f"""
+                    UPDATE diagrams d SET
+                        diagram_name = COALESCE(v.diagram_name, d.diagram_name),
+                        diagram_data = CASE WHEN v.has_data THEN v.diagram_data ELSE d.diagram_data END,
+                        live_revision = CASE WHEN v.has_data THEN NULL ELSE d.live_revision END,
+                        updated_at = CURRENT_TIMESTAMP
+                    FROM (VALUES %s) AS v(diagram_id, diagram_name, has_data, diagram_data)
+                    WHERE d.diagram_id = v.diagram_id
+                    RETURNING {diagram_columns('d')};
+                    """,
+                    [(item['diagram_id'], item['diagram_name'], item['diagram_data'] is not None,
+                      json.dumps(item['diagram_data']) if item['diagram_data'] is not None else None)
+                     for _, item in updates],
+                    template="(%s::int, %s::text, %s::boolean, %s::jsonb)", page_size=len(updates), fetch=True
+                )
+                by_id = {diagram['diagram_id']: diagram for diagram in updated}
+                # New code reaches live rooms as an edit; the rows then store what the rooms hold
+                sequenced = rooms.sequence_saved([item['diagram_id'] for _, item in updates if item['diagram_data'] is not None])
+                for diagram_id, stored in sequenced.items():
+                    by_id[diagram_id].update(stored)
+                for index, item in updates:
+                    results[index] = {'status': 200, 'diagram': by_id[item['diagram_id']]}
+
+            if moves:
+                moved = execute_values_query(
+                    """
+                    UPDATE diagrams d SET project_id = v.project_id, updated_at = CURRENT_TIMESTAMP
+                    FROM (VALUES %s) AS v(diagram_id, project_id)
+                    WHERE d.diagram_id = v.diagram_id
+                    RETURNING d.diagram_id, d.diagram_name, d.project_id, d.created_at, d.updated_at;
+                    """,
+                    [(item['diagram_id'], item['project_id']) for _, item in moves],
+                    template="(%s::int, %s::int)", page_size=len(moves), fetch=True
+                )
+                by_id = {diagram['diagram_id']: diagram for diagram in moved}
+                for index, item in moves:
+                    results[index] = {'status': 200, 'diagram': by_id[item['diagram_id']]}
+
+            if deletes:
+                db_ops._execute("DELETE FROM diagrams WHERE diagram_id = ANY(%s);",
+                                ([item['diagram_id'] for _, item in deletes],))
+                for index, item in deletes:
+                    results[index] = {'status': 200, 'diagram_id': item['diagram_id']}
+
+            # Projects whose diagram counts changed; commits with the batch
+            counted = {item['project_id'] for _, item in creates + moves}
+            counted.update(current[item['diagram_id']] for _, item in moves + deletes)
+            project_listing.bump_projects(counted)
+
+        # History is recorded once the batch is committed, like the single-item endpoints
+        try:
+            revisions.record_many(
+                [(results[i]['diagram']['diagram_id'], item['diagram_data']) for i, item in creates]
+                + [(results[i]['diagram']['diagram_id'], results[i]['diagram']['diagram_data'])
+                   for i, item in updates if item['diagram_data'] is not None],
+                user_id
+            )
+        except Exception:
+            log.exception("Error recording revisions for diagram batch")
+        for index, result in enumerate(results):
+            result.update(index=index, op=parsed[index]['op'])
+        return jsonify(results=results), 200
+    except PermissionError as e:
+        return jsonify(error=str(e)), 401
+    except rooms.ResyncRequired:
+        return jsonify(error="A diagram in the batch is being edited live; reload it and retry. No changes were made."), 409
+    except Exception as e:
+        log.exception("Failed to apply diagram batch")
+        return jsonify(error=f"Failed to apply diagram batch: {str(e)}"), 500
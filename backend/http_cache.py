@@ -0,0 +1,73 @@
+import json
+import hashlib
+
+from flask import request, jsonify, make_response
+
+# Responses may be stored by the browser but must be revalidated on every use, and never
+# by shared caches since they depend on the session.
+CACHE_CONTROL = "private, no-cache"
+
+
+def version_etag(*rows, key=('diagram_id', 'updated_at')):
+    """
+    Weak ETag from the identity and modification time of `rows` (dicts), e.g. for a diagram
+    or a listing. Cheap to compute from metadata alone, so it can be checked before the
+    rows' payload is loaded.
+    """
+    digest = hashlib.sha1()
+    for row in rows:
+        digest.update("|".join(str(row[k]) for k in key).encode('utf-8'))
+        digest.update(b"\n")
+    return digest.hexdigest(), True
+
+
+def content_etag(payload):
+    """Strong ETag from the JSON-serialisable `payload` itself, for data without timestamps."""
+    body = json.dumps(payload, sort_keys=True, default=str).encode('utf-8')
+    return hashlib.sha1(body).hexdigest(), False
+
+
+def last_modified_of(rows, field='updated_at'):
+    """Newest `field` among `rows`, or None."""
+    stamps = [row[field] for row in rows if row.get(field) is not None]
+    return max(stamps) if stamps else None
+
+
+def is_fresh(etag, last_modified=None):
+    """
+    True if the client's cached copy is current: If-None-Match matches `etag` (weak
+    comparison), or, only when no If-None-Match was sent, If-Modified-Since is not older
+    than `last_modified`.
+    """
+    value, _ = etag
+    if request.if_none_match:
+        return request.if_none_match.contains_weak(value)
+    if request.if_modified_since and last_modified is not None:
+        return last_modified.replace(microsecond=0) <= request.if_modified_since
+    return False
+
+
+def has_validators():
+    """True if the request is conditional, i.e. worth a metadata-only lookup first."""
+    return bool(request.if_none_match or request.if_modified_since)
+
+
+def _add_validators(response, etag, last_modified):
+    value, weak = etag
+    response.set_etag(value, weak=weak)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    response.headers['Cache-Control'] = CACHE_CONTROL
+    return response
+
+
+def not_modified(etag, last_modified=None):
+    """Empty 304 carrying the validators."""
+    return _add_validators(make_response('', 304), etag, last_modified)
+
+
+def conditional_json(payload, etag, last_modified=None, status=200):
+    """jsonify(payload) with ETag/Last-Modified, or a 304 if the client already has it."""
+    if is_fresh(etag, last_modified):
+        return not_modified(etag, last_modified)
+    return _add_validators(make_response(jsonify(payload), status), etag, last_modified)
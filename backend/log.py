@@ -0,0 +1,208 @@
+"""
+Structured logging for the backend.
+
+    log = get_logger(__name__)
+    log.info("Client connected", diagram_id=diagram_id)
+    log.debug("Frame received", sample=LOG_SAMPLE_RATE, payload=message)
+
+Every call returns right away. A record is dropped before any work is done if its level
+is disabled or it is sampled out. Otherwise it is put on a bounded in-memory queue, and a
+background OS thread formats it (one JSON object per line, or text with LOG_FORMAT=text)
+and writes it to stdout. Formatting includes truncating long fields to
+LOG_MAX_FIELD_CHARS. The cost on the caller's greenlet therefore doesn't depend on the
+payload size or on how fast stdout drains. When the queue is full, records are dropped
+and counted rather than waited for.
+"""
+import os
+import sys
+import json
+import time
+import atexit
+import random
+import logging
+import threading
+from collections import deque
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler
+
+from flask import has_request_context, request
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")  # json or text
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+LOG_MAX_FIELD_CHARS = int(os.getenv("LOG_MAX_FIELD_CHARS", "200"))
+LOG_SAMPLE_RATE = float(os.getenv("LOG_SAMPLE_RATE", "0.01"))  # Share of high-frequency events kept
+
+ROOT_LOGGER = "backend"
+
+_stats = {'dropped': 0, 'sampled_out': 0}
+
+
+def _truncate(value, limit):
+    if isinstance(value, (int, float, bool, type(None))):
+        return value
+    text = value if isinstance(value, str) else repr(value)
+    if len(text) > limit:
+        return f"{text[:limit]}...(+{len(text) - limit} chars)"
+    return text
+
+
+class StructuredFormatter(logging.Formatter):
+    """Formats a record and its fields as JSON or as `key=value` text, truncating long values."""
+    def __init__(self, style='json'):
+        super().__init__()
+        self.style = style
+
+    def format(self, record):
+        entry = {
+            'ts': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname.lower(),
+            'logger': record.name,
+            'msg': record.getMessage(),
+        }
+        limit = getattr(record, 'field_limit', None) or LOG_MAX_FIELD_CHARS
+        for key, value in getattr(record, 'fields', {}).items():
+            entry[key] = _truncate(value, limit)
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        if self.style == 'text':
+            extra = " ".join(f"{k}={v}" for k, v in entry.items() if k not in ('ts', 'level', 'logger', 'msg', 'exc'))
+            line = f"{entry['ts']} {record.levelname} {record.name}: {entry['msg']}" + (f" {extra}" if extra else "")
+            return line + (f"\n{entry['exc']}" if 'exc' in entry else "")
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class _BoundedQueue:
+    """
+    Queue between the app and the writer thread. deque appends and pops are atomic, so
+    neither side takes a lock that gevent would have to schedule around.
+    """
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.items = deque()
+
+    def put_nowait(self, record):
+        if len(self.items) >= self.maxsize:
+            _stats['dropped'] += 1
+            return
+        self.items.append(record)
+
+
+class AsyncHandler(QueueHandler):
+    """QueueHandler that hands records over unformatted and starts its writer per process."""
+    def __init__(self, target, maxsize=LOG_QUEUE_SIZE):
+        super().__init__(_BoundedQueue(maxsize))
+        self.target = target
+        self._writer_pid = None
+
+    def prepare(self, record):
+        return record  # Formatting happens on the writer thread
+
+    def enqueue(self, record):
+        if self._writer_pid != os.getpid():
+            self._start_writer()
+        self.queue.put_nowait(record)
+
+    def _start_writer(self):
+        self._writer_pid = os.getpid()
+        # A real OS thread even under gevent, so blocking writes to stdout never stall the hub
+        # (the original threading.Thread isn't enough: it still starts through the patched _thread)
+        try:
+            from gevent import monkey
+            if monkey.is_module_patched('threading'):
+                start_new_thread = monkey.get_original('_thread', 'start_new_thread')
+                start_new_thread(self._run, (monkey.get_original('time', 'sleep'),))
+                return
+        except ImportError:
+            pass
+        threading.Thread(target=self._run, args=(time.sleep,), name="log-writer", daemon=True).start()
+
+    def _run(self, sleep):
+        while True:
+            if not self.drain():
+                sleep(0.05)
+
+    def drain(self):
+        """Writes out everything queued so far; returns how many records were written."""
+        items, written = self.queue.items, 0
+        while items:
+            try:
+                record = items.popleft()
+            except IndexError:
+                break
+            try:
+                self.target.handle(record)
+            except Exception:
+                pass  # Never let a bad record kill the writer
+            written += 1
+        if written:
+            self.target.flush()
+        return written
+
+
+class StructuredLogger:
+    """Thin wrapper around a logging.Logger that takes fields as keyword arguments."""
+    def __init__(self, logger):
+        self.logger = logger
+
+    def _log(self, level, msg, fields, sample=None, exc_info=False, limit=None):
+        if not self.logger.isEnabledFor(level):
+            return
+        if sample is not None and sample < 1.0:
+            if random.random() >= sample:
+                _stats['sampled_out'] += 1
+                return
+            fields['sample_rate'] = sample
+        if has_request_context():
+            fields.setdefault('endpoint', request.endpoint)
+            fields.setdefault('method', request.method)
+            fields.setdefault('path', request.path)
+        self.logger.log(level, msg, exc_info=exc_info, extra={'fields': fields, 'field_limit': limit})
+
+    # `sample` keeps that share of calls; `limit` overrides LOG_MAX_FIELD_CHARS for this record
+    def debug(self, msg, sample=None, limit=None, **fields):
+        self._log(logging.DEBUG, msg, fields, sample, limit=limit)
+
+    def info(self, msg, sample=None, limit=None, **fields):
+        self._log(logging.INFO, msg, fields, sample, limit=limit)
+
+    def warning(self, msg, sample=None, limit=None, **fields):
+        self._log(logging.WARNING, msg, fields, sample, limit=limit)
+
+    def error(self, msg, sample=None, limit=None, **fields):
+        self._log(logging.ERROR, msg, fields, sample, limit=limit)
+
+    def exception(self, msg, **fields):
+        """error() with the traceback of the exception being handled."""
+        self._log(logging.ERROR, msg, fields, exc_info=True)
+
+
+_handler = None
+_configure_lock = threading.Lock()
+
+
+def configure():
+    """Attaches the async stdout handler to the backend's loggers (once per process)."""
+    global _handler
+    with _configure_lock:
+        if _handler is not None:
+            return _handler
+        target = logging.StreamHandler(sys.stdout)
+        target.setFormatter(StructuredFormatter(LOG_FORMAT))
+        _handler = AsyncHandler(target)
+        root = logging.getLogger(ROOT_LOGGER)
+        root.setLevel(LOG_LEVEL)
+        root.addHandler(_handler)
+        root.propagate = False
+        atexit.register(_handler.drain)
+        return _handler
+
+
+def get_logger(name):
+    configure()
+    return StructuredLogger(logging.getLogger(name if name.startswith(ROOT_LOGGER) else f"{ROOT_LOGGER}.{name}"))
+
+
+def stats():
+    """Records dropped because the queue was full, and high-frequency records sampled out."""
+    return {'queued': len(_handler.queue.items) if _handler else 0, **_stats}
@@ -0,0 +1,355 @@
+"""
+Prometheus-style metrics, served as text on /metrics.
+
+Each gunicorn worker keeps its own counters and histograms in memory. Every
+METRICS_FLUSH_INTERVAL seconds it writes a snapshot to METRICS_DIR, and /metrics merges
+the snapshots of every worker, so the answer doesn't depend on which worker serves the
+scrape. The merge sums counters and histograms, including those of workers that have
+since exited, so totals don't go backwards when a worker is recycled: an exited worker's
+snapshot is folded into retired.json, which is kept for good. Snapshots are named by pid
+and process start time, so a new worker that reuses a pid doesn't overwrite the old one's.
+Gauges are summed over live workers only. Rates such as messages broadcast per second are left to PromQL, e.g.
+rate(mermaid_socket_messages_sent_total[1m]).
+
+Updates take one short lock. Under gevent the lock is greenlet-aware and almost never
+contended, since greenlets only switch on I/O.
+"""
+import os
+import json
+import time
+import uuid
+import fcntl
+import bisect
+import tempfile
+import threading
+
+from flask import Response, request
+
+from backend.log import get_logger, stats as log_stats
+
+METRICS_DIR = os.getenv("METRICS_DIR", os.path.join(tempfile.gettempdir(), "mermaid-metrics"))
+METRICS_FLUSH_INTERVAL = float(os.getenv("METRICS_FLUSH_INTERVAL", "5"))
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")  # If set, scrapes must send "Authorization: Bearer <token>"
+
+RETIRED_FILE = "retired.json"  # Counter and histogram totals of exited workers
+
+PREFIX = "mermaid_"
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+log = get_logger(__name__)
+
+_lock = threading.Lock()
+_metrics = {}  # name -> (type, help, buckets)
+_counters = {}  # (name, labels) -> value
+_histograms = {}  # (name, labels) -> [per-bucket counts..., +Inf count, sum]
+_gauges = {}  # name -> callable returning a number or [(labels dict, value)]
+
+
+def describe(name, metric_type, help_text, buckets=None):
+    """Declares a metric; `metric_type` is counter, gauge or histogram."""
+    _metrics[name] = (metric_type, help_text, tuple(buckets) if buckets else None)
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+def inc(name, value=1, **labels):
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def observe(name, value, **labels):
+    buckets = _metrics[name][2]
+    key = _key(name, labels)
+    index = bisect.bisect_left(buckets, value)
+    with _lock:
+        series = _histograms.get(key)
+        if series is None:
+            series = _histograms[key] = [0] * (len(buckets) + 2)
+        series[index] += 1
+        series[-1] += value
+
+
+def register_gauge(name, help_text, read, metric_type='gauge'):
+    """
+    `read()` is called at snapshot time and returns a number or a list of (labels, value).
+    Pass metric_type='counter' to expose a total that another module already keeps.
+    """
+    describe(name, metric_type, help_text)
+    _gauges[name] = read
+
+
+# --- Built-in metrics ---
+
+describe('http_request_duration_seconds', 'histogram', "HTTP request latency by endpoint.", LATENCY_BUCKETS)
+describe('db_query_duration_seconds', 'histogram', "Latency of queries issued through db_utils.", QUERY_BUCKETS)
+describe('db_query_errors_total', 'counter', "Queries that raised a database error.")
+describe('socket_messages_sent_total', 'counter', "WebSocket messages sent to clients.")
+describe('socket_bytes_sent_total', 'counter', "Bytes of WebSocket messages sent to clients.")
+describe('socket_slow_consumers_total', 'counter', "Clients disconnected for falling behind.")
+
+
+def _resident_memory():
+    try:
+        with open('/proc/self/statm') as statm:
+            return [({'pid': str(os.getpid())}, int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE'))]
+    except (OSError, ValueError, IndexError):
+        import resource
+        return [({'pid': str(os.getpid())}, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024)]
+
+register_gauge('process_resident_memory_bytes', "Resident memory of each worker.", _resident_memory)
+register_gauge('log_records_dropped_total', "Log records dropped because the log queue was full.",
+               lambda: log_stats()['dropped'], metric_type='counter')
+register_gauge('log_records_sampled_out_total', "High-frequency log records skipped by sampling.",
+               lambda: log_stats()['sampled_out'], metric_type='counter')
+
+
+# --- Snapshots and aggregation ---
+
+def _process_start(pid):
+    """Start time of process `pid` in clock ticks since boot, or None where /proc isn't available."""
+    try:
+        with open(f'/proc/{pid}/stat') as f:
+            return int(f.read().rsplit(')', 1)[1].split()[19])
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+_identity = None  # (pid, start time, snapshot file name) of this worker
+
+
+def _worker_identity():
+    global _identity
+    if _identity is None or _identity[0] != os.getpid():
+        pid, started = os.getpid(), _process_start(os.getpid())
+        suffix = started if started is not None else uuid.uuid4().hex[:8]
+        _identity = (pid, started, f"worker-{pid}-{suffix}.json")
+    return _identity
+
+
+def snapshot():
+    """This worker's metrics as a JSON-serialisable dict."""
+    gauges = []
+    for name, read in list(_gauges.items()):
+        try:
+            value = read()
+        except Exception:
+            log.exception("Error reading gauge", gauge=name)
+            continue
+        for labels, v in (value if isinstance(value, list) else [({}, value)]):
+            gauges.append([name, labels, v])
+    with _lock:
+        counters = [[name, dict(labels), value] for (name, labels), value in _counters.items()]
+        histograms = [[name, dict(labels), list(series)] for (name, labels), series in _histograms.items()]
+    pid, started, _ = _worker_identity()
+    return {'pid': pid, 'started': started, 'time': time.time(), 'counters': counters,
+            'histograms': histograms, 'gauges': gauges}
+
+
+def _write_json(path, data):
+    temp_path = f"{path}.tmp"
+    with open(temp_path, 'w') as f:
+        json.dump(data, f)
+    os.replace(temp_path, path)  # Readers never see a half-written file
+
+
+def _read_json(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def write_snapshot():
+    os.makedirs(METRICS_DIR, exist_ok=True)
+    _write_json(os.path.join(METRICS_DIR, _worker_identity()[2]), snapshot())
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _alive(data):
+    """Whether the worker that wrote a snapshot still runs, and not just a process with its pid."""
+    if not _pid_alive(data['pid']):
+        return False
+    started = data.get('started')
+    return started is None or _process_start(data['pid']) in (None, started)
+
+
+def _is_counter(name):
+    return _metrics.get(name, ('gauge',))[0] == 'counter'
+
+
+def _retire(file_names):
+    """
+    Folds the counters and histograms of exited workers' snapshots into retired.json and
+    deletes the snapshots. Every worker's scrape may find the same ones, so this runs under
+    a lock, and retired.json lists the files already folded in case a deletion didn't happen.
+    """
+    retired_path = os.path.join(METRICS_DIR, RETIRED_FILE)
+    with open(os.path.join(METRICS_DIR, "retired.lock"), 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        retired = _read_json(retired_path) or {'counters': [], 'histograms': [], 'gauges': [], 'folded': []}
+        folded = {name for name in retired['folded'] if os.path.exists(os.path.join(METRICS_DIR, name))}
+        exited = []
+        for file_name in file_names:
+            data = None if file_name in folded else _read_json(os.path.join(METRICS_DIR, file_name))
+            if data is not None:
+                # Only totals carry over; a dead worker has no connections, rooms or memory
+                data['gauges'] = [row for row in data['gauges'] if _is_counter(row[0])]
+                exited.append(data)
+                folded.add(file_name)
+        if exited:
+            counters, histograms, _ = _merge([retired] + exited)
+            retired = {
+                'counters': [[name, dict(labels), value] for (name, labels), value in counters.items()],
+                'histograms': [[name, dict(labels), series] for (name, labels), series in histograms.items()],
+                'gauges': [], 'folded': sorted(folded),
+            }
+            _write_json(retired_path, retired)
+        for file_name in file_names:
+            try:
+                os.remove(os.path.join(METRICS_DIR, file_name))
+            except OSError:
+                pass
+
+
+def _load_snapshots():
+    """This worker's live snapshot, the latest file of every other live worker, and retired.json."""
+    snapshots = [snapshot()]
+    try:
+        names = os.listdir(METRICS_DIR)
+    except FileNotFoundError:
+        return snapshots
+    exited = []
+    for file_name in names:
+        if not (file_name.startswith("worker-") and file_name.endswith(".json")) or file_name == _worker_identity()[2]:
+            continue
+        data = _read_json(os.path.join(METRICS_DIR, file_name))
+        if data is None:
+            continue
+        if _alive(data):
+            snapshots.append(data)
+        else:
+            exited.append(file_name)
+    if exited:
+        _retire(exited)
+    retired = _read_json(os.path.join(METRICS_DIR, RETIRED_FILE))
+    if retired is not None:
+        snapshots.append(retired)
+    return snapshots
+
+
+def _merge(snapshots):
+    counters, histograms, gauges = {}, {}, {}
+    for data in snapshots:
+        for is_gauge, rows in ((False, data['counters']), (True, data['gauges'])):
+            for name, labels, value in rows:
+                # Totals kept by other modules are read like gauges but add up like counters
+                target = gauges if is_gauge and not _is_counter(name) else counters
+                key = _key(name, labels)
+                target[key] = target.get(key, 0) + value
+        for name, labels, series in data['histograms']:
+            key = _key(name, labels)
+            merged = histograms.get(key)
+            if merged is None or len(merged) != len(series):  # Buckets changed between deploys
+                histograms[key] = list(series)
+            else:
+                histograms[key] = [a + b for a, b in zip(merged, series)]
+    return counters, histograms, gauges
+
+
+def _format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in pairs)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + "}"
+
+
+def render(snapshots=None):
+    """Prometheus text exposition (format 0.0.4) of every worker's metrics."""
+    counters, histograms, gauges = _merge(snapshots if snapshots is not None else _load_snapshots())
+    by_name = {}
+    for series in (counters, gauges, histograms):
+        for (name, labels), value in series.items():
+            by_name.setdefault(name, []).append((labels, value))
+
+    lines = []
+    for name in sorted(by_name):
+        metric_type, help_text, buckets = _metrics.get(name, ('untyped', '', None))
+        full_name = PREFIX + name
+        lines.append(f"# HELP {full_name} {help_text}")
+        lines.append(f"# TYPE {full_name} {metric_type}")
+        for labels, value in sorted(by_name[name], key=lambda item: item[0]):
+            if metric_type != 'histogram':
+                lines.append(f"{full_name}{_format_labels(labels)} {value}")
+                continue
+            bounds = list(buckets or ()) + ["+Inf"]
+            cumulative = 0
+            for bound, count in zip(bounds, value[:-1]):
+                cumulative += count
+                lines.append(f"{full_name}_bucket{_format_labels(labels, [('le', bound)])} {cumulative}")
+            lines.append(f"{full_name}_sum{_format_labels(labels)} {value[-1]}")
+            lines.append(f"{full_name}_count{_format_labels(labels)} {cumulative}")
+    return "\n".join(lines) + "\n"
+
+
+def _run_writer():
+    while True:
+        time.sleep(METRICS_FLUSH_INTERVAL)
+        try:
+            write_snapshot()
+        except Exception:
+            log.exception("Error writing metrics snapshot")
+
+
+_writer_pid = None
+_writer_lock = threading.Lock()
+
+
+def ensure_writer():
+    """Starts this worker's snapshot writer; called on each request and socket connect."""
+    global _writer_pid
+    with _writer_lock:
+        if _writer_pid == os.getpid():
+            return
+        _writer_pid = os.getpid()
+    threading.Thread(target=_run_writer, name="metrics-writer", daemon=True).start()
+
+
+# --- Flask integration ---
+
+def init_app(app):
+    """Times every request and serves /metrics."""
+    @app.before_request
+    def _start_timer():
+        ensure_writer()
+        request.environ['metrics.started_at'] = time.perf_counter()
+
+    @app.after_request
+    def _record_request(response):
+        started_at = request.environ.get('metrics.started_at')
+        if started_at is not None and request.endpoint != 'metrics':
+            # The endpoint name rather than the path keeps label cardinality bounded
+            observe('http_request_duration_seconds', time.perf_counter() - started_at,
+                    endpoint=request.endpoint or 'unmatched', method=request.method,
+                    status=str(response.status_code))
+        return response
+
+    @app.route('/metrics', endpoint='metrics')
+    def metrics_endpoint():
+        if METRICS_TOKEN and request.headers.get('Authorization') != f"Bearer {METRICS_TOKEN}":
+            return Response("Unauthorized\n", status=401, mimetype='text/plain')
+        return Response(render(), mimetype='text/plain; version=0.0.4')
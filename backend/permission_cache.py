@@ -0,0 +1,102 @@
+import os
+import threading
+
+from backend.cache_utils import TTLCache
+from backend.db_utils import execute_query, PreparedQuery
+from backend import pubsub, metrics
+from backend.log import get_logger
+
+PERMISSION_CACHE_TTL = float(os.getenv("PERMISSION_CACHE_TTL", "30"))
+PERMISSION_CACHE_SIZE = int(os.getenv("PERMISSION_CACHE_SIZE", "10000"))
+
+# NOTIFY channel used to keep the caches of all gunicorn workers coherent.
+# Payload is "<project_id>" (whole project) or "<project_id>:<user_id>".
+INVALIDATION_CHANNEL = "permission_invalidation"
+
+log = get_logger(__name__)
+
+# Run on every cache miss, so it is prepared once per connection
+PERMISSION_QUERY = PreparedQuery('project_access', """
+    SELECT p.user_id AS owner_id, sp.permission_level
+    FROM projects p
+    LEFT JOIN sharing_permissions sp ON p.project_id = sp.project_id AND sp.user_id = %s
+    WHERE p.project_id = %s;
+""")
+
+# (user_id, project_id) -> {'owner_id': ..., 'permission_level': ...}
+_cache = TTLCache(maxsize=PERMISSION_CACHE_SIZE, ttl=PERMISSION_CACHE_TTL)
+_subscribed_pid = None
+_subscribe_lock = threading.Lock()
+
+
+def _on_invalidation(payload):
+    if payload is None:  # Listener reconnected and may have missed invalidations
+        _cache.clear()
+        return
+    project_id, _, user_id = payload.partition(':')
+    try:
+        _invalidate_local(int(project_id), int(user_id) if user_id else None)
+    except ValueError:
+        log.warning("Ignoring malformed permission invalidation", payload=payload)
+
+
+def _ensure_subscribed():
+    global _subscribed_pid
+    if _subscribed_pid == os.getpid():
+        return
+    with _subscribe_lock:
+        if _subscribed_pid != os.getpid():
+            pubsub.subscribe(INVALIDATION_CHANNEL, _on_invalidation)
+            _subscribed_pid = os.getpid()
+
+
+def _invalidate_local(project_id, user_id=None):
+    if user_id is None:
+        _cache.pop_where(lambda key: key[1] == project_id)
+    else:
+        _cache.pop((user_id, project_id))
+
+
+def get_project_access(project_id, user_id):
+    """
+    Returns {'owner_id', 'permission_level'} describing `user_id`'s access to the project,
+    or None if the project does not exist. Results are cached per (user_id, project_id);
+    missing projects are not cached.
+    """
+    _ensure_subscribed()
+    key = (user_id, project_id)
+    access = _cache.get(key)
+    if access is not None:
+        return access
+
+    # Always the primary: a lagging replica could hand out (and cache) a revoked share
+    result = execute_query(PERMISSION_QUERY, (user_id, project_id), fetchone=True, primary=True)
+    if not result:
+        return None
+    access = {'owner_id': result['owner_id'], 'permission_level': result['permission_level']}
+    _cache.set(key, access)
+    return access
+
+
+def invalidate(project_id, user_id=None):
+    """
+    Drops cached access for one collaborator of a project, or for everyone on it when
+    `user_id` is None, in this worker and (via NOTIFY) in all the others.
+    Call it after the change that affects access has been written.
+    """
+    _invalidate_local(project_id, user_id)
+    payload = str(project_id) if user_id is None else f"{project_id}:{user_id}"
+    pubsub.publish(INVALIDATION_CHANNEL, payload)
+
+
+def stats():
+    """Hit/miss/eviction counters for the permission cache of this worker."""
+    return _cache.stats()
+
+
+metrics.register_gauge('permission_cache_lookups_total', "Permission cache lookups by result.",
+                       lambda: [({'result': 'hit'}, _cache.hits), ({'result': 'miss'}, _cache.misses)],
+                       metric_type='counter')
+metrics.register_gauge('permission_cache_evictions_total', "Permission cache entries evicted for space.",
+                       lambda: _cache.evictions, metric_type='counter')
+metrics.register_gauge('permission_cache_entries', "Entries in the permission cache.", lambda: stats()['size'])
@@ -0,0 +1,101 @@
+import os
+
+from backend.cache_utils import TTLCache
+from backend.db_utils import execute_query, PreparedQuery
+from backend import metrics
+
+# Per-worker cache of GET /api/projects. Each user has a generation counter in
+# project_listing_generations, shared by every worker: whatever changes what a user's
+# listing shows bumps it, and a cached listing is served only while its generation is
+# still the stored one. A hit costs a primary-key lookup instead of the aggregate query.
+# Diagram saves don't bump it (autosave would defeat the cache), so diagram counts are
+# exact but last_activity can trail behind edits by up to PROJECT_LISTING_CACHE_TTL.
+PROJECT_LISTING_CACHE_TTL = float(os.getenv("PROJECT_LISTING_CACHE_TTL", "30"))
+PROJECT_LISTING_CACHE_SIZE = int(os.getenv("PROJECT_LISTING_CACHE_SIZE", "10000"))
+
+GENERATION_QUERY = PreparedQuery('listing_generation', """
+    SELECT generation FROM project_listing_generations WHERE user_id = %s;
+""")
+
+# Projects owned by the user OR shared with the user, with their diagram count and the
+# latest change to the project or any of its diagrams, in one pass over idx_diagrams_project_updated
+LISTING_QUERY = PreparedQuery('project_listing', """
+    SELECT p.project_id, p.project_name, p.user_id, p.created_at, p.updated_at, m.role,
+           count(d.diagram_id) AS diagram_count,
+           GREATEST(p.updated_at, max(d.updated_at)) AS last_activity
+    FROM (
+        SELECT project_id, 'owner' AS role FROM projects WHERE user_id = %(user_id)s
+        UNION
+        SELECT project_id, permission_level FROM sharing_permissions WHERE user_id = %(user_id)s
+    ) m
+    JOIN projects p ON p.project_id = m.project_id
+    LEFT JOIN diagrams d ON d.project_id = p.project_id
+    GROUP BY p.project_id, m.role
+    ORDER BY p.project_id;
+""")
+
+# Users are locked in user_id order so concurrent bumps can't deadlock
+_BUMP_QUERY = """
+    INSERT INTO project_listing_generations (user_id, generation)
+    SELECT user_id, 1 FROM ({members}) affected ORDER BY user_id
+    ON CONFLICT (user_id) DO UPDATE SET generation = project_listing_generations.generation + 1;
+"""
+_PROJECT_MEMBERS = """
+    SELECT user_id FROM projects WHERE project_id = ANY(%(project_ids)s)
+    UNION
+    SELECT user_id FROM sharing_permissions WHERE project_id = ANY(%(project_ids)s)
+"""
+
+# user_id -> (generation, listing)
+_cache = TTLCache(maxsize=PROJECT_LISTING_CACHE_SIZE, ttl=PROJECT_LISTING_CACHE_TTL)
+
+
+def get_listing(user_id):
+    """
+    The user's projects (role, diagram_count and last_activity included), ordered by
+    project_id. Served from this worker's cache while the user's generation is unchanged.
+    """
+    # Both reads go to the primary: a listing from a lagging replica must never be
+    # cached under the current generation
+    row = execute_query(GENERATION_QUERY, (user_id,), fetchone=True, primary=True)
+    generation = row['generation'] if row else 0
+    cached = _cache.get(user_id)
+    if cached is not None and cached[0] == generation:
+        metrics.inc('project_listing_cache_lookups_total', result='hit')
+        return cached[1]
+    metrics.inc('project_listing_cache_lookups_total', result='miss' if cached is None else 'stale')
+    # The generation was read first, so a change committed in between only costs a miss later
+    projects = execute_query(LISTING_QUERY, {'user_id': user_id}, fetchall=True, primary=True)
+    _cache.set(user_id, (generation, projects))
+    return projects
+
+
+def bump_users(user_ids):
+    """
+    Invalidates the cached listings of `user_ids` in every worker. Call it after the change
+    has been written, or inside the same unit of work.
+    """
+    user_ids = sorted(set(user_ids))
+    if user_ids:
+        execute_query(_BUMP_QUERY.format(members="SELECT unnest(%(user_ids)s::int[]) AS user_id"),
+                      {'user_ids': user_ids}, commit=True)
+
+
+def bump_projects(project_ids):
+    """
+    bump_users() for the owner and every collaborator of `project_ids`. To cover the
+    collaborators of a project being deleted, call it in the deleting unit of work before
+    the DELETE cascades to sharing_permissions.
+    """
+    project_ids = sorted(set(project_ids))
+    if project_ids:
+        execute_query(_BUMP_QUERY.format(members=_PROJECT_MEMBERS), {'project_ids': project_ids}, commit=True)
+
+
+def stats():
+    """Size and eviction counters for the listing cache of this worker (stale hits count as hits here)."""
+    return _cache.stats()
+
+
+metrics.describe('project_listing_cache_lookups_total', 'counter',
+                 "Project listing cache lookups: hit, miss, or stale (generation bumped since it was cached).")
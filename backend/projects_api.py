@@ -4,10 +4,13 @@ from backend.db_utils import BaseDBOperations # or specific project DB operation
 # If it's in app.py, we might need to pass 'app' or restructure.
 # For now, let's assume it can be imported or will be applied at registration in app.py
 # from backend.app import login_required # This creates a circular import if app.py imports this.
-from backend.app import login_required # Import the shared decorator
+from backend.auth import login_required # Import the shared decorator
+from backend.log import get_logger
+from backend import permission_cache, project_listing, http_cache
 
 projects_bp = Blueprint('projects_api', __name__)
 db_ops = BaseDBOperations() # Use the base or a specialized one
+log = get_logger(__name__)
 
 @projects_bp.route('/projects', methods=['POST'])
 @login_required # Apply decorator
@@ -24,11 +27,12 @@ def create_project():
             VALUES (%s, %s) RETURNING project_id, project_name, user_id, created_at, updated_at;
         """
         project = db_ops._execute(query, (project_name, user_id), fetchone=True, commit=True)
+        project_listing.bump_users([user_id])
         return jsonify(project), 201
     except PermissionError as e: # From _get_user_id_from_session
         return jsonify(error=str(e)), 401
     except Exception as e:
-        # Log e
+        log.exception("Failed to create project")
         return jsonify(error=f"Failed to create project: {str(e)}"), 500
 
 @projects_bp.route('/projects', methods=['GET'])
@@ -36,22 +40,17 @@ def create_project():
 def get_projects():
     try:
         user_id = db_ops._get_user_id_from_session(session)
-        # Query projects owned by the user OR shared with the user
-        query = """
-            SELECT p.project_id, p.project_name, p.user_id, p.created_at, p.updated_at, 'owner' as role
-            FROM projects p
-            WHERE p.user_id = %s
-            UNION
-            SELECT p.project_id, p.project_name, p.user_id, p.created_at, p.updated_at, sp.permission_level as role
-            FROM projects p
-            JOIN sharing_permissions sp ON p.project_id = sp.project_id
-            WHERE sp.user_id = %s;
-        """
-        projects = db_ops._execute(query, (user_id, user_id), fetchall=True)
-        return jsonify(projects), 200
+        # Projects owned by or shared with the user, with diagram counts and last activity,
+        # cached per user until something bumps their listing generation
+        projects = project_listing.get_listing(user_id)
+        # Rows are small, so the ETag is computed from the full listing; a match still
+        # saves serialising and sending it. No Last-Modified: removals don't bump updated_at.
+        etag = http_cache.version_etag(*projects, key=('project_id', 'updated_at', 'role', 'diagram_count', 'last_activity'))
+        return http_cache.conditional_json(projects, etag)
     except PermissionError as e:
         return jsonify(error=str(e)), 401
     except Exception as e:
+        log.exception("Failed to retrieve projects")
         return jsonify(error=f"Failed to retrieve projects: {str(e)}"), 500
 
 @projects_bp.route('/projects/<int:project_id>', methods=['GET'])
@@ -72,6 +71,7 @@ def get_project(project_id):
     except PermissionError as e:
         return jsonify(error=str(e)), 401
     except Exception as e:
+        log.exception("Failed to retrieve project")
         return jsonify(error=f"Failed to retrieve project: {str(e)}"), 500
 
 @projects_bp.route('/projects/<int:project_id>', methods=['PUT'])
@@ -99,10 +99,12 @@ def update_project(project_id):
         if not updated_project:
             # This case should ideally not be hit if ownership is checked and project exists
             return jsonify(error="Failed to update project or project not found."), 404 
+        project_listing.bump_projects([project_id]) # The name shows in every collaborator's listing
         return jsonify(updated_project), 200
     except PermissionError as e: # Catches both session error and ownership error
         return jsonify(error=str(e)), (401 if "User not authenticated" in str(e) else 403)
     except Exception as e:
+        log.exception("Failed to update project")
         return jsonify(error=f"Failed to update project: {str(e)}"), 500
 
 @projects_bp.route('/projects/<int:project_id>', methods=['DELETE'])
@@ -117,8 +119,12 @@ def delete_project(project_id):
         db_ops._check_ownership(project['user_id'], user_id, "Only the project owner can delete the project.")
 
         # Deletion will cascade to diagrams and sharing_permissions due to DB schema
-        deleted_count = db_ops._execute("DELETE FROM projects WHERE project_id = %s AND user_id = %s", 
-                                        (project_id, user_id), commit=True) # execute_query needs to handle rowcount for DELETE
+        with db_ops.unit_of_work():
+            # Bumped before the cascade removes the collaborators; both commit together
+            project_listing.bump_projects([project_id])
+            deleted_count = db_ops._execute("DELETE FROM projects WHERE project_id = %s AND user_id = %s", 
+                                            (project_id, user_id), commit=True) # execute_query needs to handle rowcount for DELETE
+        permission_cache.invalidate(project_id) # Drop cached access for everyone on the project
         
         # The current _execute doesn't directly return rowcount for DELETE in a simple way.
         # Let's assume if no error, it worked. A more robust way is to check cursor.rowcount.
@@ -131,4 +137,5 @@ def delete_project(project_id):
         return jsonify(error=str(e)), (401 if "User not authenticated" in str(e) else 403)
     except Exception as e:
         # Handle cases like foreign key constraints if not set to cascade, etc.
+        log.exception("Failed to delete project")
         return jsonify(error=f"Failed to delete project: {str(e)}"), 500
@@ -0,0 +1,201 @@
+import os
+import time
+import select
+import threading
+from collections import deque
+
+import psycopg2
+import psycopg2.extensions
+from psycopg2 import sql
+
+from backend.db_utils import execute_query
+from backend.log import get_logger
+
+log = get_logger(__name__)
+
+# How long the listener blocks between keepalive polls, and how long it backs off
+# before reconnecting after losing its connection.
+PUBSUB_POLL_INTERVAL = float(os.getenv("PUBSUB_POLL_INTERVAL", "5"))
+PUBSUB_RECONNECT_DELAY = float(os.getenv("PUBSUB_RECONNECT_DELAY", "2"))
+
+
+class _Listener:
+    """
+    One LISTEN connection per worker process, driven by a single background thread
+    (a greenlet once gevent has monkey-patched threading).
+
+    Only the listener thread ever touches the connection: subscribe/unsubscribe queue
+    LISTEN/UNLISTEN commands and wake the thread through a pipe, so callers never race
+    the thread for the socket.
+    """
+    def __init__(self, dsn):
+        self.dsn = dsn
+        self.pid = os.getpid()
+        self._callbacks = {}  # channel -> list of callables
+        self._pending = []  # [(command, channel)] to run on the listener connection
+        self._lock = threading.Lock()
+        self._wake_r, self._wake_w = os.pipe()
+        self._thread = threading.Thread(target=self._run, name="pg-listener", daemon=True)
+        self._thread.start()
+
+    def subscribe(self, channel, callback):
+        with self._lock:
+            callbacks = self._callbacks.setdefault(channel, [])
+            if not callbacks:
+                self._pending.append(("LISTEN", channel))
+            callbacks.append(callback)
+        self._wake()
+
+    def unsubscribe(self, channel, callback):
+        with self._lock:
+            callbacks = self._callbacks.get(channel)
+            if not callbacks or callback not in callbacks:
+                return
+            callbacks.remove(callback)
+            if not callbacks:
+                del self._callbacks[channel]
+                self._pending.append(("UNLISTEN", channel))
+        self._wake()
+
+    def _wake(self):
+        try:
+            os.write(self._wake_w, b"\0")
+        except OSError:
+            pass
+
+    def _drain_wake_pipe(self):
+        try:
+            os.read(self._wake_r, 4096)
+        except OSError:
+            pass
+
+    def _apply_pending(self, conn):
+        """Runs queued LISTEN/UNLISTEN commands; returns the channels that started listening."""
+        with self._lock:
+            pending, self._pending = self._pending, []
+        listened = []
+        with conn.cursor() as cursor:
+            for command, channel in pending:
+                cursor.execute(sql.SQL(command + " {}").format(sql.Identifier(channel)))
+                if command == "LISTEN":
+                    listened.append(channel)
+        return listened
+
+    def _dispatch(self, channel, payload):
+        with self._lock:
+            callbacks = list(self._callbacks.get(channel, ()))
+        for callback in callbacks:
+            try:
+                callback(payload)
+            except Exception:
+                log.exception("Error in pubsub callback", channel=channel)
+
+    def _run(self):
+        while True:
+            conn = None
+            try:
+                conn = psycopg2.connect(self.dsn)
+                conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+                with self._lock:
+                    # Re-LISTEN everything after a (re)connect; queued commands are subsumed.
+                    self._pending = [("LISTEN", channel) for channel in self._callbacks]
+
+                while True:
+                    # A None payload tells subscribers that the channel is now live and that
+                    # anything published before (or while we were disconnected) was not seen,
+                    # so they can resynchronise from the database.
+                    for channel in self._apply_pending(conn):
+                        self._dispatch(channel, None)
+                    readable, _, _ = select.select([conn, self._wake_r], [], [], PUBSUB_POLL_INTERVAL)
+                    if self._wake_r in readable:
+                        self._drain_wake_pipe()
+                    conn.poll()
+                    while conn.notifies:
+                        notify = conn.notifies.pop(0)
+                        self._dispatch(notify.channel, notify.payload)
+            except (psycopg2.Error, OSError) as e:
+                log.warning("Pubsub listener lost its connection", error=str(e), retry_in=PUBSUB_RECONNECT_DELAY)
+            finally:
+                if conn is not None:
+                    try:
+                        conn.close()
+                    except psycopg2.Error:
+                        pass
+            time.sleep(PUBSUB_RECONNECT_DELAY)
+
+
+class Mailbox:
+    """
+    Takes work off the listener thread: `put(item)` only queues it, and `handler(item)` runs
+    in put order on a thread of the mailbox's own (a greenlet under gevent), which exits
+    once the queue is empty. Callbacks that would block put their payload into one.
+    """
+    def __init__(self, handler, name):
+        self._handler = handler
+        self._name = name
+        self._items = deque()
+        self._lock = threading.Lock()
+        self._draining = False
+
+    def put(self, item):
+        with self._lock:
+            self._items.append(item)
+            if self._draining:
+                return
+            self._draining = True
+        threading.Thread(target=self._drain, name=self._name, daemon=True).start()
+
+    def idle(self):
+        """True when nothing is queued or being handled, so a put would run right away."""
+        with self._lock:
+            return not self._draining
+
+    def _drain(self):
+        while True:
+            with self._lock:
+                if not self._items:
+                    self._draining = False
+                    return
+                item = self._items.popleft()
+            try:
+                self._handler(item)
+            except Exception:
+                log.exception("Error in pubsub mailbox handler", mailbox=self._name)
+
+
+_listener = None
+_listener_lock = threading.Lock()
+
+
+def _get_listener():
+    global _listener
+    with _listener_lock:
+        if _listener is None or _listener.pid != os.getpid():
+            dsn = os.getenv("DATABASE_URL")
+            if not dsn:
+                raise ValueError("DATABASE_URL environment variable is not set.")
+            _listener = _Listener(dsn)
+        return _listener
+
+
+def subscribe(channel, callback):
+    """
+    Calls `callback(payload)` for every NOTIFY on `channel` received by this worker.
+    `callback` runs on the listener thread and must not block (hand anything slower to a
+    Mailbox): every channel of the worker waits on it. It is also called with
+    None once the channel is being listened to, and again after every reconnect, since
+    notifications published before that point were not received.
+    """
+    _get_listener().subscribe(channel, callback)
+
+
+def unsubscribe(channel, callback):
+    _get_listener().unsubscribe(channel, callback)
+
+
+def publish(channel, payload=""):
+    """
+    Sends a NOTIFY to every worker (this one included) listening on `channel`.
+    Inside a unit of work the notification is delivered only when the unit commits.
+    """
+    execute_query("SELECT pg_notify(%s, %s)", (channel, payload), commit=True)
@@ -0,0 +1,163 @@
+"""
+Slow-query log and per-statement statistics, fed by the db_utils query hook.
+
+Every statement is counted under its normalized SQL, which is its text with literals
+replaced by `?` and whitespace collapsed. Each entry keeps the endpoints that issued it.
+Statements slower than SLOW_QUERY_MS are logged with the calling endpoint and the shape of
+their parameters. Values are never logged. SLOW_QUERY_EXPLAIN_RATE of the slow ones are
+run once more under EXPLAIN (ANALYZE, BUFFERS) inside a savepoint that is rolled back, so
+writes are undone. The plan is logged and kept with the statement's stats.
+
+The stats are per worker; debug_api serves them in development.
+"""
+import os
+import re
+import time
+import random
+import threading
+from functools import lru_cache
+
+import psycopg2
+from flask import has_request_context, request
+
+from backend.db_utils import add_query_hook
+from backend.log import get_logger
+
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", "200"))
+SLOW_QUERY_EXPLAIN_RATE = float(os.getenv("SLOW_QUERY_EXPLAIN_RATE", "0"))  # 0 disables EXPLAIN capture
+QUERY_STATS_MAX_ENTRIES = int(os.getenv("QUERY_STATS_MAX_ENTRIES", "1000"))
+SLOW_QUERY_LOG_CHARS = 4000  # Normalized SQL and plans are logged up to this length
+ENDPOINTS_PER_QUERY = 5
+
+log = get_logger(__name__)
+
+_lock = threading.Lock()
+_stats = {}  # normalized sql -> stats dict
+_since = time.time()
+_untracked = 0  # Statements not counted because _stats was full
+
+
+_STRING_LITERAL = re.compile(r"'(?:[^']|'')*'")
+_NUMBER_LITERAL = re.compile(r"(?<![\w$.])-?\d+(?:\.\d+)?\b")
+_PLACEHOLDER = re.compile(r"%\(\w+\)s|%s")
+_VALUES_LIST = re.compile(r"\bVALUES\s*(\(\s*\?(?:\s*(?:::\s*\w+)?\s*,\s*\?)*\s*(?:::\s*\w+)?\s*\)(?:\s*,\s*)?)+", re.I)
+_IN_LIST = re.compile(r"\bIN\s*\(\s*\?(?:\s*,\s*\?)*\s*\)", re.I)
+_WHITESPACE = re.compile(r"\s+")
+_COMMENT = re.compile(r"--[^\n]*")
+
+
+@lru_cache(maxsize=4096)
+def normalize_sql(query):
+    """SQL with comments, literals and placeholders abstracted away, on one line."""
+    text = _COMMENT.sub(" ", query)
+    text = _STRING_LITERAL.sub("?", text)
+    text = _PLACEHOLDER.sub("?", text)
+    text = _NUMBER_LITERAL.sub("?", text)
+    text = _IN_LIST.sub("IN (...)", text)
+    text = _VALUES_LIST.sub("VALUES (...) ", text)
+    return _WHITESPACE.sub(" ", text).strip().rstrip(";").strip()
+
+
+def _type_name(value):
+    if isinstance(value, (list, tuple)):
+        return f"{type(value).__name__}[{len(value)}]"
+    if isinstance(value, (str, bytes)):
+        return f"{type(value).__name__}({len(value)})"
+    return type(value).__name__
+
+
+def params_shape(params, batch_size=None):
+    """Types (and sizes) of the parameters, never their values."""
+    if params is None:
+        return None
+    if batch_size is not None:  # execute_values: params holds the first row
+        row = params[0] if params else ()
+        return f"{batch_size} rows of ({', '.join(_type_name(v) for v in row)})"
+    if isinstance(params, dict):
+        return {key: _type_name(value) for key, value in params.items()}
+    return [_type_name(value) for value in params]
+
+
+def _caller():
+    if has_request_context():
+        return request.endpoint or request.path
+    return threading.current_thread().name
+
+
+def _explain(event):
+    """Re-runs the statement under EXPLAIN ANALYZE in a rolled-back savepoint; returns the plan."""
+    conn = event.cursor.connection
+    if conn.autocommit or conn.closed or event.cursor.query is None:
+        return None
+    with conn.cursor() as cursor:
+        cursor.execute("SAVEPOINT query_profile_explain;")
+        try:
+            # cursor.query is the statement exactly as sent, parameters already bound
+            cursor.execute(b"EXPLAIN (ANALYZE, BUFFERS) " + event.cursor.query)
+            return "\n".join(row[0] for row in cursor.fetchall())
+        except psycopg2.Error as e:
+            return f"EXPLAIN failed: {e}"
+        finally:
+            cursor.execute("ROLLBACK TO SAVEPOINT query_profile_explain;")
+            cursor.execute("RELEASE SAVEPOINT query_profile_explain;")
+
+
+def _on_query(event):
+    global _untracked
+    sql = normalize_sql(event.query)
+    caller = _caller()
+    duration_ms = event.duration * 1000
+    with _lock:
+        entry = _stats.get(sql)
+        if entry is None:
+            if len(_stats) >= QUERY_STATS_MAX_ENTRIES:
+                _untracked += 1
+                entry = None
+            else:
+                entry = _stats[sql] = {'calls': 0, 'total_ms': 0.0, 'max_ms': 0.0, 'errors': 0,
+                                       'slow': 0, 'endpoints': {}, 'last_plan': None}
+        if entry is not None:
+            entry['calls'] += 1
+            entry['total_ms'] += duration_ms
+            entry['max_ms'] = max(entry['max_ms'], duration_ms)
+            entry['errors'] += event.error is not None
+            endpoints = entry['endpoints']
+            if caller in endpoints or len(endpoints) < ENDPOINTS_PER_QUERY:
+                endpoints[caller] = endpoints.get(caller, 0) + 1
+
+    if duration_ms < SLOW_QUERY_MS:
+        return
+    plan = None
+    if event.error is None and event.operation != 'OTHER' \
+            and SLOW_QUERY_EXPLAIN_RATE > 0 and random.random() < SLOW_QUERY_EXPLAIN_RATE:
+        plan = _explain(event)
+    with _lock:
+        if entry is not None:
+            entry['slow'] += 1
+            if plan is not None:
+                entry['last_plan'] = plan
+    log.warning("Slow query", limit=SLOW_QUERY_LOG_CHARS, duration_ms=round(duration_ms, 1),
+                caller=caller, sql=sql, params=params_shape(event.params, event.batch_size),
+                error=str(event.error) if event.error is not None else None, plan=plan)
+
+
+def top_queries(limit=20, sort='total_ms'):
+    """The `limit` statements with the highest `sort` (total_ms, mean_ms, max_ms, calls or slow)."""
+    with _lock:
+        rows = [{'sql': sql, **entry, 'endpoints': dict(entry['endpoints']),
+                 'mean_ms': entry['total_ms'] / entry['calls'] if entry['calls'] else 0.0}
+                for sql, entry in _stats.items()]
+        untracked = _untracked
+    rows.sort(key=lambda row: row[sort], reverse=True)
+    return {'pid': os.getpid(), 'since': _since, 'untracked': untracked, 'queries': rows[:limit]}
+
+
+def reset():
+    global _since, _untracked
+    with _lock:
+        _stats.clear()
+        _since = time.time()
+        _untracked = 0
+
+
+add_query_hook(_on_query)
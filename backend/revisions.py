@@ -0,0 +1,305 @@
+"""
+Revision history of diagram_data.
+
+Versions are stored in diagram_revisions as zlib-compressed payloads: every
+REVISION_SNAPSHOT_EVERY-th version of a chain is a full snapshot of the diagram's
+canonical JSON text, the others are text ops (see text_ops) against the version before.
+Materialising any version therefore reads and applies at most REVISION_SNAPSHOT_EVERY rows.
+
+A compactor thread in each worker thins revisions older than REVISION_COMPACT_AFTER_DAYS
+to one per REVISION_COMPACT_BUCKET, re-encoding the survivors so chains stay short.
+"""
+import os
+import json
+import time
+import zlib
+import threading
+
+import psycopg2
+from psycopg2.extras import RealDictCursor
+
+from backend.db_utils import execute_query, execute_values_query, get_db_connection, release_db_connection
+from backend.text_ops import apply_ops, diff
+from backend.log import get_logger
+
+REVISION_SNAPSHOT_EVERY = int(os.getenv("REVISION_SNAPSHOT_EVERY", "20"))
+REVISION_COMPACT_AFTER_DAYS = float(os.getenv("REVISION_COMPACT_AFTER_DAYS", "7"))
+REVISION_COMPACT_BUCKET = os.getenv("REVISION_COMPACT_BUCKET", "hour")  # date_trunc() unit
+REVISION_COMPACT_INTERVAL = float(os.getenv("REVISION_COMPACT_INTERVAL", "3600"))
+COMPACT_BATCH = 50  # Diagrams compacted per pass
+RECORD_RETRIES = 3
+
+log = get_logger(__name__)
+
+# First key of the transaction-level advisory lock taken while compacting a diagram
+_COMPACT_LOCK = 0x52455653  # 'REVS'
+
+
+def canonical_text(diagram_data):
+    """Stable text form of diagram_data that deltas are computed on."""
+    return json.dumps(diagram_data, sort_keys=True, indent=1, ensure_ascii=False)
+
+
+def _decode(row, text):
+    """Text of the version in `row`, given the text of the version before it."""
+    payload = zlib.decompress(row['payload']).decode('utf-8')
+    return payload if row['is_snapshot'] else apply_ops(text, json.loads(payload))
+
+
+def _encode_snapshot(text):
+    return zlib.compress(text.encode('utf-8'))
+
+
+def _encode_delta(old_text, new_text):
+    return zlib.compress(json.dumps(diff(old_text, new_text), ensure_ascii=False).encode('utf-8'))
+
+
+def _chain(diagram_id, version=None):
+    """Rows from the snapshot at or before `version` (default: the newest) up to `version`."""
+    query = """
+        SELECT version, is_snapshot, payload, created_at FROM diagram_revisions
+        WHERE diagram_id = %(diagram_id)s
+          AND version >= COALESCE((SELECT max(version) FROM diagram_revisions
+                                   WHERE diagram_id = %(diagram_id)s AND is_snapshot
+                                     AND (%(version)s IS NULL OR version <= %(version)s)), 0)
+          AND (%(version)s IS NULL OR version <= %(version)s)
+        ORDER BY version;
+    """
+    return execute_query(query, {'diagram_id': diagram_id, 'version': version}, fetchall=True) or []
+
+
+def _replay(rows):
+    text = None
+    for row in rows:
+        text = _decode(row, text)
+    return text
+
+
+def materialize(diagram_id, version):
+    """
+    Returns {'version', 'created_at', 'diagram_data'} for one version of a diagram, or
+    None if that version does not exist (or was compacted away).
+    """
+    rows = _chain(diagram_id, version)
+    if not rows or rows[-1]['version'] != version:
+        return None
+    return {
+        'version': version,
+        'created_at': rows[-1]['created_at'],
+        'diagram_data': json.loads(_replay(rows)),
+    }
+
+
+def record(diagram_id, diagram_data, user_id=None):
+    """
+    Appends diagram_data as the diagram's next version unless it equals the newest one.
+    Returns the version number it is stored as.
+    """
+    _ensure_compactor()
+    text = canonical_text(diagram_data)
+    for _ in range(RECORD_RETRIES):
+        rows = _chain(diagram_id)
+        if rows:
+            head_text = _replay(rows)
+            if head_text == text:
+                return rows[-1]['version']
+            version = rows[-1]['version'] + 1
+            is_snapshot = len(rows) >= REVISION_SNAPSHOT_EVERY
+            payload = _encode_snapshot(text) if is_snapshot else _encode_delta(head_text, text)
+        else:
+            version, is_snapshot, payload = 1, True, _encode_snapshot(text)
+        inserted = execute_query(
+            """
+            INSERT INTO diagram_revisions (diagram_id, version, is_snapshot, payload, size, user_id)
+            VALUES (%s, %s, %s, %s, %s, %s)
+            ON CONFLICT (diagram_id, version) DO NOTHING
+            RETURNING version;
+            """,
+            (diagram_id, version, is_snapshot, payload, len(text), user_id),
+            fetchone=True, commit=True
+        )
+        if inserted:
+            return version
+        # Someone else recorded this version first; diff against theirs instead
+    raise RuntimeError(f"Could not record a revision of diagram {diagram_id} after {RECORD_RETRIES} attempts")
+
+
+def record_many(items, user_id=None):
+    """
+    record() for many diagrams at once: `items` is [(diagram_id, diagram_data)], one per
+    diagram. Reads every head chain in one query and inserts in one statement; diagrams
+    that lose a race for their next version are retried one by one.
+    """
+    if not items:
+        return
+    _ensure_compactor()
+    chains = {}
+    for row in execute_query(
+        """
+        SELECT r.diagram_id, r.version, r.is_snapshot, r.payload FROM diagram_revisions r
+        WHERE r.diagram_id = ANY(%(ids)s)
+          AND r.version >= COALESCE((SELECT max(s.version) FROM diagram_revisions s
+                                     WHERE s.diagram_id = r.diagram_id AND s.is_snapshot), 0)
+        ORDER BY r.diagram_id, r.version;
+        """,
+        {'ids': [diagram_id for diagram_id, _ in items]}, fetchall=True
+    ) or []:
+        chains.setdefault(row['diagram_id'], []).append(row)
+
+    values, data_by_id = [], {}
+    for diagram_id, diagram_data in items:
+        text = canonical_text(diagram_data)
+        rows = chains.get(diagram_id)
+        if rows:
+            head_text = _replay(rows)
+            if head_text == text:
+                continue
+            version = rows[-1]['version'] + 1
+            is_snapshot = len(rows) >= REVISION_SNAPSHOT_EVERY
+            payload = _encode_snapshot(text) if is_snapshot else _encode_delta(head_text, text)
+        else:
+            version, is_snapshot, payload = 1, True, _encode_snapshot(text)
+        values.append((diagram_id, version, is_snapshot, payload, len(text), user_id))
+        data_by_id[diagram_id] = diagram_data
+    if not values:
+        return
+    inserted = execute_values_query(
+        """
+        INSERT INTO diagram_revisions (diagram_id, version, is_snapshot, payload, size, user_id)
+        VALUES %s
+        ON CONFLICT (diagram_id, version) DO NOTHING
+        RETURNING diagram_id;
+        """,
+        values, page_size=len(values), fetch=True, commit=True
+    )
+    for diagram_id in set(data_by_id) - {row['diagram_id'] for row in inserted}:
+        record(diagram_id, data_by_id[diagram_id], user_id)
+
+
+def record_quietly(diagram_id, diagram_data, user_id=None):
+    """record() for callers whose own write already succeeded: failures are only logged."""
+    try:
+        return record(diagram_id, diagram_data, user_id)
+    except Exception:
+        log.exception("Error recording revision", diagram_id=diagram_id)
+        return None
+
+
+def list_revisions(diagram_id, limit=50, before=None):
+    """Metadata of a diagram's versions, newest first, optionally only those older than `before`."""
+    return execute_query(
+        """
+        SELECT version, created_at, user_id, size, is_snapshot, octet_length(payload) AS stored_size
+        FROM diagram_revisions
+        WHERE diagram_id = %(diagram_id)s AND (%(before)s IS NULL OR version < %(before)s)
+        ORDER BY version DESC
+        LIMIT %(limit)s;
+        """,
+        {'diagram_id': diagram_id, 'before': before, 'limit': limit}, fetchall=True
+    ) or []
+
+
+# --- Compaction ---
+
+def _compact_diagram(cursor, diagram_id):
+    """
+    Thins one diagram's old revisions on `cursor`'s transaction. Keeps every revision newer
+    than the cutoff and the newest one of each older bucket, then re-encodes the survivors
+    so that each is a delta against the previous survivor, with a snapshot every
+    REVISION_SNAPSHOT_EVERY. Returns the number of revisions removed.
+    """
+    # Concurrent record() calls only append deltas against the head, which is always kept
+    # with its text unchanged, so only other compactors need keeping out
+    cursor.execute("SELECT pg_try_advisory_xact_lock(%s, %s) AS locked;", (_COMPACT_LOCK, diagram_id))
+    if not cursor.fetchone()['locked']:
+        return 0  # Another worker is on it
+    cursor.execute(
+        """
+        SELECT version, is_snapshot, payload,
+               created_at >= CURRENT_TIMESTAMP - make_interval(secs => %(after)s) AS recent,
+               row_number() OVER (PARTITION BY date_trunc(%(bucket)s, created_at)
+                                  ORDER BY version DESC) = 1 AS last_in_bucket
+        FROM diagram_revisions
+        WHERE diagram_id = %(diagram_id)s
+        ORDER BY version;
+        """,
+        {'diagram_id': diagram_id, 'after': REVISION_COMPACT_AFTER_DAYS * 86400,
+         'bucket': REVISION_COMPACT_BUCKET}
+    )
+    rows = cursor.fetchall()
+    text, kept_text, chain_length = None, None, 0
+    removed, rewritten = [], []
+    for row in rows:
+        text = _decode(row, text)
+        if not (row['recent'] or row['last_in_bucket']) and row is not rows[-1]:
+            removed.append(row['version'])
+            continue
+        if kept_text is None or chain_length >= REVISION_SNAPSHOT_EVERY:
+            is_snapshot, payload, chain_length = True, _encode_snapshot(text), 1
+        else:
+            is_snapshot, payload = False, _encode_delta(kept_text, text)
+            chain_length += 1
+        if is_snapshot != row['is_snapshot'] or payload != bytes(row['payload']):
+            rewritten.append((is_snapshot, payload, diagram_id, row['version']))
+        kept_text = text
+    if not removed:
+        return 0
+    cursor.execute("DELETE FROM diagram_revisions WHERE diagram_id = %s AND version = ANY(%s);",
+                   (diagram_id, removed))
+    cursor.executemany(
+        "UPDATE diagram_revisions SET is_snapshot = %s, payload = %s WHERE diagram_id = %s AND version = %s;",
+        rewritten
+    )
+    return len(removed)
+
+
+def compact():
+    """One compaction pass over diagrams with thinnable revisions; returns revisions removed."""
+    candidates = execute_query(
+        """
+        SELECT DISTINCT diagram_id FROM diagram_revisions
+        WHERE created_at < CURRENT_TIMESTAMP - make_interval(secs => %s)
+        GROUP BY diagram_id, date_trunc(%s, created_at)
+        HAVING count(*) > 1
+        LIMIT %s;
+        """,
+        (REVISION_COMPACT_AFTER_DAYS * 86400, REVISION_COMPACT_BUCKET, COMPACT_BATCH), fetchall=True
+    ) or []
+    removed = 0
+    for candidate in candidates:
+        conn = get_db_connection()
+        discard = False
+        try:
+            with conn.cursor(cursor_factory=RealDictCursor) as cursor:
+                removed += _compact_diagram(cursor, candidate['diagram_id'])
+            conn.commit()
+        except psycopg2.Error as e:
+            discard = isinstance(e, (psycopg2.OperationalError, psycopg2.InterfaceError))
+            log.error("Error compacting revisions", diagram_id=candidate['diagram_id'], error=str(e))
+        finally:
+            release_db_connection(conn, discard=discard)
+    return removed
+
+
+def _run_compactor():
+    while True:
+        time.sleep(REVISION_COMPACT_INTERVAL)
+        try:
+            removed = compact()
+            if removed:
+                log.info("Compacted old diagram revisions", removed=removed)
+        except Exception:
+            log.exception("Error compacting diagram revisions")
+
+
+_compactor_pid = None
+_compactor_lock = threading.Lock()
+
+
+def _ensure_compactor():
+    global _compactor_pid
+    with _compactor_lock:
+        if _compactor_pid == os.getpid():
+            return
+        _compactor_pid = os.getpid()
+    threading.Thread(target=_run_compactor, name="revision-compactor", daemon=True).start()
@@ -0,0 +1,114 @@
+import json
+from flask import Blueprint, request, jsonify, session
+from backend.db_utils import BaseDBOperations
+from backend.auth import login_required # Import the shared decorator
+from backend.log import get_logger
+from backend.diagrams_api import ACCESS_COLUMNS, diagram_columns, evaluate_access, split_access
+from backend import revisions, rooms
+
+revisions_bp = Blueprint('revisions_api', __name__)
+db_ops = BaseDBOperations()
+log = get_logger(__name__)
+
+MAX_REVISIONS_PAGE = 200
+
+# Checks the caller's access to a diagram's project in one query
+def check_diagram_access(diagram_id, user_id, require_edit=False):
+    query = f"""
+        SELECT {ACCESS_COLUMNS}
+        FROM diagrams d
+        JOIN projects p ON p.project_id = d.project_id
+        LEFT JOIN sharing_permissions sp ON sp.project_id = d.project_id AND sp.user_id = %(user_id)s
+        WHERE d.diagram_id = %(diagram_id)s;
+    """
+    row = db_ops._execute(query, {'user_id': user_id, 'diagram_id': diagram_id}, fetchone=True)
+    if not row:
+        raise PermissionError("Diagram not found.")
+    owner_id, permission_level, _ = split_access(row)
+    return evaluate_access(owner_id, permission_level, user_id, require_edit)
+
+def _permission_error_response(e):
+    if "User not authenticated" in str(e) or "invalid session" in str(e):
+        return jsonify(error=str(e)), 401
+    elif "not found" in str(e):
+        return jsonify(error=str(e)), 404
+    return jsonify(error=str(e)), 403
+
+@revisions_bp.route('/diagrams/<int:diagram_id>/revisions', methods=['GET'])
+@login_required
+def list_diagram_revisions(diagram_id):
+    """
+    A diagram's versions, newest first: ?limit= (default 50) and ?before=<version> to page.
+    Responds with {"revisions": [...], "next_before": <version or null>}.
+    """
+    try:
+        limit = int(request.args.get('limit', 50))
+        before = request.args.get('before')
+        before = int(before) if before is not None else None
+    except ValueError:
+        return jsonify(error="limit and before must be integers."), 400
+    if not 1 <= limit <= MAX_REVISIONS_PAGE:
+        return jsonify(error=f"limit must be between 1 and {MAX_REVISIONS_PAGE}."), 400
+
+    try:
+        user_id = db_ops._get_user_id_from_session(session)
+        check_diagram_access(diagram_id, user_id)
+        rows = revisions.list_revisions(diagram_id, limit + 1, before)
+        next_before = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_before = rows[-1]['version']
+        return jsonify(revisions=rows, next_before=next_before), 200
+    except PermissionError as e:
+        return _permission_error_response(e)
+    except Exception as e:
+        log.exception("Failed to list revisions")
+        return jsonify(error=f"Failed to list revisions: {str(e)}"), 500
+
+@revisions_bp.route('/diagrams/<int:diagram_id>/revisions/<int:version>', methods=['GET'])
+@login_required
+def get_diagram_revision(diagram_id, version):
+    try:
+        user_id = db_ops._get_user_id_from_session(session)
+        check_diagram_access(diagram_id, user_id)
+        revision = revisions.materialize(diagram_id, version)
+        if revision is None:
+            return jsonify(error="Revision not found."), 404
+        return jsonify(revision), 200
+    except PermissionError as e:
+        return _permission_error_response(e)
+    except Exception as e:
+        log.exception("Failed to retrieve revision")
+        return jsonify(error=f"Failed to retrieve revision: {str(e)}"), 500
+
+@revisions_bp.route('/diagrams/<int:diagram_id>/revisions/<int:version>/restore', methods=['POST'])
+@login_required
+def restore_diagram_revision(diagram_id, version):
+    """Makes an old version the diagram's current data (recorded as a new version)."""
+    try:
+        user_id = db_ops._get_user_id_from_session(session)
+        check_diagram_access(diagram_id, user_id, require_edit=True)
+        revision = revisions.materialize(diagram_id, version)
+        if revision is None:
+            return jsonify(error="Revision not found."), 404
+
+        query = f"""
+            UPDATE diagrams SET diagram_data = %s::jsonb, live_revision = NULL, updated_at = CURRENT_TIMESTAMP
+            WHERE diagram_id = %s
+            RETURNING {diagram_columns('diagrams')};
+        """
+        with db_ops.unit_of_work():
+            diagram = db_ops._execute(query, (json.dumps(revision['diagram_data']), diagram_id), fetchone=True, commit=True)
+            if not diagram: # Deleted concurrently
+                return jsonify(error="Diagram not found."), 404
+            # Editors in a live room get the restored code as an edit rather than losing it to the next flush
+            diagram.update(rooms.sequence_saved([diagram_id]).get(diagram_id, {}))
+        revisions.record_quietly(diagram_id, diagram['diagram_data'], user_id)
+        return jsonify(diagram), 200
+    except PermissionError as e:
+        return _permission_error_response(e)
+    except rooms.ResyncRequired:
+        return jsonify(error="The diagram is being edited live; reload it and restore again."), 409
+    except Exception as e:
+        log.exception("Failed to restore revision")
+        return jsonify(error=f"Failed to restore revision: {str(e)}"), 500
@@ -0,0 +1,481 @@
+import os
+import json
+import atexit
+import time
+import threading
+from collections import deque
+
+from backend.db_utils import execute_query, execute_values_query
+from backend.text_ops import validate_ops, apply_ops, transform, diff
+from backend import backplane, pubsub, revisions, metrics
+from backend.log import get_logger
+
+log = get_logger(__name__)
+
+# How many sequenced edits each room keeps in memory for rebasing late client edits, and
+# (roughly) how many are kept in diagram_ops behind the newest snapshot.
+ROOM_HISTORY_LIMIT = int(os.getenv("ROOM_HISTORY_LIMIT", "500"))
+# Every this many revisions the full text is stored and broadcast so clients can resync.
+ROOM_SNAPSHOT_INTERVAL = int(os.getenv("ROOM_SNAPSHOT_INTERVAL", "100"))
+# How long a room with no clients stays loaded before it is evicted.
+ROOM_IDLE_GRACE_SECONDS = float(os.getenv("ROOM_IDLE_GRACE_SECONDS", "30"))
+# How often edits of live rooms are written back to diagrams.diagram_data.
+ROOM_FLUSH_INTERVAL = float(os.getenv("ROOM_FLUSH_INTERVAL", "2"))
+# Minimum seconds between revision history entries recorded from a live room.
+ROOM_REVISION_INTERVAL = float(os.getenv("ROOM_REVISION_INTERVAL", "60"))
+# Attempts at claiming a revision before the sender is told to resync instead.
+SEQUENCE_RETRIES = 5
+
+# Coalescing key for snapshot frames: a newer snapshot supersedes any still queued.
+SNAPSHOT = 'snapshot'
+
+
+class ResyncRequired(Exception):
+    """The client's edit cannot be rebased onto the current revision; it must reload the snapshot."""
+
+
+def op_frame(rev, ops):
+    return json.dumps({'type': 'op', 'rev': rev, 'ops': ops})
+
+
+class Room:
+    """
+    The live document of one diagram on this worker: text, revision and recent history.
+
+    Revisions are global, not per worker. An edit gets revision N by inserting row N into
+    diagram_ops; if another worker already inserted it, this room catches up from the table,
+    rebases the edit again and retries. Edits sequenced elsewhere arrive through the backplane.
+    `broadcast(message, sender=None, coalesce_key=None)` queues a frame for local clients.
+    All state is guarded by `lock`. Messages from the backplane wait in `inbox` and are
+    applied off the listener thread, since taking the lock can mean waiting on a database
+    round trip.
+    """
+    def __init__(self, diagram_id, broadcast, origin=None):
+        self.diagram_id = diagram_id
+        self.origin = origin  # Backplane origin of the edits it sequences; this worker's by default
+        self.text = None
+        self.rev = None
+        self.history = deque(maxlen=ROOM_HISTORY_LIMIT)  # (rev, ops), oldest first
+        self.lock = threading.RLock()
+        self.persisted_rev = None  # Revision last written to diagrams.diagram_data
+        self.loaded_code_md5 = None  # Of the stored code, if it had no live_revision when loaded
+        self.revision_pending = False  # Written to diagrams but not yet recorded as a revision
+        self.revision_recorded_at = 0.0
+        self.refs = 0  # Sockets using the room; guarded by the registry lock
+        self.idle_since = None  # When the last socket left, while awaiting eviction
+        self._broadcast = broadcast
+        self.inbox = pubsub.Mailbox(self._apply_remote, f"room-{diagram_id}")
+
+    @property
+    def loaded(self):
+        return self.rev is not None
+
+    def snapshot_frame(self, resync=False, seq=None):
+        frame = {'type': 'snapshot', 'rev': self.rev, 'text': self.text}
+        if resync:
+            frame['resync'] = True
+            if seq is not None:
+                frame['seq'] = seq
+        return json.dumps(frame)
+
+    def _fetch_state(self):
+        """Rows from the newest snapshot onwards."""
+        return execute_query(
+            """
+            SELECT revision, ops, snapshot, created_at FROM diagram_ops
+            WHERE diagram_id = %s AND revision >= COALESCE(
+                (SELECT max(revision) FROM diagram_ops WHERE diagram_id = %s AND snapshot IS NOT NULL), 0)
+            ORDER BY revision;
+            """,
+            (self.diagram_id, self.diagram_id), fetchall=True
+        ) or []
+
+    def _load_rows(self, rows):
+        self.history.clear()
+        self.text, self.rev = rows[0]['snapshot'], rows[0]['revision']
+        for row in rows[1:]:
+            ops = json.loads(row['ops'])
+            self.text = apply_ops(self.text, ops)
+            self.rev = row['revision']
+            self.history.append((self.rev, ops))
+
+    def load(self):
+        """
+        Loads the room, once, from the diagram's stored code and its diagram_ops history.
+        A diagram without history is seeded from its code, at the revision that code was
+        flushed from so revisions never go backwards; code saved through the REST API after
+        the last edit is sequenced on top as a new revision. Raises LookupError if the
+        diagram does not exist.
+        """
+        with self.lock:
+            if self.loaded:
+                return
+            rows = execute_query(
+                """
+                SELECT COALESCE(d.diagram_data->>'code', '') AS code, d.updated_at, d.live_revision,
+                       md5(COALESCE(d.diagram_data->>'code', '')) AS code_md5,
+                       o.revision, o.ops, o.snapshot, o.created_at
+                FROM diagrams d
+                LEFT JOIN LATERAL (
+                    SELECT revision, ops, snapshot, created_at FROM diagram_ops
+                    WHERE diagram_id = d.diagram_id AND revision >= COALESCE(
+                        (SELECT max(revision) FROM diagram_ops
+                         WHERE diagram_id = d.diagram_id AND snapshot IS NOT NULL), 0)
+                ) o ON true
+                WHERE d.diagram_id = %s
+                ORDER BY o.revision;
+                """,
+                (self.diagram_id,), fetchall=True
+            )
+            if not rows:
+                raise LookupError(f"Diagram {self.diagram_id} not found")
+            stored = rows[0]
+            if stored['revision'] is None:
+                execute_query(
+                    """
+                    INSERT INTO diagram_ops (diagram_id, revision, snapshot, origin) VALUES (%s, %s, %s, %s)
+                    ON CONFLICT (diagram_id, revision) DO NOTHING;
+                    """,
+                    (self.diagram_id, stored['live_revision'] or 0, stored['code'], backplane.worker_id()),
+                    commit=True
+                )
+                rows = self._fetch_state()  # Another worker may have seeded it first
+            self._load_rows(rows)
+            if stored['live_revision'] is None:
+                self.loaded_code_md5 = stored['code_md5']
+            # Nothing to write back unless the history is ahead of the stored code
+            self.persisted_rev = self.rev if stored['code'] == self.text else (stored['live_revision'] or -1)
+            if stored['revision'] is not None and stored['live_revision'] is None \
+                    and stored['updated_at'] > rows[-1]['created_at'] and stored['code'] != self.text:
+                try:
+                    self._sequence(diff(self.text, stored['code']))
+                except ResyncRequired as e:
+                    log.warning("Could not bring room up to date with its saved code", diagram_id=self.diagram_id, reason=str(e))
+
+    def _apply(self, rev, ops, frame=None, sender=None):
+        """Applies an edit sequenced as `rev` and queues it for local clients other than `sender`."""
+        self.text = apply_ops(self.text, ops)
+        self.rev = rev
+        self.history.append((rev, ops))
+        self._broadcast(frame or op_frame(rev, ops), sender)
+        if rev % ROOM_SNAPSHOT_INTERVAL == 0:
+            self._broadcast(self.snapshot_frame(), None, SNAPSHOT)
+
+    def _catch_up(self, sender=None):
+        """
+        Applies the revisions other workers sequenced that we have not seen yet.
+        Returns their ops in order, or None if they were already purged and the room was
+        reloaded from a snapshot instead (local clients other than `sender` are resynced).
+        """
+        rows = execute_query(
+            "SELECT revision, ops FROM diagram_ops WHERE diagram_id = %s AND revision > %s ORDER BY revision;",
+            (self.diagram_id, self.rev), fetchall=True
+        ) or []
+        if rows and rows[0]['revision'] != self.rev + 1:
+            log.info("Room fell behind purged history; reloading snapshot", diagram_id=self.diagram_id, rev=self.rev)
+            self._load_rows(self._fetch_state())
+            self._broadcast(self.snapshot_frame(resync=True), sender)
+            return None
+        caught_up = []
+        for row in rows:
+            ops = json.loads(row['ops'])
+            self._apply(row['revision'], ops)
+            caught_up.append(ops)
+        return caught_up
+
+    def _claim(self, rev, ops, frame, snapshot):
+        """Tries to sequence `ops` as `rev`, notifying the other workers in the same statement."""
+        payload = backplane.envelope(frame, self.origin)
+        if payload is None:  # Too big for NOTIFY: receivers fetch it from diagram_ops
+            payload = backplane.envelope(json.dumps({'type': 'op', 'rev': rev, 'ref': True}), self.origin)
+        row = execute_query(
+            """
+            WITH claimed AS (
+                INSERT INTO diagram_ops (diagram_id, revision, ops, snapshot, origin)
+                VALUES (%s, %s, %s, %s, %s)
+                ON CONFLICT (diagram_id, revision) DO NOTHING
+                RETURNING revision
+            )
+            SELECT revision, pg_notify(%s, %s) FROM claimed;
+            """,
+            (self.diagram_id, rev, json.dumps(ops), snapshot, self.origin or backplane.worker_id(),
+             backplane.channel_for(self.diagram_id), payload),
+            fetchone=True, commit=True
+        )
+        return row is not None
+
+    def _purge(self, snapshot_rev):
+        execute_query(
+            "DELETE FROM diagram_ops WHERE diagram_id = %s AND revision < %s;",
+            (self.diagram_id, snapshot_rev - ROOM_HISTORY_LIMIT), commit=True
+        )
+
+    def submit(self, ops, base_rev, sender, seq=None):
+        """
+        Sequences a client edit made against `base_rev`: rebases it over the revisions the
+        client had not seen, claims the next revision, acks `sender` and broadcasts it.
+        Returns the new revision. Raises ValueError for malformed ops and ResyncRequired when
+        the edit can no longer be rebased.
+        """
+        validate_ops(ops)
+        with self.lock:
+            if not isinstance(base_rev, int) or base_rev > self.rev:
+                raise ResyncRequired(f"Unknown base revision {base_rev!r}")
+            if base_rev < self.rev:
+                if not self.history or self.history[0][0] > base_rev + 1:
+                    raise ResyncRequired(f"Base revision {base_rev} is too old to rebase")
+                for rev, concurrent in self.history:
+                    if rev > base_rev:
+                        ops, _ = transform(ops, concurrent)
+
+            return self._sequence(ops, sender, seq)
+
+    def _sequence(self, ops, sender=None, seq=None):
+        """Claims the next revision for `ops` (already rebased onto self.rev), retrying on conflict."""
+        for _ in range(SEQUENCE_RETRIES):
+            try:
+                new_text = apply_ops(self.text, ops)
+            except ValueError as e:
+                raise ResyncRequired(str(e))
+            rev = self.rev + 1
+            frame = op_frame(rev, ops)
+            snapshot = new_text if rev % ROOM_SNAPSHOT_INTERVAL == 0 else None
+            if self._claim(rev, ops, frame, snapshot):
+                metrics.inc('room_edits_sequenced_total')
+                self._apply(rev, ops, frame, sender)
+                if sender is not None:
+                    sender.enqueue(json.dumps({'type': 'ack', 'rev': rev, 'seq': seq}))
+                if snapshot is not None:
+                    self._purge(rev)
+                return rev
+            # Another worker sequenced this revision first
+            concurrent_edits = self._catch_up(sender)
+            if concurrent_edits is None:
+                raise ResyncRequired("Room was reloaded from a snapshot")
+            for concurrent in concurrent_edits:
+                ops, _ = transform(ops, concurrent)
+        raise ResyncRequired(f"Could not sequence edit after {SEQUENCE_RETRIES} attempts")
+
+    def on_remote(self, message):
+        """Backplane handler: queues an edit sequenced by another worker (None: check for missed ones)."""
+        self.inbox.put(message)
+
+    def _apply_remote(self, message):
+        with self.lock:
+            if not self.loaded:
+                return  # load() reads whatever was committed before it
+            if message is None:
+                self._catch_up()
+                return
+            try:
+                frame = json.loads(message)
+            except ValueError:
+                log.warning("Ignoring malformed room message", diagram_id=self.diagram_id, payload=message)
+                return
+            if frame.get('type') != 'op' or not isinstance(frame.get('rev'), int) or frame['rev'] <= self.rev:
+                return
+            if frame['rev'] == self.rev + 1 and 'ops' in frame:
+                self._apply(frame['rev'], frame['ops'], message)
+            else:  # Missed a revision, or the edit was too large to inline
+                self._catch_up()
+
+
+def sequence_saved(diagram_ids):
+    """
+    Brings live diagrams in line with code just saved through the REST API (an update, a batch
+    or a revision restore). Call it after writing diagram_data, in the same unit of work.
+
+    For each diagram with live history, the saved code is sequenced as the next revision, and
+    every worker's room (this one's included) applies it like any remote edit. The row is then
+    marked with that revision, so no room can flush older text over the save. A live edit that
+    wins the race is merged in, and the row stores the merged text. Diagrams without history
+    are left alone; their room sequences the saved code when it loads.
+
+    Returns {diagram_id: {'diagram_data', 'updated_at'}} for the rows it
+    rewrote. Raises ResyncRequired if live edits keep winning the race.
+    """
+    saved = execute_query(
+        """
+        SELECT d.diagram_id, COALESCE(d.diagram_data->>'code', '') AS code FROM diagrams d
+        WHERE d.diagram_id = ANY(%s) AND EXISTS (SELECT 1 FROM diagram_ops o WHERE o.diagram_id = d.diagram_id);
+        """,
+        (list(diagram_ids),), fetchall=True, primary=True
+    ) or []
+    sequenced = []
+    for row in saved:
+        # A scratch copy of the room: its edit reaches the loaded ones through the backplane
+        room = Room(row['diagram_id'], lambda *args: None, origin=f"{backplane.worker_id()}:api")
+        room._load_rows(room._fetch_state())
+        ops = diff(room.text, row['code'])
+        if ops:
+            room._sequence(ops)
+        sequenced.append((room.diagram_id, room.rev, room.text))
+    if not sequenced:
+        return {}
+    rows = execute_values_query(
+        """
+        UPDATE diagrams AS d
+        SET diagram_data = jsonb_set(
+                CASE WHEN jsonb_typeof(d.diagram_data) = 'object' THEN d.diagram_data ELSE '{}'::jsonb END,
+                '{code}', to_jsonb(v.code)),
+            live_revision = v.revision
+        FROM (VALUES %s) AS v(diagram_id, revision, code)
+        WHERE d.diagram_id = v.diagram_id
+        RETURNING d.diagram_id, d.diagram_data, d.updated_at;
+        """,
+        sequenced, fetch=True
+    )
+    return {row.pop('diagram_id'): row for row in rows}
+
+
+_rooms = {}  # diagram_id -> Room
+_rooms_lock = threading.Lock()
+
+metrics.describe('room_edits_sequenced_total', 'counter', "Real-time edits sequenced by this worker.")
+metrics.register_gauge('rooms_loaded', "Diagram rooms held in memory, including idle ones awaiting eviction.",
+                       lambda: len(_rooms))
+
+
+def acquire(diagram_id, broadcast):
+    """Returns the room for `diagram_id`, creating it (and joining the backplane) if needed."""
+    _ensure_flusher()
+    with _rooms_lock:
+        room = _rooms.get(diagram_id)
+        if room is None:
+            room = _rooms[diagram_id] = Room(diagram_id, broadcast)
+            # join/leave only queue LISTEN/UNLISTEN, so they are cheap enough to run under the lock
+            try:
+                backplane.join(diagram_id, room.on_remote)
+            except Exception as e:
+                log.error("Could not join backplane; edits from other workers will arrive on catch-up only",
+                          diagram_id=diagram_id, error=str(e))
+        room.refs += 1
+        room.idle_since = None
+        return room
+
+
+def release(diagram_id):
+    """
+    Drops a socket's reference to the room. The last one out flushes it and leaves it idle:
+    it stays loaded (and follows the other workers) for ROOM_IDLE_GRACE_SECONDS in case
+    someone reconnects, and is evicted after that.
+    """
+    with _rooms_lock:
+        room = _rooms.get(diagram_id)
+        if room is None:
+            return
+        room.refs -= 1
+        if room.refs > 0:
+            return
+        if not room.loaded:  # Nothing worth keeping
+            _evict_locked(room)
+            return
+        room.idle_since = idle_since = time.monotonic()
+    _flush_quietly([room])
+    timer = threading.Timer(ROOM_IDLE_GRACE_SECONDS, _evict_if_idle, args=(room, idle_since))
+    timer.daemon = True
+    timer.start()
+
+
+def _evict_locked(room):
+    del _rooms[room.diagram_id]
+    backplane.leave(room.diagram_id)
+
+
+def _evict_if_idle(room, idle_since):
+    with _rooms_lock:
+        # Rejoined (and maybe left again) since this timer was set: a later timer owns it
+        if _rooms.get(room.diagram_id) is not room or room.idle_since != idle_since:
+            return
+    _flush_quietly([room])  # In case the flush on leave failed
+    with _rooms_lock:
+        if _rooms.get(room.diagram_id) is room and room.idle_since == idle_since:
+            _evict_locked(room)
+
+
+def flush(rooms_to_flush=None, final=False):
+    """
+    Writes the text of every dirty room (all of this worker's by default) to
+    diagrams.diagram_data, in one transaction. Each worker following a room flushes it;
+    live_revision makes the writes of the ones that are behind no-ops. A row without a
+    live_revision is only written while its code is still the one the room loaded, never
+    over a save that cleared it since.
+    Rooms this worker wrote are then recorded in the revision history, at most every
+    ROOM_REVISION_INTERVAL seconds while clients are connected (always if `final`).
+    Returns the number of rooms written.
+    """
+    if rooms_to_flush is None:
+        with _rooms_lock:
+            rooms_to_flush = list(_rooms.values())
+    batch = {}
+    for room in rooms_to_flush:
+        with room.lock:
+            if room.loaded and room.rev > room.persisted_rev:
+                batch[room.diagram_id] = (room, room.rev, room.text, room.loaded_code_md5)
+    written = []
+    if batch:
+        written = execute_values_query(
+            """
+            UPDATE diagrams AS d
+            SET diagram_data = jsonb_set(
+                    CASE WHEN jsonb_typeof(d.diagram_data) = 'object' THEN d.diagram_data ELSE '{}'::jsonb END,
+                    '{code}', to_jsonb(v.code)),
+                live_revision = v.revision
+            FROM (VALUES %s) AS v(diagram_id, revision, code, loaded_code_md5)
+            WHERE d.diagram_id = v.diagram_id AND (d.live_revision < v.revision OR (
+                d.live_revision IS NULL AND md5(COALESCE(d.diagram_data->>'code', '')) = v.loaded_code_md5))
+            RETURNING d.diagram_id;
+            """,
+            [(diagram_id, rev, text, code_md5) for diagram_id, (_, rev, text, code_md5) in batch.items()],
+            template="(%s, %s, %s, %s::text)", fetch=True, commit=True
+        )
+        for room, rev, _, _ in batch.values():
+            with room.lock:
+                room.persisted_rev = max(room.persisted_rev, rev)
+        for row in written:
+            batch[row['diagram_id']][0].revision_pending = True
+    _record_revisions(rooms_to_flush, final)
+    return len(written)
+
+
+def _record_revisions(rooms_to_record, final=False):
+    now = time.monotonic()
+    due = {room.diagram_id: room for room in rooms_to_record
+           if room.revision_pending and (final or room.refs <= 0 or
+                                         now - room.revision_recorded_at >= ROOM_REVISION_INTERVAL)}
+    if not due:
+        return
+    rows = execute_query("SELECT diagram_id, diagram_data FROM diagrams WHERE diagram_id = ANY(%s);",
+                         (list(due),), fetchall=True) or []
+    for row in rows:
+        revisions.record_quietly(row['diagram_id'], row['diagram_data'])
+    for room in due.values():
+        room.revision_pending = False
+        room.revision_recorded_at = now
+
+
+def _flush_quietly(rooms_to_flush=None, final=False):
+    try:
+        flush(rooms_to_flush, final)
+    except Exception:
+        log.exception("Error flushing live diagrams")
+
+
+def _run_flusher():
+    while True:
+        time.sleep(ROOM_FLUSH_INTERVAL)
+        _flush_quietly()
+
+
+_flusher_pid = None
+
+
+def _ensure_flusher():
+    """Starts this worker's periodic flush thread, and the flush at shutdown, once per process."""
+    global _flusher_pid
+    with _rooms_lock:
+        if _flusher_pid == os.getpid():
+            return
+        _flusher_pid = os.getpid()
+    threading.Thread(target=_run_flusher, name="room-flusher", daemon=True).start()
+    atexit.register(_flush_quietly, None, True)
@@ -0,0 +1,114 @@
+import json
+import base64
+from flask import Blueprint, request, jsonify, session
+from backend.db_utils import BaseDBOperations
+from backend.auth import login_required # Import the shared decorator
+from backend.log import get_logger
+
+search_bp = Blueprint('search_api', __name__)
+db_ops = BaseDBOperations()
+log = get_logger(__name__)
+
+DEFAULT_SEARCH_LIMIT = 20
+MAX_SEARCH_LIMIT = 100
+MAX_QUERY_LENGTH = 200
+
+# Ranks full-text hits (name weighted above source) and adds trigram word similarity, so
+# substrings and typos still match. The accessible projects are those of
+# projects_api.get_projects: owned by the user or shared with them. The inner query only
+# touches the search indexes; snippets are built for the returned page alone.
+SEARCH_QUERY = """
+    WITH accessible AS (
+        SELECT p.project_id, p.project_name FROM projects p WHERE p.user_id = %(user_id)s
+        UNION
+        SELECT p.project_id, p.project_name
+        FROM projects p
+        JOIN sharing_permissions sp ON p.project_id = sp.project_id
+        WHERE sp.user_id = %(user_id)s
+    ), terms AS (
+        SELECT websearch_to_tsquery('simple', %(q)s) AS tsq, lower(%(q)s) AS needle
+    )
+    SELECT page.diagram_id, page.diagram_name, page.project_id, page.project_name, page.updated_at, page.rank,
+           ts_headline('simple', COALESCE(d.diagram_data->>'code', ''), terms.tsq,
+                       'MaxFragments=1, MaxWords=12, MinWords=3') AS snippet
+    FROM (
+        SELECT * FROM (
+            SELECT d.diagram_id, d.diagram_name, d.project_id, a.project_name, d.updated_at,
+                   (ts_rank_cd(d.search_vector, t.tsq) + word_similarity(t.needle, d.search_text))::float8 AS rank
+            FROM terms t
+            CROSS JOIN diagrams d
+            JOIN accessible a ON a.project_id = d.project_id
+            WHERE d.search_vector @@ t.tsq
+               OR d.search_text LIKE %(pattern)s
+               OR t.needle <%% d.search_text
+        ) ranked
+        WHERE %(after_rank)s::float8 IS NULL OR (ranked.rank, ranked.diagram_id) < (%(after_rank)s, %(after_id)s)
+        ORDER BY ranked.rank DESC, ranked.diagram_id DESC
+        LIMIT %(limit)s
+    ) page
+    JOIN diagrams d ON d.diagram_id = page.diagram_id
+    CROSS JOIN terms
+    ORDER BY page.rank DESC, page.diagram_id DESC;
+"""
+
+def encode_search_cursor(result):
+    """Opaque keyset cursor pointing just past `result` in (rank, diagram_id) DESC order."""
+    raw = json.dumps([result['rank'], result['diagram_id']])
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+def decode_search_cursor(cursor):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        rank, diagram_id = json.loads(raw)
+        return float(rank), int(diagram_id)
+    except (ValueError, TypeError):
+        raise ValueError("Invalid cursor.")
+
+def like_pattern(text):
+    """LIKE pattern matching `text` anywhere, with its wildcards escaped."""
+    escaped = text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    return f"%{escaped}%"
+
+@search_bp.route('/search', methods=['GET'])
+@login_required
+def search_diagrams():
+    """
+    Searches the names and Mermaid source of every diagram the user can see.
+    ?q= (required), ?limit= (default 20) and ?cursor= to page.
+    Responds with {"results": [...], "next_cursor": <str or null>}, best matches first.
+    """
+    q = request.args.get('q', '').strip()
+    if not q:
+        return jsonify(error="Search query (q) is required."), 400
+    if len(q) > MAX_QUERY_LENGTH:
+        return jsonify(error=f"Search query must be at most {MAX_QUERY_LENGTH} characters."), 400
+    try:
+        limit = int(request.args.get('limit', DEFAULT_SEARCH_LIMIT))
+    except ValueError:
+        return jsonify(error="limit must be an integer."), 400
+    if not 1 <= limit <= MAX_SEARCH_LIMIT:
+        return jsonify(error=f"limit must be between 1 and {MAX_SEARCH_LIMIT}."), 400
+    after_rank = after_id = None
+    if 'cursor' in request.args:
+        try:
+            after_rank, after_id = decode_search_cursor(request.args['cursor'])
+        except ValueError as e:
+            return jsonify(error=str(e)), 400
+
+    try:
+        user_id = db_ops._get_user_id_from_session(session)
+        params = {
+            'user_id': user_id, 'q': q, 'pattern': like_pattern(q.lower()),
+            'after_rank': after_rank, 'after_id': after_id, 'limit': limit + 1,
+        }
+        results = db_ops._execute(SEARCH_QUERY, params, fetchall=True)
+        next_cursor = None
+        if len(results) > limit:
+            results = results[:limit]
+            next_cursor = encode_search_cursor(results[-1])
+        return jsonify(results=results, next_cursor=next_cursor), 200
+    except PermissionError as e:
+        return jsonify(error=str(e)), 401
+    except Exception as e:
+        log.exception("Failed to search diagrams")
+        return jsonify(error=f"Failed to search diagrams: {str(e)}"), 500
@@ -1,17 +1,19 @@
 from flask import Blueprint, request, jsonify, session
 from backend.db_utils import BaseDBOperations
-from backend.app import login_required # Import the shared decorator
+from backend.auth import login_required # Import the shared decorator
+from backend.log import get_logger
+from backend import permission_cache, project_listing, http_cache
 
 sharing_bp = Blueprint('sharing_api', __name__)
 db_ops = BaseDBOperations()
+log = get_logger(__name__)
 
 # Helper function to check if the current user owns the project
 def check_project_ownership(project_id, current_user_id):
-    project_owner_query = "SELECT user_id FROM projects WHERE project_id = %s;"
-    project = db_ops._execute(project_owner_query, (project_id,), fetchone=True)
+    project = permission_cache.get_project_access(project_id, current_user_id)
     if not project:
         raise PermissionError("Project not found.") # 404
-    if project['user_id'] != current_user_id:
+    if project['owner_id'] != current_user_id:
         raise PermissionError("Only the project owner can manage sharing settings.") # 403
     return True
 
@@ -50,6 +52,8 @@ def add_collaborator(project_id):
             RETURNING permission_id, project_id, user_id, permission_level, created_at;
         """
         permission = db_ops._execute(query, (project_id, collaborator_user_id, permission_level), fetchone=True, commit=True)
+        permission_cache.invalidate(project_id, collaborator_user_id)
+        project_listing.bump_users([current_user_id, collaborator_user_id])
         return jsonify(permission), 201
     except PermissionError as e: # Catches session errors and ownership/project not found errors
         status_code = 401 if "User not authenticated" in str(e) or "invalid session" in str(e) \
@@ -58,6 +62,7 @@ def add_collaborator(project_id):
     except Exception as e:
         # Catch unique constraint violations if user is already a collaborator (handled by ON CONFLICT now)
         # or other DB errors
+        log.exception("Failed to add collaborator")
         return jsonify(error=f"Failed to add collaborator: {str(e)}"), 500
 
 @sharing_bp.route('/projects/<int:project_id>/sharing', methods=['GET'])
@@ -68,13 +73,7 @@ def get_shared_with_users(project_id):
         # Owner or anyone with access to the project can see who it's shared with
         # Using the check_project_access function from diagrams_api logic (or similar)
         # For simplicity here, we check if user can access the project first.
-        access_query = """
-            SELECT p.user_id AS owner_id, sp.permission_level
-            FROM projects p
-            LEFT JOIN sharing_permissions sp ON p.project_id = sp.project_id AND sp.user_id = %s
-            WHERE p.project_id = %s;
-        """
-        access_result = db_ops._execute(access_query, (current_user_id, project_id), fetchone=True)
+        access_result = permission_cache.get_project_access(project_id, current_user_id)
         if not access_result or (access_result['owner_id'] != current_user_id and not access_result['permission_level']):
              raise PermissionError("Access denied to project sharing information.")
 
@@ -86,12 +85,15 @@ def get_shared_with_users(project_id):
             WHERE sp.project_id = %s;
         """
         shared_users = db_ops._execute(query, (project_id,), fetchall=True)
-        return jsonify(shared_users), 200
+        shared_users.sort(key=lambda user: user['user_id'])
+        # Nothing here carries a modification time, so the ETag hashes the content
+        return http_cache.conditional_json(shared_users, http_cache.content_etag(shared_users))
     except PermissionError as e:
         status_code = 401 if "User not authenticated" in str(e) or "invalid session" in str(e) \
             else (404 if "Project not found" in str(e) else 403)
         return jsonify(error=str(e)), status_code
     except Exception as e:
+        log.exception("Failed to retrieve sharing information")
         return jsonify(error=f"Failed to retrieve sharing information: {str(e)}"), 500
 
 @sharing_bp.route('/projects/<int:project_id>/sharing/<int:shared_user_id>', methods=['PUT'])
@@ -122,12 +124,15 @@ def update_collaborator_permission(project_id, shared_user_id):
         updated_permission = db_ops._execute(query, (new_permission_level, project_id, shared_user_id), fetchone=True, commit=True)
         if not updated_permission:
             return jsonify(error="Collaborator not found for this project or no update was made."), 404
+        permission_cache.invalidate(project_id, shared_user_id)
+        project_listing.bump_users([current_user_id, shared_user_id]) # The collaborator's role changed
         return jsonify(updated_permission), 200
     except PermissionError as e:
         status_code = 401 if "User not authenticated" in str(e) or "invalid session" in str(e) \
             else (404 if "Project not found" in str(e) else 403)
         return jsonify(error=str(e)), status_code
     except Exception as e:
+        log.exception("Failed to update permission")
         return jsonify(error=f"Failed to update permission: {str(e)}"), 500
 
 @sharing_bp.route('/projects/<int:project_id>/sharing/<int:shared_user_id>', methods=['DELETE'])
@@ -135,29 +140,31 @@ def update_collaborator_permission(project_id, shared_user_id):
 def remove_collaborator(project_id, shared_user_id):
     try:
         current_user_id = db_ops._get_user_id_from_session(session)
-        check_project_ownership(project_id, current_user_id) # Only owner can remove collaborators
 
-        if shared_user_id == current_user_id:
-            return jsonify(error="Cannot remove yourself as a collaborator via this route."), 400
-        
-        # The _execute method needs to be able to return info about deletion success.
-        # Assuming it raises an error for failure or returns None/0 if nothing deleted.
-        # For psycopg2, cursor.rowcount gives number of rows affected.
-        delete_query = "DELETE FROM sharing_permissions WHERE project_id = %s AND user_id = %s;"
-        # We need to modify _execute or have a specific method in db_ops that returns rowcount for DELETE.
-        # For now, let's assume it works and if record not found, no error, but nothing happens.
-        # A better check would be to see if the permission existed first.
-        
-        # Check if permission exists
-        perm_exists = db_ops._execute("SELECT 1 FROM sharing_permissions WHERE project_id = %s AND user_id = %s", (project_id, shared_user_id), fetchone=True)
-        if not perm_exists:
-            return jsonify(error="Collaborator not found for this project."), 404
+        # RETURNING tells us whether a permission was actually removed, so the existence
+        # check and the delete are a single statement.
+        delete_query = """
+            DELETE FROM sharing_permissions WHERE project_id = %s AND user_id = %s
+            RETURNING permission_id;
+        """
+
+        # Ownership check and delete share one connection and transaction
+        with db_ops.unit_of_work():
+            check_project_ownership(project_id, current_user_id) # Only owner can remove collaborators
+
+            if shared_user_id == current_user_id:
+                return jsonify(error="Cannot remove yourself as a collaborator via this route."), 400
 
-        db_ops._execute(delete_query, (project_id, shared_user_id), commit=True)
+            removed = db_ops._execute(delete_query, (project_id, shared_user_id), fetchone=True, commit=True)
+            if not removed:
+                return jsonify(error="Collaborator not found for this project."), 404
+            permission_cache.invalidate(project_id, shared_user_id) # Other workers are notified on commit
+            project_listing.bump_users([current_user_id, shared_user_id]) # Commits with the delete
         return jsonify(message="Collaborator removed successfully."), 200
     except PermissionError as e:
         status_code = 401 if "User not authenticated" in str(e) or "invalid session" in str(e) \
             else (404 if "Project not found" in str(e) else 403)
         return jsonify(error=str(e)), status_code
     except Exception as e:
+        log.exception("Failed to remove collaborator")
         return jsonify(error=f"Failed to remove collaborator: {str(e)}"), 500
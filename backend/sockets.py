@@ -1,74 +1,296 @@
+import os
+import time
+import struct
+import threading
+import functools
+from collections import deque
+from flask import session
 from flask_sockets import Sockets
+from werkzeug.routing import Rule
 import json # Using json for message structure
+from backend.db_utils import execute_query
+from backend import rooms, text_ops, metrics, permission_cache
+from backend.log import get_logger, LOG_SAMPLE_RATE
+
+class WebSocketSockets(Sockets):
+    """Flask-Sockets whose routes are marked as websocket rules; Werkzeug 2+ won't match them otherwise."""
+    def add_url_rule(self, rule, _, f, **options):
+        self.url_map.add(Rule(rule, endpoint=f, websocket=True))
 
 # Initialize Flask-Sockets
-sockets = Sockets()
+sockets = WebSocketSockets()
+log = get_logger(__name__)
+
+# Outbound backpressure settings. A client whose queue is full, or whose oldest undelivered
+# message is older than the lag threshold, is disconnected instead of holding up its room.
+SOCKET_SEND_QUEUE_SIZE = int(os.getenv("SOCKET_SEND_QUEUE_SIZE", "64"))
+SOCKET_MAX_LAG_SECONDS = float(os.getenv("SOCKET_MAX_LAG_SECONDS", "10"))
+
+# Close code sent to clients dropped for falling behind (1013: try again later)
+CLOSE_CODE_SLOW_CONSUMER = 1013
+# Close code sent to clients that may not open the diagram (1008: policy violation)
+CLOSE_CODE_POLICY_VIOLATION = 1008
+
+def close_with_code(ws, code, reason=''):
+    """
+    Closes a gevent-websocket socket with a status code. Its own close() drops the code and
+    mangles a bytes message, so the close frame is written here and the socket marked closed.
+    """
+    try:
+        ws.send_frame(struct.pack('!H', code) + reason.encode('utf-8'), ws.OPCODE_CLOSE)
+    finally:
+        ws.closed = True
+
+def count_sent(message):
+    metrics.inc('socket_messages_sent_total')
+    metrics.inc('socket_bytes_sent_total', len(message) if isinstance(message, bytes) else len(message.encode('utf-8')))
+
+class ClientConnection:
+    """
+    A connected socket plus its bounded outbound queue.
+
+    Broadcasters only enqueue; a dedicated writer (a greenlet under gevent) drains the queue,
+    so one slow peer never delays the others or the sender's read loop. A message enqueued
+    with the same `coalesce_key` as a pending one replaces it in place, keeping the original
+    enqueue time so that lag keeps accumulating for a stalled client.
+    """
+    def __init__(self, ws, diagram_id):
+        self.ws = ws
+        self.diagram_id = diagram_id
+        self.can_edit = False  # Viewers get the snapshot and every edit, but may not send ops
+        self._queue = deque()  # [enqueued_at, coalesce_key, message]
+        self._in_flight_since = None  # Enqueue time of the message being sent, if any
+        self._cond = threading.Condition()
+        self._closed = False
+        self._start_writer()
+
+    def _start_writer(self):
+        self._writer = threading.Thread(target=self._drain, name=f"ws-writer-{self.diagram_id}", daemon=True)
+        self._writer.start()
+
+    def _wake_writer(self):
+        """Tells the writer the queue changed. Caller holds the condition's lock."""
+        self._cond.notify_all()
+
+    @property
+    def closed(self):
+        return self._closed or self.ws.closed
+
+    def lag(self):
+        """Seconds the oldest undelivered message has been waiting."""
+        oldest = self._in_flight_since if self._in_flight_since is not None else \
+            (self._queue[0][0] if self._queue else None)
+        return 0.0 if oldest is None else time.monotonic() - oldest
+
+    def enqueue(self, message, coalesce_key=None):
+        """Queues `message` for sending; returns False if the client is closed or was just dropped."""
+        with self._cond:
+            if self.closed:
+                return False
+            lag = self.lag()
+            if lag > SOCKET_MAX_LAG_SECONDS:
+                self._drop_locked(f"lagging {lag:.1f}s behind")
+                return False
+            if coalesce_key is not None:
+                for entry in self._queue:
+                    if entry[1] == coalesce_key:
+                        entry[2] = message
+                        return True
+            if len(self._queue) >= SOCKET_SEND_QUEUE_SIZE:
+                self._drop_locked(f"send queue full ({len(self._queue)} messages)")
+                return False
+            self._queue.append([time.monotonic(), coalesce_key, message])
+            self._wake_writer()
+        return True
+
+    def _drain(self):
+        while True:
+            with self._cond:
+                while not self._queue and not self._closed:
+                    self._cond.wait()
+                if self._closed:
+                    return
+                enqueued_at, _, message = self._queue.popleft()
+                self._in_flight_since = enqueued_at
+            try:
+                self.ws.send(message)
+                count_sent(message)
+            except Exception as e:
+                log.warning("Send failed, closing client", diagram_id=self.diagram_id, error=str(e))
+                self.close()
+                return
+            finally:
+                self._in_flight_since = None
+
+    def _drop_locked(self, reason):
+        """Disconnects a slow consumer. Caller holds the condition's lock."""
+        if self._closed:
+            return
+        self._stop_locked()
+        metrics.inc('socket_slow_consumers_total')
+        log.warning("Disconnecting slow client", diagram_id=self.diagram_id, reason=reason)
+        self._close_slow_socket()
+
+    def _close_slow_socket(self):
+        # Closing writes a close frame to the same stalled socket, so do it off the broadcaster's greenlet
+        threading.Thread(target=self._close_socket, daemon=True).start()
+
+    def _close_socket(self):
+        try:
+            close_with_code(self.ws, CLOSE_CODE_SLOW_CONSUMER)
+        except Exception:
+            pass
+
+    def _stop_locked(self):
+        self._closed = True
+        self._queue.clear()
+        self._wake_writer()
+
+    def close(self):
+        """Stops the writer and discards pending messages; the socket itself is left to its handler."""
+        with self._cond:
+            self._stop_locked()
+
 
 # Dictionary to store clients connected to each diagram.
-# Structure: { diagram_id_1: {client_ws_1, client_ws_2}, diagram_id_2: {client_ws_3} }
+# Structure: { diagram_id_1: {client_1, client_2}, diagram_id_2: {client_3} }
+# Each client is a ClientConnection wrapping the socket and its send queue.
 # Using a set for clients to automatically handle duplicates and efficient removal.
 diagram_clients = {}
 
+def broadcast_local(diagram_id, message, sender=None, coalesce_key=None):
+    """Queues `message` for every client of `diagram_id` connected to this worker, except `sender`."""
+    current_diagram_room = diagram_clients.get(diagram_id, set())
+    for client in list(current_diagram_room): # Iterate over a copy for safe removal
+        if client is sender:
+            continue
+        if not client.enqueue(message, coalesce_key):
+            # Closed or dropped as a slow consumer; its own handler finishes the cleanup
+            current_diagram_room.discard(client)
+
+metrics.register_gauge('socket_connections', "WebSocket clients connected to this worker, summed over workers.",
+                       lambda: sum(len(clients) for clients in list(diagram_clients.values())))
+metrics.register_gauge('socket_diagrams', "Diagrams with at least one connected client, summed over workers.",
+                       lambda: len(diagram_clients))
+
+def _parse_frame(message):
+    """
+    Client frames are JSON objects with a `type`:
+        {"type": "op", "base_rev": n, "ops": [...], "seq": n}  an edit made against revision base_rev
+        {"type": "resync"}                                 ask for the current snapshot
+        {"type": "join"}                                   ignored; the snapshot is sent on connect
+    Anything else is treated as the full Mermaid source, as sent by older clients.
+    """
+    try:
+        frame = json.loads(message)
+    except ValueError:
+        return None
+    return frame if isinstance(frame, dict) and 'type' in frame else None
+
+def _error_frame(message):
+    return json.dumps({'type': 'error', 'message': message})
+
+def socket_access(diagram_id, user):
+    """
+    What `user` (the session's user) may do on the diagram's socket: 'edit', 'view', or None
+    when they may not open it (not logged in, no access to its project, or no such diagram).
+    """
+    if not user or 'user_id' not in user:
+        return None
+    diagram = execute_query("SELECT project_id FROM diagrams WHERE diagram_id = %s;", (diagram_id,),
+                            fetchone=True, primary=True)
+    if not diagram:
+        return None
+    access = permission_cache.get_project_access(diagram['project_id'], user['user_id'])
+    if not access:
+        return None
+    if access['owner_id'] == user['user_id'] or access['permission_level'] in ('edit', 'admin'):
+        return 'edit'
+    return 'view' if access['permission_level'] else None
+
+def join_room(diagram_id, client):
+    """Registers `client` in the diagram's room and queues it the current snapshot; returns the room."""
+    room = rooms.acquire(diagram_id, functools.partial(broadcast_local, diagram_id))
+    try:
+        # Only the first client of a room on this worker waits for the database
+        room.load()
+        with room.lock:
+            # Registered under the room lock so no revision slips in between snapshot and first op
+            diagram_clients.setdefault(diagram_id, set()).add(client)
+            client.enqueue(room.snapshot_frame())
+    except Exception:
+        rooms.release(diagram_id)
+        raise
+    return room
+
+def handle_message(room, client, message):
+    """Applies one message received from `client`; replies (acks, snapshots, errors) go to its queue."""
+    frame = _parse_frame(message)
+    if not client.can_edit and (frame is None or frame['type'] == 'op'):
+        # The resync makes the client drop the rejected edit instead of waiting for its ack
+        client.enqueue(_error_frame("You do not have permission to edit this diagram."))
+        with room.lock:
+            client.enqueue(room.snapshot_frame(resync=True, seq=frame.get('seq') if frame else None))
+        return
+    try:
+        if frame is None:  # Legacy client: whole document, turned into an edit of the current revision
+            with room.lock:
+                ops = text_ops.diff(room.text, message)
+                if ops:
+                    room.submit(ops, room.rev, client)
+        elif frame['type'] == 'op':
+            room.submit(frame.get('ops'), frame.get('base_rev'), client, frame.get('seq'))
+        elif frame['type'] == 'join':
+            pass  # The snapshot was sent on connect
+        elif frame['type'] == 'resync':
+            with room.lock:
+                client.enqueue(room.snapshot_frame(resync=True))
+        else:
+            client.enqueue(_error_frame(f"Unknown message type {frame['type']!r}"))
+    except rooms.ResyncRequired as e:
+        log.info("Resyncing client", diagram_id=room.diagram_id, reason=str(e))
+        with room.lock:
+            client.enqueue(room.snapshot_frame(resync=True, seq=frame.get('seq') if frame else None))
+    except ValueError as e:
+        client.enqueue(_error_frame(str(e)))
+
+def leave_room(diagram_id, client, room=None):
+    """Stops `client` and drops it from the room; `room` is None if join_room never succeeded."""
+    client.close()
+    if diagram_id in diagram_clients:
+        diagram_clients[diagram_id].discard(client)
+        if not diagram_clients[diagram_id]: # If room is empty, delete it
+            del diagram_clients[diagram_id]
+    if room is not None:
+        rooms.release(diagram_id)
+    log.debug("Client disconnected", diagram_id=diagram_id, remaining=len(diagram_clients.get(diagram_id, ())))
+
 @sockets.route('/ws/diagram/<int:diagram_id>')
 def diagram_socket(ws, diagram_id):
     """Handles WebSocket connections for a specific diagram."""
-    # Check if user is authenticated via session (optional but good practice)
-    # from flask import session # Would need app context or pass session
-    # user = session.get('user')
-    # if not user:
-    #     ws.close(message="User not authenticated.")
-    #     return
-
-    print(f"Client connected to diagram {diagram_id}, ws: {ws}")
-    
-    # Add client to the set for this diagram_id
-    if diagram_id not in diagram_clients:
-        diagram_clients[diagram_id] = set()
-    diagram_clients[diagram_id].add(ws)
+    metrics.ensure_writer()  # Socket-only workers never see a Flask request
+    # Flask-Sockets runs this inside the upgrade request's context, so the session is available
+    access = socket_access(diagram_id, session.get('user'))
+    if access is None:
+        close_with_code(ws, CLOSE_CODE_POLICY_VIOLATION, "Not allowed to open this diagram.")
+        return
+    client = ClientConnection(ws, diagram_id)
+    client.can_edit = access == 'edit'
+    log.debug("Client connected", diagram_id=diagram_id)
+    room = None
 
     try:
+        room = join_room(diagram_id, client)
         while not ws.closed:
             # Receive message from client
             message = ws.receive()
             if message is None:  # Connection closed by client
-                print(f"Client sent None, closing connection for diagram {diagram_id}, ws: {ws}")
-                break 
-            
-            print(f"Message received for diagram {diagram_id} from {ws}: {message}")
-
-            # For this basic implementation, we expect the message to be the Mermaid code string.
-            # In a more advanced setup, messages might be JSON objects with type, payload, sender_id, etc.
-            # e.g., data = json.loads(message)
-            # mermaid_code = data.get('code')
-            # sender_id = data.get('sender_id') # Could be user_id or a unique ws id
-
-            # Broadcast the received message to all *other* clients in the same diagram room
-            current_diagram_room = diagram_clients.get(diagram_id, set())
-            for client_ws in list(current_diagram_room): # Iterate over a copy for safe removal
-                if client_ws != ws and not client_ws.closed:
-                    try:
-                        # Send the raw message received. If using JSON, send json.dumps(data)
-                        client_ws.send(message) 
-                        print(f"Message sent to client {client_ws} in diagram {diagram_id}")
-                    except Exception as e:
-                        print(f"Error sending message to client {client_ws} in diagram {diagram_id}: {e}. Removing client.")
-                        # If sending fails, assume client is disconnected and remove them
-                        diagram_clients[diagram_id].remove(client_ws)
-                        # ws.close() is handled by the client or gevent-websocket's internals mostly
-                elif client_ws.closed: # Clean up already closed sockets
-                    print(f"Removing already closed client {client_ws} from diagram {diagram_id}")
-                    if client_ws in diagram_clients.get(diagram_id, set()):
-                         diagram_clients[diagram_id].remove(client_ws)
-
-
-    except Exception as e:
-        # Log any errors that occur during the WebSocket handling
-        print(f"Error in WebSocket handler for diagram {diagram_id}, ws {ws}: {e}")
+                break
+            log.debug("Frame received", sample=LOG_SAMPLE_RATE, diagram_id=diagram_id, size=len(message), payload=message)
+            handle_message(room, client, message)
+
+    except Exception:
+        log.exception("Error in WebSocket handler", diagram_id=diagram_id)
     finally:
         # Ensure client is removed from the set when connection is closed or an error occurs
-        print(f"Client disconnected from diagram {diagram_id}, ws: {ws}. Removing from clients list.")
-        if diagram_id in diagram_clients and ws in diagram_clients[diagram_id]:
-            diagram_clients[diagram_id].remove(ws)
-            if not diagram_clients[diagram_id]: # If room is empty, delete it
-                del diagram_clients[diagram_id]
-        print(f"Current clients for diagram {diagram_id}: {diagram_clients.get(diagram_id)}")
+        leave_room(diagram_id, client, room)
@@ -0,0 +1,122 @@
+"""
+Text operations for the real-time diagram protocol.
+
+An edit is a list of primitive operations applied in order, with positions counted in
+Unicode code points:
+
+    {"p": 5, "i": "abc"}   insert "abc" before position 5
+    {"p": 5, "d": 3}       delete 3 characters starting at position 5
+
+frontend/socketService.js implements the same functions; keep the two in sync.
+"""
+
+MAX_OPS_PER_EDIT = 200
+
+
+def validate_ops(ops):
+    """Raises ValueError unless `ops` is a well-formed list of primitive operations."""
+    if not isinstance(ops, list) or len(ops) > MAX_OPS_PER_EDIT:
+        raise ValueError(f"ops must be a list of at most {MAX_OPS_PER_EDIT} operations.")
+    for op in ops:
+        if not isinstance(op, dict) or not isinstance(op.get('p'), int) or op['p'] < 0:
+            raise ValueError(f"Invalid operation: {op!r}")
+        if 'i' in op:
+            if not isinstance(op['i'], str) or 'd' in op:
+                raise ValueError(f"Invalid insert operation: {op!r}")
+        elif not isinstance(op.get('d'), int) or op['d'] <= 0:
+            raise ValueError(f"Invalid delete operation: {op!r}")
+    return ops
+
+
+def apply_ops(text, ops):
+    """Applies `ops` to `text`; raises ValueError if an operation falls outside the text."""
+    for op in ops:
+        pos = op['p']
+        if pos > len(text):
+            raise ValueError(f"Operation position {pos} is beyond the end of the text ({len(text)}).")
+        if 'i' in op:
+            text = text[:pos] + op['i'] + text[pos:]
+        else:
+            if pos + op['d'] > len(text):
+                raise ValueError(f"Delete of {op['d']} at {pos} runs past the end of the text ({len(text)}).")
+            text = text[:pos] + text[pos + op['d']:]
+    return text
+
+
+def diff(old, new):
+    """Smallest single-splice edit turning `old` into `new` (common prefix/suffix trimmed)."""
+    if old == new:
+        return []
+    limit = min(len(old), len(new))
+    start = 0
+    while start < limit and old[start] == new[start]:
+        start += 1
+    end_old, end_new = len(old), len(new)
+    while end_old > start and end_new > start and old[end_old - 1] == new[end_new - 1]:
+        end_old -= 1
+        end_new -= 1
+    ops = []
+    if end_old > start:
+        ops.append({'p': start, 'd': end_old - start})
+    if end_new > start:
+        ops.append({'p': start, 'i': new[start:end_new]})
+    return ops
+
+
+def _delete_after_delete(x, y):
+    """Delete `x` rewritten to apply after delete `y`; empty if `y` already removed it all."""
+    x_end, y_end = x['p'] + x['d'], y['p'] + y['d']
+    overlap = max(0, min(x_end, y_end) - max(x['p'], y['p']))
+    remaining = x['d'] - overlap
+    pos = x['p'] if x['p'] <= y['p'] else max(y['p'], x['p'] - y['d'])
+    return [{'p': pos, 'd': remaining}] if remaining > 0 else []
+
+
+def _insert_vs_delete(ins, dele):
+    """Transforms an insert against a concurrent delete; returns (ins', del')."""
+    length = len(ins['i'])
+    if ins['p'] <= dele['p']:
+        return [ins], [{'p': dele['p'] + length, 'd': dele['d']}]
+    if ins['p'] >= dele['p'] + dele['d']:
+        return [{'p': ins['p'] - dele['d'], 'i': ins['i']}], [dele]
+    # Insert lands inside the deleted range: keep the inserted text, delete around it
+    before = ins['p'] - dele['p']
+    return ([{'p': dele['p'], 'i': ins['i']}],
+            [{'p': dele['p'], 'd': before}, {'p': dele['p'] + length, 'd': dele['d'] - before}])
+
+
+def _transform_primitive(a, b):
+    """
+    Transforms concurrent primitives `a` and `b` against each other.
+    Returns (a', b'): a' applies after b, b' applies after a. `b` wins ties, i.e. when both
+    insert at the same position b's text ends up first.
+    """
+    if 'i' in a and 'i' in b:
+        if b['p'] <= a['p']:
+            return [{'p': a['p'] + len(b['i']), 'i': a['i']}], [b]
+        return [a], [{'p': b['p'] + len(a['i']), 'i': b['i']}]
+    if 'i' in a:
+        return _insert_vs_delete(a, b)
+    if 'i' in b:
+        b_prime, a_prime = _insert_vs_delete(b, a)
+        return a_prime, b_prime
+    return _delete_after_delete(a, b), _delete_after_delete(b, a)
+
+
+def transform(a_ops, b_ops):
+    """
+    Transforms two concurrent edits made against the same text.
+    Returns (a', b') with apply(apply(t, b), a') == apply(apply(t, a), b'). `b` is the edit
+    that was sequenced first and wins ties.
+    """
+    if not a_ops or not b_ops:
+        return list(a_ops), list(b_ops)
+    if len(a_ops) == 1 and len(b_ops) == 1:
+        return _transform_primitive(a_ops[0], b_ops[0])
+    if len(a_ops) > 1:
+        a_head, b_after_head = transform(a_ops[:1], b_ops)
+        a_tail, b_after_all = transform(a_ops[1:], b_after_head)
+        return a_head + a_tail, b_after_all
+    a_after_head, b_head = transform(a_ops, b_ops[:1])
+    a_after_all, b_tail = transform(a_after_head, b_ops[1:])
+    return a_after_all, b_head + b_tail
@@ -0,0 +1,392 @@
+"""
+Project export and import.
+
+An export is NDJSON, optionally inside a zip as `project.ndjson`. It has one record per line:
+
+    {"type": "project", "format": 1, "project_name": ..., "created_at": ...}
+    {"type": "sharing", "email": ..., "permission_level": ...}       (one per collaborator)
+    {"type": "diagram", "diagram_name": ..., "diagram_data": ..., "created_at": ..., "updated_at": ...}
+
+Both directions stream, so memory use does not grow with the size of the project. Exports
+read diagrams through a server-side cursor, in one REPEATABLE READ snapshot. Imports
+parse the upload line by line and insert in batches of IMPORT_BATCH_SIZE, all in one
+transaction.
+"""
+import os
+import json
+import zipfile
+import tempfile
+from datetime import datetime
+
+import psycopg2
+from psycopg2.extras import RealDictCursor
+from flask import Blueprint, Response, request, jsonify, session
+
+from backend.db_utils import BaseDBOperations, execute_values_query, get_db_connection, release_db_connection
+from backend.auth import login_required # Import the shared decorator
+from backend.diagrams_api import check_project_access
+from backend import permission_cache, project_listing, revisions
+from backend.log import get_logger
+
+transfer_bp = Blueprint('transfer_api', __name__)
+db_ops = BaseDBOperations()
+log = get_logger(__name__)
+
+EXPORT_FORMAT_VERSION = 1
+EXPORT_ENTRY_NAME = "project.ndjson"
+EXPORT_CURSOR_ITERSIZE = int(os.getenv("EXPORT_CURSOR_ITERSIZE", "200"))  # Diagrams fetched per round-trip
+EXPORT_CHUNK_BYTES = 64 * 1024  # Response chunks are at least this big, bar the last
+IMPORT_BATCH_SIZE = int(os.getenv("IMPORT_BATCH_SIZE", "500"))  # Diagrams per INSERT
+IMPORT_MAX_LINE_BYTES = int(os.getenv("IMPORT_MAX_LINE_BYTES", str(16 * 1024 * 1024)))
+IMPORT_SPOOL_MEMORY = 1024 * 1024  # Zip uploads larger than this are spooled to disk
+VALID_PERMISSIONS = ('view', 'edit')
+
+ZIP_MAGIC = b"PK\x03\x04"
+
+
+def _json_default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+
+def _line(record):
+    return json.dumps(record, default=_json_default, ensure_ascii=False).encode('utf-8') + b"\n"
+
+
+def _permission_error_response(e):
+    if "User not authenticated" in str(e) or "invalid session" in str(e):
+        return jsonify(error=str(e)), 401
+    elif "Project not found" in str(e):
+        return jsonify(error=str(e)), 404
+    return jsonify(error=str(e)), 403
+
+
+# --- Export ---
+
+def export_records(project_id):
+    """
+    Yields the export of a project as NDJSON lines (bytes). Uses its own pooled connection
+    for as long as the generator runs, and releases it when the generator finishes or is closed.
+    """
+    conn = get_db_connection()
+    discard = False
+    try:
+        with conn.cursor(cursor_factory=RealDictCursor) as cursor:
+            # One consistent snapshot for the project, its sharing and every diagram
+            cursor.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ READ ONLY;")
+            cursor.execute(
+                "SELECT project_name, created_at, updated_at FROM projects WHERE project_id = %s;",
+                (project_id,)
+            )
+            project = cursor.fetchone()
+            if not project:
+                return  # Deleted since the access check
+            yield _line({'type': 'project', 'format': EXPORT_FORMAT_VERSION, **project})
+
+            cursor.execute(
+                """
+                SELECT u.email, u.username, sp.permission_level
+                FROM sharing_permissions sp
+                JOIN users u ON u.user_id = sp.user_id
+                WHERE sp.project_id = %s
+                ORDER BY u.user_id;
+                """,
+                (project_id,)
+            )
+            for share in cursor.fetchall():
+                yield _line({'type': 'sharing', **share})
+
+        # Diagrams can be arbitrarily many and large, so they come through a named cursor
+        # that only holds EXPORT_CURSOR_ITERSIZE rows in memory at a time
+        with conn.cursor(name=f"export_project_{project_id}", cursor_factory=RealDictCursor) as diagrams:
+            diagrams.itersize = EXPORT_CURSOR_ITERSIZE
+            diagrams.execute(
+                """
+                SELECT diagram_name, diagram_data, created_at, updated_at
+                FROM diagrams WHERE project_id = %s
+                ORDER BY diagram_id;
+                """,
+                (project_id,)
+            )
+            for diagram in diagrams:
+                yield _line({'type': 'diagram', **diagram})
+    except psycopg2.Error as e:
+        discard = isinstance(e, (psycopg2.OperationalError, psycopg2.InterfaceError))
+        log.error("Error exporting project", project_id=project_id, error=str(e))
+        raise
+    finally:
+        if not discard:
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                discard = True
+        release_db_connection(conn, discard=discard)
+
+
+def _chunked(lines):
+    """Joins small lines into chunks of about EXPORT_CHUNK_BYTES."""
+    buffer, size = [], 0
+    for line in lines:
+        buffer.append(line)
+        size += len(line)
+        if size >= EXPORT_CHUNK_BYTES:
+            yield b"".join(buffer)
+            buffer, size = [], 0
+    if buffer:
+        yield b"".join(buffer)
+
+
+class _ChunkSink:
+    """Write-only, unseekable file object that zipfile writes into and the response drains."""
+    def __init__(self):
+        self.chunks = []
+        self.size = 0
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.size += len(data)
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b"".join(self.chunks)
+        self.chunks, self.size = [], 0
+        return data
+
+
+def _zipped(lines):
+    """Streams `lines` as the single entry of a zip archive."""
+    sink = _ChunkSink()
+    # On an unseekable file zipfile writes sizes in data descriptors after each entry,
+    # so nothing has to be buffered; zip64 because the size isn't known upfront
+    with zipfile.ZipFile(sink, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+        with archive.open(EXPORT_ENTRY_NAME, 'w', force_zip64=True) as entry:
+            for line in lines:
+                entry.write(line)
+                if sink.size >= EXPORT_CHUNK_BYTES:
+                    yield sink.drain()
+    yield sink.drain()
+
+
+@transfer_bp.route('/projects/<int:project_id>/export', methods=['GET'])
+@login_required
+def export_project(project_id):
+    """
+    Streams a project, its sharing settings and all of its diagrams.
+    ?format=ndjson (default) or ?format=zip.
+    """
+    export_format = request.args.get('format', 'ndjson')
+    if export_format not in ('ndjson', 'zip'):
+        return jsonify(error="format must be ndjson or zip."), 400
+    try:
+        user_id = db_ops._get_user_id_from_session(session)
+        check_project_access(project_id, user_id)
+    except PermissionError as e:
+        return _permission_error_response(e)
+    except Exception as e:
+        log.exception("Failed to export project")
+        return jsonify(error=f"Failed to export project: {str(e)}"), 500
+
+    lines = export_records(project_id)
+    if export_format == 'zip':
+        body, mimetype = _zipped(lines), 'application/zip'
+    else:
+        body, mimetype = _chunked(lines), 'application/x-ndjson'
+    response = Response(body, mimetype=mimetype)
+    response.headers['Content-Disposition'] = f'attachment; filename="project-{project_id}.{export_format}"'
+    response.headers['Cache-Control'] = "no-store"
+    return response
+
+
+# --- Import ---
+
+def _read_records(stream, first_line=None):
+    """Yields (line_number, record) from an NDJSON byte stream, one line in memory at a time."""
+    line_number = 0
+    while True:
+        if first_line is not None:
+            line, first_line = first_line, None
+        else:
+            line = stream.readline(IMPORT_MAX_LINE_BYTES + 1)
+        if not line:
+            return
+        line_number += 1
+        if len(line) > IMPORT_MAX_LINE_BYTES:
+            raise ValueError(f"Line {line_number} is longer than {IMPORT_MAX_LINE_BYTES} bytes.")
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError:
+            raise ValueError(f"Line {line_number} is not valid JSON.")
+        if not isinstance(record, dict):
+            raise ValueError(f"Line {line_number} is not a JSON object.")
+        yield line_number, record
+
+
+def _upload_records(stream):
+    """
+    Yields (line_number, record) from an upload that is either NDJSON or a zip export.
+    Zips need their central directory, which is at the end, so they are spooled first.
+    """
+    first_line = stream.readline(IMPORT_MAX_LINE_BYTES + 1)
+    if not first_line.startswith(ZIP_MAGIC):
+        yield from _read_records(stream, first_line)
+        return
+
+    with tempfile.SpooledTemporaryFile(max_size=IMPORT_SPOOL_MEMORY) as spool:
+        spool.write(first_line)
+        while True:
+            chunk = stream.read(EXPORT_CHUNK_BYTES)
+            if not chunk:
+                break
+            spool.write(chunk)
+        spool.seek(0)
+        try:
+            archive = zipfile.ZipFile(spool)
+        except zipfile.BadZipFile:
+            raise ValueError("Upload is not a valid zip archive.")
+        with archive:
+            if EXPORT_ENTRY_NAME not in archive.namelist():
+                raise ValueError(f"Zip archive has no {EXPORT_ENTRY_NAME}.")
+            with archive.open(EXPORT_ENTRY_NAME) as entry:
+                yield from _read_records(entry)
+
+
+class _ProjectImporter:
+    """Buffers imported records and writes them to a new project in batches."""
+    def __init__(self, user_id, project_id):
+        self.user_id = user_id
+        self.project_id = project_id
+        self.diagrams = []
+        self.diagram_data = []
+        self.shares = []
+        self.diagram_count = 0
+        self.shared_count = 0
+        self.skipped_shares = 0
+
+    def add_diagram(self, line_number, record):
+        if not record.get('diagram_name') or not isinstance(record['diagram_name'], str):
+            raise ValueError(f"Line {line_number}: diagram_name is required.")
+        diagram_data = record.get('diagram_data') or {}
+        self.diagrams.append((
+            record['diagram_name'], self.project_id, json.dumps(diagram_data),
+            record.get('created_at'), record.get('updated_at'),
+        ))
+        self.diagram_data.append(diagram_data)
+        if len(self.diagrams) >= IMPORT_BATCH_SIZE:
+            self.flush_diagrams()
+
+    def add_share(self, line_number, record):
+        if not record.get('email') or record.get('permission_level') not in VALID_PERMISSIONS:
+            raise ValueError(f"Line {line_number}: sharing needs an email and a permission_level among {list(VALID_PERMISSIONS)}.")
+        self.shares.append((record['email'], record['permission_level']))
+        if len(self.shares) >= IMPORT_BATCH_SIZE:
+            self.flush_shares()
+
+    def flush_diagrams(self):
+        if not self.diagrams:
+            return
+        created = execute_values_query(
+            """
+            INSERT INTO diagrams (diagram_name, project_id, diagram_data, created_at, updated_at)
+            VALUES %s
+            RETURNING diagram_id;
+            """,
+            self.diagrams,
+            template="(%s, %s, %s::jsonb, COALESCE(%s::timestamptz, CURRENT_TIMESTAMP), COALESCE(%s::timestamptz, CURRENT_TIMESTAMP))",
+            page_size=len(self.diagrams), fetch=True
+        )
+        # Each diagram starts its history at the imported data, in the same transaction
+        revisions.record_many(
+            [(row['diagram_id'], diagram_data) for row, diagram_data in zip(created, self.diagram_data)],
+            self.user_id
+        )
+        self.diagram_count += len(created)
+        self.diagrams, self.diagram_data = [], []
+
+    def flush_shares(self):
+        if not self.shares:
+            return
+        # Collaborators are matched by email; unknown users and the importer are skipped
+        shared = execute_values_query(
+            f"""
+            INSERT INTO sharing_permissions (project_id, user_id, permission_level)
+            SELECT {int(self.project_id)}, u.user_id, v.permission_level
+            FROM (VALUES %s) AS v(email, permission_level)
+            JOIN users u ON u.email = v.email
+            WHERE u.user_id <> {int(self.user_id)}
+            ON CONFLICT (project_id, user_id) DO NOTHING
+            RETURNING user_id;
+            """,
+            self.shares, template="(%s::text, %s::text)", page_size=len(self.shares), fetch=True
+        )
+        self.shared_count += len(shared)
+        self.skipped_shares += len(self.shares) - len(shared)
+        self.shares = []
+
+    def flush(self):
+        self.flush_shares()
+        self.flush_diagrams()
+
+
+@transfer_bp.route('/projects/import', methods=['POST'])
+@login_required
+def import_project():
+    """
+    Creates a new project, owned by the caller, from an export (NDJSON or zip) sent as the
+    request body or as a multipart `file`. ?project_name= overrides the exported name.
+    The import is all-or-nothing.
+    """
+    upload = request.files.get('file')
+    stream = upload.stream if upload else request.stream
+    try:
+        user_id = db_ops._get_user_id_from_session(session)
+        with db_ops.unit_of_work():
+            records = _upload_records(stream)
+            first = next(records, None)
+            if first is None:
+                raise ValueError("Upload is empty.")
+            line_number, header = first
+            if header.get('type') != 'project':
+                raise ValueError("Line 1 must be the project record.")
+            if header.get('format') != EXPORT_FORMAT_VERSION:
+                raise ValueError(f"Unsupported export format {header.get('format')!r}.")
+            project_name = request.args.get('project_name') or header.get('project_name')
+            if not project_name or not isinstance(project_name, str):
+                raise ValueError("Project name is required.")
+
+            project = db_ops._execute(
+                """
+                INSERT INTO projects (project_name, user_id)
+                VALUES (%s, %s) RETURNING project_id, project_name, user_id, created_at, updated_at;
+                """,
+                (project_name, user_id), fetchone=True
+            )
+            importer = _ProjectImporter(user_id, project['project_id'])
+            for line_number, record in records:
+                if record.get('type') == 'diagram':
+                    importer.add_diagram(line_number, record)
+                elif record.get('type') == 'sharing':
+                    importer.add_share(line_number, record)
+                else:
+                    raise ValueError(f"Line {line_number}: unknown record type {record.get('type')!r}.")
+            importer.flush()
+            project_listing.bump_projects([project['project_id']]) # Owner and imported collaborators
+        if importer.shared_count:
+            permission_cache.invalidate(project['project_id'])
+        return jsonify(project=project, diagrams_imported=importer.diagram_count,
+                       collaborators_imported=importer.shared_count,
+                       collaborators_skipped=importer.skipped_shares), 201
+    except ValueError as e:
+        return jsonify(error=str(e)), 400
+    except psycopg2.DataError as e: # e.g. a malformed timestamp in the upload
+        return jsonify(error=f"Invalid value in upload: {str(e).splitlines()[0]}"), 400
+    except PermissionError as e:
+        return jsonify(error=str(e)), 401
+    except Exception as e:
+        log.exception("Failed to import project")
+        return jsonify(error=f"Failed to import project: {str(e)}"), 500
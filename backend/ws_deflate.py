@@ -0,0 +1,219 @@
+"""
+permessage-deflate (RFC 7692) for the gevent WebSocket server.
+
+gevent-websocket implements no WebSocket extensions and rejects frames with RSV bits set.
+This module adds compression to it. Run gunicorn with this module's worker, or pass
+DeflateWebSocketHandler to pywsgi:
+
+    gunicorn -w 4 -k backend.ws_deflate.GeventWebSocketWorker backend.app:app
+
+Context takeover is on unless the client opts out. Both sides then keep their LZ77
+window from one message to the next, so a diagram frame that resembles a recent one
+compresses mostly into back-references, to a fraction of its size. Examples are the next
+edit to the same Mermaid text, or a resync after a snapshot.
+
+Frames go out at SOCKET_DEFLATE_LEVEL. Messages under SOCKET_DEFLATE_MIN_BYTES are sent
+as they are. The window is 2**SOCKET_DEFLATE_WINDOW_BITS bytes in both directions; 12
+(4 KB) is the `websockets` library's default too. Deflate state is created on the first
+message that needs it, so an idle editor socket carries none. The ASGI mode doesn't use
+this module: uvicorn negotiates permessage-deflate itself.
+
+Compression is counted in the socket_deflate_* metrics: bytes in, bytes out and CPU seconds.
+"""
+import os
+import time
+import zlib
+from socket import error as socket_error
+
+from geventwebsocket.handler import WebSocketHandler
+from geventwebsocket.websocket import WebSocket, Header, MSG_ALREADY_CLOSED, MSG_SOCKET_DEAD
+from geventwebsocket.exceptions import ProtocolError, WebSocketError
+
+from backend import metrics
+
+SOCKET_DEFLATE = os.getenv("SOCKET_DEFLATE", "1") == "1"
+SOCKET_DEFLATE_LEVEL = int(os.getenv("SOCKET_DEFLATE_LEVEL", "6"))  # 1-9
+SOCKET_DEFLATE_MIN_BYTES = int(os.getenv("SOCKET_DEFLATE_MIN_BYTES", "64"))
+SOCKET_DEFLATE_WINDOW_BITS = min(15, max(9, int(os.getenv("SOCKET_DEFLATE_WINDOW_BITS", "12"))))
+SOCKET_DEFLATE_MAX_MESSAGE_BYTES = int(os.getenv("SOCKET_DEFLATE_MAX_MESSAGE_BYTES", str(16 * 1024 * 1024)))  # Inflated size limit
+
+EXTENSION = 'permessage-deflate'
+_MEM_LEVEL = 5  # zlib's default is 8; 5 keeps the compressor near 16 KB at a small cost in ratio
+_TAIL = b'\x00\x00\xff\xff'  # Every sync-flushed block ends with it; RFC 7692 strips it from the wire
+# geventwebsocket counts the reserved bits from 0, so its RSV0_MASK is the spec's RSV1
+_RSV_COMPRESSED = Header.RSV0_MASK
+
+
+def negotiate(offers):
+    """
+    Picks the first permessage-deflate offer in a Sec-WebSocket-Extensions value that we can
+    accept. Returns (response header value, DeflateWebSocket settings), or None to decline.
+    """
+    for offer in offers.split(','):
+        name, *params = [part.strip() for part in offer.split(';')]
+        if name != EXTENSION:
+            continue
+        options = {}
+        for param in params:
+            key, _, value = param.partition('=')
+            options.setdefault(key.strip(), []).append(value.strip().strip('"'))
+        if any(len(values) > 1 for values in options.values()) or set(options) - {
+                'server_no_context_takeover', 'client_no_context_takeover',
+                'server_max_window_bits', 'client_max_window_bits'}:
+            continue
+        try:
+            server_bits = int(options['server_max_window_bits'][0]) if 'server_max_window_bits' in options else 15
+            client_value = options.get('client_max_window_bits', [''])[0]
+            client_bits = int(client_value) if client_value else 15
+        except ValueError:
+            continue
+        # zlib can't produce a raw deflate stream with an 8-bit window
+        if not (9 <= server_bits <= 15 and 8 <= client_bits <= 15):
+            continue
+
+        settings = {
+            'server_bits': min(server_bits, SOCKET_DEFLATE_WINDOW_BITS),
+            'client_bits': client_bits,
+            'server_no_takeover': 'server_no_context_takeover' in options,
+            'client_no_takeover': 'client_no_context_takeover' in options,
+        }
+        response = [EXTENSION]
+        if settings['server_no_takeover']:
+            response.append('server_no_context_takeover')
+        if settings['client_no_takeover']:
+            response.append('client_no_context_takeover')
+        if settings['server_bits'] < 15:
+            response.append(f"server_max_window_bits={settings['server_bits']}")
+        if 'client_max_window_bits' in options:  # Only an offer that has it lets us limit the client's window
+            settings['client_bits'] = min(client_bits, SOCKET_DEFLATE_WINDOW_BITS)
+            response.append(f"client_max_window_bits={settings['client_bits']}")
+        return "; ".join(response), settings
+    return None
+
+
+class DeflateWebSocket(WebSocket):
+    """geventwebsocket's WebSocket with the permessage-deflate settings agreed in the handshake."""
+    def __init__(self, environ, stream, handler, server_bits, client_bits, server_no_takeover, client_no_takeover):
+        super().__init__(environ, stream, handler)
+        self.server_bits = server_bits
+        self.client_bits = client_bits
+        self.server_no_takeover = server_no_takeover
+        self.client_no_takeover = client_no_takeover
+        self._deflater = None
+        self._inflater = None
+        self._inflating = False  # The message being read arrived compressed
+        self._inflated = 0
+
+    # --- Sending ---
+
+    def _deflate(self, data):
+        started = time.thread_time()
+        if self._deflater is None:
+            self._deflater = zlib.compressobj(SOCKET_DEFLATE_LEVEL, zlib.DEFLATED, -self.server_bits, _MEM_LEVEL)
+        payload = self._deflater.compress(data) + self._deflater.flush(zlib.Z_SYNC_FLUSH)
+        if self.server_no_takeover:
+            self._deflater = None
+        metrics.inc('socket_deflate_input_bytes_total', len(data))
+        metrics.inc('socket_deflate_output_bytes_total', len(payload) - len(_TAIL))
+        metrics.inc('socket_deflate_cpu_seconds_total', time.thread_time() - started)
+        return payload[:-len(_TAIL)]
+
+    def send_frame(self, message, opcode):
+        if opcode not in (self.OPCODE_TEXT, self.OPCODE_BINARY):
+            return super().send_frame(message, opcode)
+        if self.closed:
+            self.current_app.on_close(MSG_ALREADY_CLOSED)
+            raise WebSocketError(MSG_ALREADY_CLOSED)
+
+        data = self._encode_bytes(message) if opcode == self.OPCODE_TEXT else bytes(message)
+        flags = 0
+        # Once a message went through the compressor, the client's window depends on the rest
+        # being compressed too, so the size check only ever skips whole messages
+        if len(data) >= SOCKET_DEFLATE_MIN_BYTES:
+            data = self._deflate(data)
+            flags = _RSV_COMPRESSED
+        header = Header.encode_header(True, opcode, b'', len(data), flags)
+        try:
+            self.raw_write(header + data)
+        except socket_error:
+            raise WebSocketError(MSG_SOCKET_DEAD)
+
+    # --- Receiving ---
+
+    def _inflate(self, payload, fin):
+        if self._inflater is None:
+            self._inflater = zlib.decompressobj(-self.client_bits)
+        limit = SOCKET_DEFLATE_MAX_MESSAGE_BYTES - self._inflated
+        data = self._inflater.decompress(payload + (_TAIL if fin else b''), limit + 1)
+        self._inflated += len(data)
+        if self._inflated > SOCKET_DEFLATE_MAX_MESSAGE_BYTES:
+            raise ProtocolError("Message too large once decompressed")
+        if fin:
+            self._inflating = False
+            self._inflated = 0
+            if self.client_no_takeover:
+                self._inflater = None
+        return data
+
+    def read_frame(self):
+        # geventwebsocket's read_frame, except that RSV1 marks a compressed message
+        header = Header.decode_header(self.stream)
+        compressed = bool(header.flags & _RSV_COMPRESSED)
+        if header.flags & ~_RSV_COMPRESSED:
+            raise ProtocolError
+        if compressed and header.opcode not in (self.OPCODE_TEXT, self.OPCODE_BINARY):
+            raise ProtocolError("RSV1 is only valid on the first frame of a data message")
+        if header.opcode in (self.OPCODE_TEXT, self.OPCODE_BINARY):
+            self._inflating = compressed
+
+        payload = b''
+        if header.length:
+            try:
+                payload = self.raw_read(header.length)
+            except Exception:
+                payload = b''
+            if len(payload) != header.length:
+                raise WebSocketError('Unexpected EOF reading frame payload')
+            if header.mask:
+                payload = header.unmask_payload(payload)
+
+        if self._inflating and header.opcode in (self.OPCODE_TEXT, self.OPCODE_BINARY, self.OPCODE_CONTINUATION):
+            payload = self._inflate(bytes(payload), header.fin)
+            header.length = len(payload)
+        return header, payload
+
+
+class DeflateWebSocketHandler(WebSocketHandler):
+    """WebSocketHandler that accepts permessage-deflate when the client offers it."""
+    def start_response(self, status, headers, exc_info=None):
+        websocket = getattr(self, 'websocket', None)
+        if SOCKET_DEFLATE and str(status).startswith('101') and websocket is not None:
+            offers = self.environ.get('HTTP_SEC_WEBSOCKET_EXTENSIONS', '')
+            agreed = negotiate(offers)
+            if agreed is not None:
+                value, settings = agreed
+                headers = list(headers) + [('Sec-WebSocket-Extensions', value)]
+                # The replaced socket would send a close frame from __del__ on the shared stream
+                websocket.closed = True
+                self.websocket = DeflateWebSocket(self.environ, websocket.stream, self, **settings)
+                self.environ['wsgi.websocket'] = self.websocket
+            metrics.inc('socket_deflate_handshakes_total',
+                        result='accepted' if agreed else 'declined' if EXTENSION in offers else 'not_offered')
+        return super().start_response(status, headers, exc_info)
+
+
+try:
+    from gunicorn.workers.ggevent import GeventPyWSGIWorker
+except ImportError:  # Only needed to run under gunicorn
+    GeventPyWSGIWorker = None
+
+if GeventPyWSGIWorker is not None:
+    class GeventWebSocketWorker(GeventPyWSGIWorker):
+        """gunicorn's gevent worker serving WebSockets through DeflateWebSocketHandler."""
+        wsgi_handler = DeflateWebSocketHandler
+
+
+metrics.describe('socket_deflate_handshakes_total', 'counter', "WebSocket handshakes by permessage-deflate outcome: accepted, declined, or not_offered.")
+metrics.describe('socket_deflate_input_bytes_total', 'counter', "Bytes of WebSocket messages before compression.")
+metrics.describe('socket_deflate_output_bytes_total', 'counter', "Bytes of WebSocket messages after compression.")
+metrics.describe('socket_deflate_cpu_seconds_total', 'counter', "CPU time spent compressing WebSocket messages.")
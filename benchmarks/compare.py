@@ -0,0 +1,93 @@
+"""
+Compares two benchmark results written by run.py.
+
+    python benchmarks/compare.py results/before.json results/after.json [--threshold 10]
+
+Prints throughput and latency percentiles side by side, with the relative change, and
+exits with status 1 if any latency got worse (or throughput dropped) by more than
+--threshold percent, so it can gate a CI job.
+"""
+import sys
+import json
+import argparse
+
+LATENCY_KEYS = ('p50', 'p95', 'p99')
+ROOM_LATENCIES = ('ack_latency_ms', 'fanout_delay_ms')
+
+
+def _rows(results):
+    """(name, metric, value, higher_is_better) for every comparable number in a result set."""
+    for name, result in sorted(results.items()):
+        if name == 'rooms':
+            yield name, 'edits_per_second', result['edits_per_second'], True
+            for group in ROOM_LATENCIES:
+                for key in LATENCY_KEYS:
+                    yield name, f"{group}.{key}", (result[group] or {}).get(key), False
+            continue
+        if name == 'idle_sockets':
+            yield name, 'connected', result['connected'], True
+            yield name, 'connects_per_second', result['connects_per_second'], True
+            yield name, 'server_memory_per_socket_bytes', result['server_memory_per_socket_bytes'], False
+            for key in LATENCY_KEYS:
+                yield name, f"probe_latency_ms.{key}", (result['probe_latency_ms'] or {}).get(key), False
+            continue
+        if name == 'compression':
+            for target, totals in sorted(result.items()):
+                yield f"{name}.{target}", 'ratio', totals['ratio'], False
+                yield f"{name}.{target}", 'cpu_ms_per_mb_saved', totals['cpu_ms_per_mb_saved'], False
+            continue
+        yield name, 'throughput_rps', result['throughput_rps'], True
+        yield name, 'errors', result['errors'], False
+        for key in LATENCY_KEYS:
+            yield name, f"latency_ms.{key}", (result['latency_ms'] or {}).get(key), False
+        if 'planning_ms' in result:  # prepared.py
+            yield name, 'planning_ms.mean', (result['planning_ms'] or {}).get('mean'), False
+
+
+def compare(before, after, threshold):
+    old = {(name, metric): value for name, metric, value, _ in _rows(before['results'])}
+    regressions = []
+    lines = [f"{'workload':<38} {'metric':<24} {'before':>10} {'after':>10} {'change':>8}"]
+    for name, metric, value, higher_is_better in _rows(after['results']):
+        previous = old.get((name, metric))
+        if previous is None or value is None:
+            change = ""
+        elif previous == 0:
+            change = "" if value == 0 else "new"
+            if value and metric == 'errors':
+                regressions.append((name, metric))
+        else:
+            delta = (value - previous) / previous * 100
+            change = f"{delta:+.1f}%"
+            worse = -delta if higher_is_better else delta
+            if worse > threshold:
+                regressions.append((name, metric))
+                change += " !"
+        lines.append(f"{name:<38} {metric:<24} {'' if previous is None else previous:>10} "
+                     f"{'' if value is None else value:>10} {change:>8}")
+    return lines, regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compare two benchmark result files.")
+    parser.add_argument('before')
+    parser.add_argument('after')
+    parser.add_argument('--threshold', type=float, default=10, help="Percent change reported as a regression.")
+    args = parser.parse_args(argv)
+    with open(args.before) as f:
+        before = json.load(f)
+    with open(args.after) as f:
+        after = json.load(f)
+
+    print(f"before: {before['meta']['commit']}  after: {after['meta']['commit']}")
+    if before['meta']['config'] != after['meta']['config']:
+        print("warning: the runs used different settings; compare with care")
+    lines, regressions = compare(before, after, args.threshold)
+    print("\n".join(lines))
+    if regressions:
+        print(f"\n{len(regressions)} regression(s) over {args.threshold:g}%")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
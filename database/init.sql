@@ -1,3 +1,6 @@
+-- Trigram indexes for fuzzy diagram search
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
 -- Table for Users
 CREATE TABLE users (
     user_id SERIAL PRIMARY KEY,
@@ -35,6 +38,9 @@ CREATE TABLE diagrams (
     diagram_name VARCHAR(255) NOT NULL,
     project_id INT NOT NULL,
     diagram_data JSONB, -- Using JSONB for potentially complex diagram data
+    live_revision INT NULL, -- Real-time revision diagram_data was last flushed from; NULL after a REST save to a diagram without live history
+    search_text TEXT NULL, -- Lower-cased name and Mermaid source, maintained by trigger for trigram search
+    search_vector TSVECTOR NULL, -- Full-text index of the name (weight A) and source (weight B), maintained by trigger
     created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
     updated_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
     FOREIGN KEY (project_id) REFERENCES projects(project_id) ON DELETE CASCADE
@@ -52,12 +58,68 @@ CREATE TABLE sharing_permissions (
     UNIQUE (project_id, user_id) -- Ensures a user doesn't have multiple permissions for the same project
 );
 
+-- Large real-time messages relayed between backend workers by reference (NOTIFY payloads
+-- are capped at 8000 bytes). Rows are transient, so the table is not WAL-logged.
+CREATE UNLOGGED TABLE socket_messages (
+    message_id BIGSERIAL PRIMARY KEY,
+    diagram_id INT NOT NULL,
+    payload TEXT NOT NULL,
+    created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+);
+
+-- Sequenced real-time edits per diagram. The primary key is what orders edits globally:
+-- a worker claims revision N by inserting it, and loses the race if another worker already
+-- did. `snapshot` holds the full text every few revisions so rooms can be loaded without
+-- replaying the whole history; older rows are purged.
+CREATE UNLOGGED TABLE diagram_ops (
+    diagram_id INT NOT NULL,
+    revision INT NOT NULL,
+    ops TEXT NULL, -- JSON list of text operations; NULL for the initial revision
+    snapshot TEXT NULL, -- Full text after this revision, written every ROOM_SNAPSHOT_INTERVAL revisions
+    origin VARCHAR(255) NULL, -- Worker that sequenced the edit
+    created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (diagram_id, revision),
+    FOREIGN KEY (diagram_id) REFERENCES diagrams(diagram_id) ON DELETE CASCADE
+);
+
+-- Revision history of diagrams.diagram_data (see backend/revisions.py). `payload` is
+-- zlib-compressed: the full canonical JSON text for snapshots, otherwise text ops against
+-- the previous version.
+CREATE TABLE diagram_revisions (
+    diagram_id INT NOT NULL,
+    version INT NOT NULL,
+    is_snapshot BOOLEAN NOT NULL,
+    payload BYTEA NOT NULL,
+    size INT NOT NULL, -- Uncompressed length of the version's text
+    user_id INT NULL, -- Who saved it; NULL for live edits
+    created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (diagram_id, version),
+    FOREIGN KEY (diagram_id) REFERENCES diagrams(diagram_id) ON DELETE CASCADE,
+    FOREIGN KEY (user_id) REFERENCES users(user_id) ON DELETE SET NULL
+);
+
+-- Per-user version of the project listing (backend/project_listing.py). Bumped by every
+-- change to a user's projects, their sharing or their diagram counts; workers serve a
+-- cached listing only while its generation matches.
+CREATE TABLE project_listing_generations (
+    user_id INT PRIMARY KEY,
+    generation BIGINT NOT NULL DEFAULT 0,
+    FOREIGN KEY (user_id) REFERENCES users(user_id) ON DELETE CASCADE
+);
+
 -- Indexes for faster lookups
 CREATE INDEX idx_users_email ON users(email); -- Email is already unique, but an explicit index can be good
 CREATE INDEX idx_projects_user_id ON projects(user_id);
 CREATE INDEX idx_diagrams_project_id ON diagrams(project_id);
+-- Keyset pagination for diagram listings: newest first within a project
+CREATE INDEX idx_diagrams_project_updated ON diagrams(project_id, updated_at DESC, diagram_id DESC);
+-- Diagram search: full-text matches, and substring/typo-tolerant matches through trigrams
+CREATE INDEX idx_diagrams_search_vector ON diagrams USING GIN (search_vector);
+CREATE INDEX idx_diagrams_search_text_trgm ON diagrams USING GIN (search_text gin_trgm_ops);
 CREATE INDEX idx_sharing_project_id ON sharing_permissions(project_id);
 CREATE INDEX idx_sharing_user_id ON sharing_permissions(user_id);
+CREATE INDEX idx_socket_messages_created_at ON socket_messages(created_at);
+CREATE INDEX idx_diagram_revisions_created_at ON diagram_revisions(created_at);
 
 -- Optional: Add a trigger to update 'updated_at' timestamp on projects, diagrams, and users
 CREATE OR REPLACE FUNCTION update_updated_at_column()
@@ -82,3 +144,21 @@ CREATE TRIGGER update_users_updated_at
 BEFORE UPDATE ON users
 FOR EACH ROW
 EXECUTE FUNCTION update_updated_at_column();
+
+-- Keep the diagram search columns in step with the name and the Mermaid source
+CREATE OR REPLACE FUNCTION update_diagram_search_columns()
+RETURNS TRIGGER AS $$
+DECLARE
+    source TEXT := COALESCE(NEW.diagram_data->>'code', '');
+BEGIN
+    NEW.search_text = lower(NEW.diagram_name || E'\n' || source);
+    NEW.search_vector = setweight(to_tsvector('simple', NEW.diagram_name), 'A')
+                     || setweight(to_tsvector('simple', source), 'B');
+    RETURN NEW;
+END;
+$$ language 'plpgsql';
+
+CREATE TRIGGER update_diagrams_search_columns
+BEFORE INSERT OR UPDATE OF diagram_name, diagram_data ON diagrams
+FOR EACH ROW
+EXECUTE FUNCTION update_diagram_search_columns();
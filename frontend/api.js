@@ -35,9 +35,9 @@ async function getProjects() {
     // return await response.json();
     await new Promise(resolve => setTimeout(resolve, 500)); // Simulate network delay
     return [
-        { project_id: 1, project_name: 'My First Project', user_id: 1, role: 'owner', created_at: new Date().toISOString(), updated_at: new Date().toISOString() },
-        { project_id: 2, project_name: 'Shared Project Alpha', user_id: 2, role: 'edit', created_at: new Date().toISOString(), updated_at: new Date().toISOString() },
-        { project_id: 3, project_name: 'Another Cool Project', user_id: 1, role: 'owner', created_at: new Date().toISOString(), updated_at: new Date().toISOString() },
+        { project_id: 1, project_name: 'My First Project', user_id: 1, role: 'owner', created_at: new Date().toISOString(), updated_at: new Date().toISOString(), diagram_count: 2, last_activity: new Date().toISOString() },
+        { project_id: 2, project_name: 'Shared Project Alpha', user_id: 2, role: 'edit', created_at: new Date().toISOString(), updated_at: new Date().toISOString(), diagram_count: 1, last_activity: new Date().toISOString() },
+        { project_id: 3, project_name: 'Another Cool Project', user_id: 1, role: 'owner', created_at: new Date().toISOString(), updated_at: new Date().toISOString(), diagram_count: 0, last_activity: new Date().toISOString() },
     ];
 }
 
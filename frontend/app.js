@@ -5,8 +5,7 @@ document.addEventListener('DOMContentLoaded', () => {
     let currentProject = null; // Selected project
     let currentDiagrams = [];
     let currentDiagram = null; // Selected diagram for editing
-    let diagramSocket = null; // WebSocket for the current diagram
-    let isRemoteUpdate = false; // Flag to prevent echo loops
+    let diagramSync = null; // Real-time session (DiagramSync) for the current diagram
 
     // --- DOM Elements from UI.js (or query them here if not exposed) ---
     const homeLink = document.getElementById('home-link');
@@ -58,9 +57,9 @@ document.addEventListener('DOMContentLoaded', () => {
                 UI.showView('projects'); // Fallback if no current project
             }
             currentDiagram = null;
-            if (diagramSocket) {
-                SocketService.close(diagramSocket);
-                diagramSocket = null;
+            if (diagramSync) {
+                diagramSync.close();
+                diagramSync = null;
             }
         });
         saveDiagramBtn.addEventListener('click', handleSaveDiagram);
@@ -217,26 +216,24 @@ document.addEventListener('DOMContentLoaded', () => {
             const diagramId = parseInt(li.dataset.diagramId);
             if (!isNaN(diagramId)) {
                 // Close previous socket if open
-                if (diagramSocket) {
-                    SocketService.close(diagramSocket);
-                    diagramSocket = null;
+                if (diagramSync) {
+                    diagramSync.close();
+                    diagramSync = null;
                 }
 
                 currentDiagram = currentDiagrams.find(d => d.diagram_id === diagramId);
                 if (currentDiagram) {
                     console.log(`App: Diagram ${currentDiagram.diagram_name} selected.`);
-                    const detailedDiagram = await Api.getDiagramDetails(currentDiagram.diagram_id);
-                    currentDiagram = detailedDiagram; 
                     UI.showView('editor');
-                    UI.populateEditor(currentDiagram); // This will also do an initial render
+                    UI.populateEditor(currentDiagram); // Name only; the code arrives in the socket's first snapshot
 
                     // Establish WebSocket connection for the selected diagram
-                    diagramSocket = SocketService.connect(
-                        currentDiagram.diagram_id,
-                        handleIncomingSocketMessage,
-                        handleSocketError,
-                        handleSocketClose
-                    );
+                    diagramSync = new DiagramSync(currentDiagram.diagram_id, {
+                        getText: () => UI.mermaidCodeTextarea.value,
+                        setText: handleRemoteText,
+                        onError: handleSocketError,
+                        onClose: handleSocketClose
+                    });
                 }
             }
         }
@@ -267,6 +264,12 @@ document.addEventListener('DOMContentLoaded', () => {
             alert("No diagram selected for saving.");
             return;
         }
+        if (diagramSync && diagramSync.rev !== null) {
+            // Live sessions are written back by the server; flush anything the debounce has not sent yet
+            diagramSync.localChange();
+            alert("Diagram saved. Changes are saved automatically while you are connected.");
+            return;
+        }
         const newCode = UI.mermaidCodeTextarea.value;
         // Assuming diagram name isn't changed here, but could add UI for it
         const newName = currentDiagram.diagram_name; 
@@ -293,34 +296,43 @@ document.addEventListener('DOMContentLoaded', () => {
     }
 
     function handleMermaidCodeChange() {
-        if (isRemoteUpdate) { // If update came from socket, don't send it back
-            isRemoteUpdate = false; // Reset flag
-            return;
-        }
-        if (currentDiagram && diagramSocket) {
-            const code = UI.mermaidCodeTextarea.value;
-            UI.renderMermaidDiagram(code); // Render locally first
-            SocketService.send(diagramSocket, code); // Send update to other clients
-            console.log("App: Sent diagram update via WebSocket.");
-        } else if (currentDiagram) { // Diagram loaded, but no socket (local editing only)
-             const code = UI.mermaidCodeTextarea.value;
-             UI.renderMermaidDiagram(code);
+        if (!currentDiagram) return;
+        const code = UI.mermaidCodeTextarea.value;
+        UI.renderMermaidDiagram(code); // Render locally first
+        if (diagramSync) {
+            diagramSync.localChange(); // Sends only what changed since the last sync
         }
     }
 
     // --- WebSocket Event Handlers ---
-    function handleIncomingSocketMessage(newCode) {
-        if (currentDiagram && UI.mermaidCodeTextarea.value !== newCode) {
+    // Called by DiagramSync with the new text and the remote edit that produced it
+    // (null when a whole snapshot was taken), so the caret can follow the edit.
+    function handleRemoteText(newCode, ops) {
+        if (!currentDiagram) return;
+        const textarea = UI.mermaidCodeTextarea;
+        if (textarea.value !== newCode) {
             console.log("App: Received diagram update via WebSocket:", newCode.substring(0,50) + "...");
-            isRemoteUpdate = true; // Set flag to prevent echo
-            UI.mermaidCodeTextarea.value = newCode;
-            UI.renderMermaidDiagram(newCode);
-            // Update currentDiagram's data if needed, though saving is a separate step
-            if (currentDiagram.diagram_data && typeof currentDiagram.diagram_data === 'object') {
-                currentDiagram.diagram_data.code = newCode;
-            } else {
-                currentDiagram.diagram_data = { code: newCode };
+            const oldValue = textarea.value;
+            // Selection offsets are UTF-16 units, edits are in code points
+            const toPoints = (offset) => Array.from(oldValue.slice(0, offset)).length;
+            const toUnits = (index) => Array.from(newCode).slice(0, index).join('').length;
+            let start = toPoints(textarea.selectionStart);
+            let end = toPoints(textarea.selectionEnd);
+            if (ops) {
+                start = TextOps.transformIndex(start, ops);
+                end = TextOps.transformIndex(end, ops);
+            }
+            textarea.value = newCode; // Setting value does not fire 'input', so this is not sent back
+            if (document.activeElement === textarea) {
+                textarea.setSelectionRange(toUnits(start), toUnits(end));
             }
+            UI.renderMermaidDiagram(newCode);
+        }
+        // Update currentDiagram's data if needed, though saving is a separate step
+        if (currentDiagram.diagram_data && typeof currentDiagram.diagram_data === 'object') {
+            currentDiagram.diagram_data.code = newCode;
+        } else {
+            currentDiagram.diagram_data = { code: newCode };
         }
     }
 
@@ -329,9 +341,9 @@ document.addEventListener('DOMContentLoaded', () => {
         // Optionally, display a user-friendly message, e.g., using a toast notification
         alert("Real-time collaboration error: Connection to the server failed or was interrupted.");
         // You might want to disable collaborative features or attempt reconnection here.
-        if (diagramSocket) {
-            SocketService.close(diagramSocket); // Ensure it's fully closed
-            diagramSocket = null;
+        if (diagramSync) {
+            diagramSync.close(); // Ensure it's fully closed
+            diagramSync = null;
         }
     }
 
@@ -341,7 +353,7 @@ document.addEventListener('DOMContentLoaded', () => {
         // if (!event.wasClean) { // Check event.wasClean if available
         //     alert("Real-time collaboration session ended unexpectedly.");
         // }
-        diagramSocket = null; // Clear the socket reference
+        diagramSync = null; // Clear the session reference
     }
 
 
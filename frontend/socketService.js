@@ -56,3 +56,249 @@ const SocketService = {
 
 // If using modules:
 // export default SocketService;
+
+// --- Text operations ---
+// Same model as backend/text_ops.py; keep the two in sync. An edit is a list of primitive
+// operations applied in order, positions counted in Unicode code points:
+//   { p: 5, i: "abc" }  insert "abc" before position 5
+//   { p: 5, d: 3 }      delete 3 characters starting at position 5
+const TextOps = {
+    apply(text, ops) {
+        let chars = Array.from(text);
+        for (const op of ops) {
+            if (op.p > chars.length) {
+                throw new Error(`Operation position ${op.p} is beyond the end of the text (${chars.length}).`);
+            }
+            if (op.i !== undefined) {
+                chars = chars.slice(0, op.p).concat(Array.from(op.i), chars.slice(op.p));
+            } else {
+                if (op.p + op.d > chars.length) {
+                    throw new Error(`Delete of ${op.d} at ${op.p} runs past the end of the text (${chars.length}).`);
+                }
+                chars = chars.slice(0, op.p).concat(chars.slice(op.p + op.d));
+            }
+        }
+        return chars.join('');
+    },
+
+    // Smallest single-splice edit turning oldText into newText.
+    diff(oldText, newText) {
+        if (oldText === newText) return [];
+        const a = Array.from(oldText);
+        const b = Array.from(newText);
+        const limit = Math.min(a.length, b.length);
+        let start = 0;
+        while (start < limit && a[start] === b[start]) start++;
+        let endA = a.length, endB = b.length;
+        while (endA > start && endB > start && a[endA - 1] === b[endB - 1]) {
+            endA--;
+            endB--;
+        }
+        const ops = [];
+        if (endA > start) ops.push({ p: start, d: endA - start });
+        if (endB > start) ops.push({ p: start, i: b.slice(start, endB).join('') });
+        return ops;
+    },
+
+    _deleteAfterDelete(x, y) {
+        const overlap = Math.max(0, Math.min(x.p + x.d, y.p + y.d) - Math.max(x.p, y.p));
+        const remaining = x.d - overlap;
+        const p = x.p <= y.p ? x.p : Math.max(y.p, x.p - y.d);
+        return remaining > 0 ? [{ p, d: remaining }] : [];
+    },
+
+    _insertVsDelete(ins, del) {
+        const length = Array.from(ins.i).length;
+        if (ins.p <= del.p) return [[ins], [{ p: del.p + length, d: del.d }]];
+        if (ins.p >= del.p + del.d) return [[{ p: ins.p - del.d, i: ins.i }], [del]];
+        const before = ins.p - del.p;
+        return [[{ p: del.p, i: ins.i }],
+                [{ p: del.p, d: before }, { p: del.p + length, d: del.d - before }]];
+    },
+
+    _transformPrimitive(a, b) {
+        if (a.i !== undefined && b.i !== undefined) {
+            if (b.p <= a.p) return [[{ p: a.p + Array.from(b.i).length, i: a.i }], [b]];
+            return [[a], [{ p: b.p + Array.from(a.i).length, i: b.i }]];
+        }
+        if (a.i !== undefined) return this._insertVsDelete(a, b);
+        if (b.i !== undefined) {
+            const [bPrime, aPrime] = this._insertVsDelete(b, a);
+            return [aPrime, bPrime];
+        }
+        return [this._deleteAfterDelete(a, b), this._deleteAfterDelete(b, a)];
+    },
+
+    // Transforms concurrent edits a and b made against the same text; returns [a', b'] where
+    // a' applies after b and b' after a. b is the edit sequenced first and wins ties.
+    transform(aOps, bOps) {
+        if (!aOps.length || !bOps.length) return [aOps.slice(), bOps.slice()];
+        if (aOps.length === 1 && bOps.length === 1) return this._transformPrimitive(aOps[0], bOps[0]);
+        if (aOps.length > 1) {
+            const [aHead, bAfterHead] = this.transform(aOps.slice(0, 1), bOps);
+            const [aTail, bAfterAll] = this.transform(aOps.slice(1), bAfterHead);
+            return [aHead.concat(aTail), bAfterAll];
+        }
+        const [aAfterHead, bHead] = this.transform(aOps, bOps.slice(0, 1));
+        const [aAfterAll, bTail] = this.transform(aAfterHead, bOps.slice(1));
+        return [aAfterAll, bHead.concat(bTail)];
+    },
+
+    // Where a cursor at code point `index` ends up after ops made by someone else.
+    transformIndex(index, ops) {
+        for (const op of ops) {
+            if (op.i !== undefined) {
+                if (op.p < index) index += Array.from(op.i).length;
+            } else if (op.p < index) {
+                index -= Math.min(op.d, index - op.p);
+            }
+        }
+        return index;
+    }
+};
+
+// --- Collaborative editing session ---
+// Keeps a diagram's text in sync through the server's revisioned protocol:
+// at most one edit is in flight (pending) and local edits made meanwhile are buffered;
+// edits from others are transformed against both before being applied.
+//
+//   getText()            current editor contents
+//   setText(text, ops)   replace the editor contents; ops is the remote edit (null for a snapshot)
+class DiagramSync {
+    constructor(diagramId, { getText, setText, onError, onClose }) {
+        this.getText = getText;
+        this.setText = setText;
+        this.rev = null;          // Last server revision reflected in `shadow`
+        this.shadow = '';         // Server text at `rev` plus our pending and buffered edits
+        this.pending = null;      // Edit sent and not acknowledged yet
+        this.pendingSeq = null;
+        this.buffer = [];         // Edits made while `pending` was in flight
+        this.seq = 0;
+        this.awaitingResync = false;
+        // The server sends the current snapshot as soon as the connection opens
+        this.socket = SocketService.connect(
+            diagramId,
+            (data) => this.handleMessage(data),
+            onError,
+            onClose
+        );
+    }
+
+    // Call after the user edits the text.
+    localChange() {
+        if (this.rev === null || this.awaitingResync) return;
+        const text = this.getText();
+        const ops = TextOps.diff(this.shadow, text);
+        if (!ops.length) return;
+        this.shadow = text;
+        if (this.pending) {
+            this.buffer = this.buffer.concat(ops);
+        } else {
+            this.sendOps(ops);
+        }
+    }
+
+    sendOps(ops) {
+        this.pending = ops;
+        this.pendingSeq = ++this.seq;
+        SocketService.send(this.socket, JSON.stringify({ type: 'op', base_rev: this.rev, ops, seq: this.pendingSeq }));
+    }
+
+    requestResync() {
+        this.awaitingResync = true;
+        SocketService.send(this.socket, JSON.stringify({ type: 'resync' }));
+    }
+
+    handleMessage(data) {
+        let msg;
+        try {
+            msg = JSON.parse(data);
+        } catch (e) {
+            console.error("DiagramSync: Ignoring non-JSON message.", e);
+            return;
+        }
+        switch (msg.type) {
+            case 'snapshot': return this.handleSnapshot(msg);
+            case 'ack': return this.handleAck(msg);
+            case 'op': return this.handleRemoteOp(msg);
+            case 'error':
+                console.error("DiagramSync: Server rejected a message:", msg.message);
+                return;
+        }
+    }
+
+    handleSnapshot(msg) {
+        if (this.rev === null) {
+            // First snapshot after connecting
+            this.adopt(msg);
+            return;
+        }
+        if (msg.resync) {
+            if (msg.seq !== undefined && msg.seq !== this.pendingSeq) return; // Rejection of an edit we already replaced
+            const local = this.getText();
+            this.awaitingResync = false;
+            this.adopt(msg);
+            // Re-send whatever we had on top of the server text as a fresh edit
+            const ops = TextOps.diff(msg.text, local);
+            if (ops.length) {
+                this.shadow = local;
+                this.setText(local, null);
+                this.sendOps(ops);
+            }
+            return;
+        }
+        // Periodic snapshot: only worth taking when we have nothing of our own in flight
+        if (!this.pending && !this.buffer.length && msg.rev >= this.rev && this.getText() === this.shadow) {
+            const changed = msg.text !== this.shadow;
+            this.rev = msg.rev;
+            this.shadow = msg.text;
+            if (changed) this.setText(msg.text, null);
+        }
+    }
+
+    adopt(msg) {
+        this.rev = msg.rev;
+        this.shadow = msg.text;
+        this.pending = null;
+        this.pendingSeq = null;
+        this.buffer = [];
+        this.setText(msg.text, null);
+    }
+
+    handleAck(msg) {
+        if (this.awaitingResync || msg.seq !== this.pendingSeq) return;
+        this.rev = msg.rev;
+        this.pending = null;
+        this.pendingSeq = null;
+        if (this.buffer.length) {
+            const ops = this.buffer;
+            this.buffer = [];
+            this.sendOps(ops);
+        }
+    }
+
+    handleRemoteOp(msg) {
+        if (this.rev === null || this.awaitingResync || msg.rev <= this.rev) return;
+        if (msg.rev !== this.rev + 1) { // Missed a revision
+            this.requestResync();
+            return;
+        }
+        this.localChange(); // Fold in typing the debounce has not picked up yet
+        let incoming = msg.ops;
+        if (this.pending) [this.pending, incoming] = TextOps.transform(this.pending, incoming);
+        if (this.buffer.length) [this.buffer, incoming] = TextOps.transform(this.buffer, incoming);
+        this.rev = msg.rev;
+        try {
+            this.shadow = TextOps.apply(this.shadow, incoming);
+        } catch (e) {
+            console.error("DiagramSync: Could not apply remote edit, resyncing.", e);
+            this.requestResync();
+            return;
+        }
+        this.setText(this.shadow, incoming);
+    }
+
+    close() {
+        SocketService.close(this.socket);
+    }
+}
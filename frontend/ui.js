@@ -60,6 +60,9 @@ function renderProjectList(projects) {
     projects.forEach(project => {
         const li = document.createElement('li');
         li.textContent = project.project_name;
+        if (project.diagram_count !== undefined) { // Listing aggregates, so no per-project follow-up requests
+            li.title = `${project.diagram_count} diagram(s), last activity ${new Date(project.last_activity).toLocaleString()}`;
+        }
         li.dataset.projectId = project.project_id; // Store project ID
         li.dataset.role = project.role; // Store role (owner, edit, view)
         